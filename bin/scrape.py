@@ -1,3 +1,4 @@
+import argparse
 import asyncio
 import json
 import logging
@@ -5,17 +6,26 @@ from pathlib import Path
 import sys
 sys.path.append(str(Path(__file__).resolve().parent.parent))
 import subscrape
+from subscrape.apis import replay
 
 log_level = logging.INFO
 
 
-async def main():
+async def main(args):
     """Loads `config/scrape_config.json and iterates over all chains present in the config.
     Will call `scraper_factory()` to retrieve the proper scraper for a chain.
     If `_version` in the config does not match the current version, a warning is logged.
+
+    :param args: the parsed command line arguments
+    :type args: argparse.Namespace
     """
     logging.basicConfig(level=log_level, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s (%(filename)s:%(lineno)s)')
 
+    if args.record is not None:
+        replay.enable_recording(args.record)
+    elif args.replay is not None:
+        replay.enable_replay(args.replay, args.replay_latency, args.replay_max_calls_per_sec)
+
     # httpx with asyncio can cause an "unclosed transport" error on Windows. A workaround is to set a different loop
     # policy. See https://github.com/encode/httpx/issues/914
     # and https://github.com/encode/httpx/issues/914#issuecomment-622586610
@@ -41,4 +51,11 @@ async def main():
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description="Scrape the chains configured in config/scrape_config.json")
+    parser.add_argument("--record", metavar="ARCHIVE", help="record all explorer responses to this archive")
+    parser.add_argument("--replay", metavar="ARCHIVE", help="serve all explorer requests from this archive")
+    parser.add_argument("--replay-latency", type=float, default=0.0, metavar="SECONDS",
+                        help="simulated latency of every replayed request")
+    parser.add_argument("--replay-max-calls-per-sec", type=float, default=None, metavar="CALLS",
+                        help="simulated rate limit of the replayed explorers")
+    asyncio.run(main(parser.parse_args()))
@@ -1,3 +1,4 @@
+import asyncio
 import logging
 import os
 from pathlib import Path
@@ -8,40 +9,108 @@ from subscrape.scrapers.parachain_scraper import ParachainScraper
 from subscrape.db.subscrape_db import SubscrapeDB
 from subscrape.scrapers.scrape_config import ScrapeConfig
 from subscrape.apis.subscan_wrapper import SubscanWrapper
+from subscrape.apis import replay, shared_rate_limiter
+from subscrape.apis.response_cache import ResponseCache
 
 repo_root = Path(__file__).parent.parent.absolute()
 logger = logging.getLogger(__name__)
+response_cache_path = Path("data/cache/http/responses.db")
+default_db_connection_string = "sqlite:///data/cache/default.db"
+_response_caches = {}   # one open response cache per path, shared by all wrappers
+_subscan_key_pools = {}  # one pool per set of Subscan keys, shared by all chains, since a key's budget spans them
 
+replay.configure_from_environment()
 
-def moonscan_factory(chain):
+
+def read_api_keys(key_path: Path) -> list:
+    """
+    Read the API keys from a key file. The file may contain several keys, one per line.
+
+    :param key_path: path of the key file
+    :type key_path: Path
+    :return: the list of keys. Empty if the file does not exist.
+    :rtype: list
+    """
+    if not key_path.exists():
+        return []
+    with key_path.open(encoding="UTF-8", mode='r') as source:
+        return [line.strip() for line in source.read().splitlines() if line.strip()]
+
+
+def shared_rate_limit_dir(chain_config: ScrapeConfig = None):
+    """
+    Return the folder through which rate budgets are coordinated across processes, or None if the config does not ask
+    for it or the platform does not support it.
+
+    :param chain_config: configuration for the specific chain
+    :type chain_config: ScrapeConfig
+    """
+    if chain_config is None or not chain_config.shared_rate_limit:
+        return None
+    if not shared_rate_limiter.is_supported():
+        logger.warning("Cross-process rate limiting is not supported on this platform. Using a local rate limit.")
+        return None
+    return repo_root / 'data' / 'ratelimit'
+
+
+def response_cache_factory(chain_config: ScrapeConfig = None):
+    """
+    Return the persistent response cache shared by all API wrappers, or None if the config disables it or explorer
+    traffic is recorded or replayed.
+
+    :param chain_config: configuration for the specific chain
+    :type chain_config: ScrapeConfig
     """
-    Return a configured Moonscan API interface, including API key to speed up transactions
+    if chain_config is not None and not chain_config.response_cache:
+        return None
+    if replay.is_active():
+        # every request has to reach the recording or replay transport
+        return None
+    if response_cache_path not in _response_caches:
+        _response_caches[response_cache_path] = ResponseCache(response_cache_path)
+    return _response_caches[response_cache_path]
+
+
+def close_response_caches():
+    """
+    Close the open response caches. They are opened again on demand.
+    """
+    for response_cache in _response_caches.values():
+        response_cache.close()
+    _response_caches.clear()
+
+
+def moonscan_factory(chain, chain_config: ScrapeConfig = None):
+    """
+    Return a configured Moonscan API interface, including API keys to speed up transactions
 
     :param chain: name of the specific EVM chain
     :type chain: str
+    :param chain_config: configuration for the specific chain
+    :type chain_config: ScrapeConfig
     """
-    moonscan_key = None
-    moonscan_key_path = repo_root / 'config' / f'moonscan-{chain}-key'
-    if moonscan_key_path.exists():
-        with moonscan_key_path.open(encoding="UTF-8", mode='r') as source:
-            moonscan_key = source.read()
+    moonscan_keys = read_api_keys(repo_root / 'config' / f'moonscan-{chain}-key')
 
-    return MoonscanWrapper(chain, moonscan_key)
+    return MoonscanWrapper(chain, moonscan_keys or None, shared_rate_limit_dir=shared_rate_limit_dir(chain_config),
+                           response_cache=response_cache_factory(chain_config))
 
 
-def blockscout_factory(chain):
+def blockscout_factory(chain, chain_config: ScrapeConfig = None):
     """
     Return a configured Blockscout API interface
 
     :param chain: name of the specific EVM chain
     :type chain: str
+    :param chain_config: configuration for the specific chain
+    :type chain_config: ScrapeConfig
     """
-    return BlockscoutWrapper(chain)
+    return BlockscoutWrapper(chain, shared_rate_limit_dir=shared_rate_limit_dir(chain_config),
+                             response_cache=response_cache_factory(chain_config))
 
 
 def subscan_factory(chain, db: SubscrapeDB, chain_config: ScrapeConfig):
     """
-    Return a configured Subscan API interface, including API key to speed up transactions
+    Return a configured Subscan API interface, including API keys to speed up transactions
 
     :param chain: name of the specific substrate chain
     :type chain: str
@@ -50,13 +119,17 @@ def subscan_factory(chain, db: SubscrapeDB, chain_config: ScrapeConfig):
     :param chain_config: configuration for the specific chain
     :type chain_config: ScrapeConfig
     """
-    subscan_key = None
-    subscan_key_path = repo_root / 'config' / 'subscan-key'
-    if subscan_key_path.exists():
-        with subscan_key_path.open(encoding="UTF-8", mode='r') as source:
-            subscan_key = source.read()
+    subscan_keys = read_api_keys(repo_root / 'config' / 'subscan-key')
+    rate_limit_dir = shared_rate_limit_dir(chain_config)
+    # anonymous calls are limited per endpoint, so only pools of real keys are shared between the chains
+    pool_key = (tuple(subscan_keys), rate_limit_dir)
 
-    scraper = SubscanWrapper(chain, db, subscan_key)
+    scraper = SubscanWrapper(chain, db, subscan_keys or None,
+                             shared_rate_limit_dir=rate_limit_dir,
+                             response_cache=response_cache_factory(chain_config),
+                             api_key_pool=_subscan_key_pools.get(pool_key))
+    if len(subscan_keys) > 0:
+        _subscan_key_pools.setdefault(pool_key, scraper.api_keys)
     return scraper
 
 
@@ -71,50 +144,111 @@ def scraper_factory(chain_name, chain_config: ScrapeConfig, db_factory: callable
     :param db_factory: optional function to use to create a database connection. takes the chain config as parameter
     :type db_factory: callable
     """
+    # determine the database connection string
+    if chain_config.db_connection_string is None:
+        db_connection_string = default_db_connection_string
+    else:
+        db_connection_string = chain_config.db_connection_string
+
+    # create the database object
+    if db_factory is None:
+        db = SubscrapeDB(db_connection_string, background_writer=chain_config.background_writer)
+    else:
+        db = db_factory(chain_config)
+
     if chain_name == "moonriver" or chain_name == "moonbeam":
         db_path = Path(__file__).parent.parent / 'data' / 'parachains'
         if not db_path.is_dir():
             db_path.mkdir(parents=True)
         db_path = db_path / f'{chain_name}_'
-        moonscan_api = moonscan_factory(chain_name)
-        blockscout_api = blockscout_factory(chain_name)
+        moonscan_api = moonscan_factory(chain_name, chain_config)
+        blockscout_api = blockscout_factory(chain_name, chain_config)
         scraper = MoonbeamScraper(db_path=db_path, moonscan_api=moonscan_api, blockscout_api=blockscout_api,
-                                  chain_name=chain_name)
+                                  chain_name=chain_name, db=db)
         return scraper
     else:
-        # determine the database connection string
-        if chain_config.db_connection_string is None:
-            db_connection_string = "sqlite:///data/cache/default.db"
-        else:
-            db_connection_string = chain_config.db_connection_string
-
-        # create the database object
-        if db_factory is None:
-            db = SubscrapeDB(db_connection_string)
-        else:
-            db = db_factory(chain_config)
-
         subscan_api = subscan_factory(chain_name, db, chain_config)
         scraper = ParachainScraper(subscan_api)
         return scraper
 
 
+def shared_db_factory(dbs: dict = None) -> callable:
+    """
+    Return a db factory that hands out one `SubscrapeDB` per connection string, so that chains scraped concurrently
+    into the same database share a session instead of locking each other out.
+
+    :param dbs: optional dict that collects the databases by connection string, so that the caller can close them
+    :type dbs: dict
+    :return: function that takes the chain config and returns the database
+    :rtype: callable
+    """
+    if dbs is None:
+        dbs = {}
+
+    def db_factory(chain_config: ScrapeConfig) -> SubscrapeDB:
+        db_connection_string = chain_config.db_connection_string or default_db_connection_string
+        if db_connection_string not in dbs:
+            dbs[db_connection_string] = SubscrapeDB(db_connection_string,
+                                                    background_writer=chain_config.background_writer)
+        return dbs[db_connection_string]
+
+    return db_factory
+
+
+async def _scrape_chain(chain_name, operations, chain_config: ScrapeConfig, db_factory: callable = None) -> list:
+    """
+    Scrape a single chain.
+
+    :param chain_name: name of the specific chain
+    :type chain_name: str
+    :param operations: the config of the chain
+    :type operations: dict
+    :param chain_config: configuration for the specific chain
+    :type chain_config: ScrapeConfig
+    :param db_factory: optional function to use to create a database connection
+    :type db_factory: callable
+    :return: the list of scraped items
+    """
+    scraper = scraper_factory(chain_name, chain_config, db_factory)
+    try:
+        items = await scraper.scrape(operations, chain_config)
+    finally:
+        await scraper.close()
+    logger.info(f"Scraped {len(items)} items from {chain_name}")
+    return items
+
+
 async def scrape(chains_config, db_factory=None) -> list:
     """
     For each specified chain, get an appropriate scraper and then scrape the chain for transactions of interest based
-    on the config file.
+    on the config file. The chains are scraped concurrently, since each of them talks to its own explorer endpoints
+    with their own rate budgets. A failing chain does not interrupt the others; once all chains are done, the first
+    error is raised.
 
     :param chains_config: list of chains to scrape
     :type chains_config: list
     :param db_factory: optional function to use to create a database connection. takes the chain config as parameter
     :type db_factory: function
-    :return: the list of scraped items
+    :return: the list of scraped items, in the order of the chains in the config
     """
     items = []
+    dbs = {}    # the databases this run opened itself and has to close
+    replay_state = replay.current_state()
 
     try:
         scrape_config = ScrapeConfig(chains_config)
 
+        # record or replay all explorer traffic if the config asks for it
+        if "_record" in chains_config:
+            replay.enable_recording(chains_config["_record"])
+        elif "_replay" in chains_config:
+            replay.enable_replay(chains_config["_replay"])
+
+        if db_factory is None:
+            db_factory = shared_db_factory(dbs)
+
+        chain_names = []
+        tasks = []
         for chain_name in chains_config:
             if chain_name.startswith("_"):
                 if chain_name == "_version" and chains_config[chain_name] != 1:
@@ -128,27 +262,60 @@ async def scrape(chains_config, db_factory=None) -> list:
                 logger.info(f"Config asks to skip chain {chain_name}")
                 continue
 
-            scraper = scraper_factory(chain_name, chain_config, db_factory)
-            new_items = await scraper.scrape(operations, chain_config)
-            items.extend(new_items)
+            chain_names.append(chain_name)
+            tasks.append(_scrape_chain(chain_name, operations, chain_config, db_factory))
+
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+
+        errors = []
+        for chain_name, result in zip(chain_names, results):
+            if isinstance(result, BaseException):
+                if len(errors) > 0:
+                    # the first error is logged and raised below
+                    logger.error(f"Scraping {chain_name} failed as well: {result}")
+                errors.append(result)
+            else:
+                items.extend(result)
+        if len(errors) > 0:
+            raise errors[0]
     except Exception as e:
         logger.error(f"Uncaught error during scraping: {e}")
         import traceback
         # log traceback
         logger.error(f"Traceback: {traceback.format_exc()}")
         raise e
+    finally:
+        # waits for the background writers to commit everything
+        for db in dbs.values():
+            db.close()
+        close_response_caches()
+        # the record/replay transport of this run must not leak into later runs
+        replay.restore(replay_state)
 
     logger.info(f"Scraped a total of {len(items)} items")
     return items
 
 
-def wipe_cache():
+def wipe_cache(include_responses: bool = False):
     """
-    Wipe the cache folder
+    Wipe the cache folder. The http response cache is kept, since finalized chain data never changes.
+
+    :param include_responses: also wipe the http response cache
+    :type include_responses: bool
     """
     if os.path.exists("data/cache"):
         import shutil
         logger.info("wiping cache folder")
-        shutil.rmtree("data/cache/")
+        if include_responses:
+            close_response_caches()
+            shutil.rmtree("data/cache/")
+        else:
+            for entry in os.scandir("data/cache"):
+                if Path(entry.path) == response_cache_path.parent:
+                    continue
+                if entry.is_dir():
+                    shutil.rmtree(entry.path)
+                else:
+                    os.remove(entry.path)
     else:
         logger.info("cache folder does not exist")
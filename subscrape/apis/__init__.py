@@ -1,3 +1,15 @@
+from . import api_key_pool
+from . import block_windows
 from . import blockscout_wrapper
+from . import http_client
+from . import json_decoder
+from . import mock_explorer
 from . import moonscan_wrapper
+from . import prefetch
+from . import rate_limiter
+from . import replay
+from . import response_cache
+from . import retry_policy
+from . import shared_rate_limiter
+from . import single_flight
 from . import subscan_wrapper
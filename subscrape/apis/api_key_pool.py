@@ -0,0 +1,67 @@
+__author__ = 'Tommi Enenkel @alice_und_bob'
+
+from subscrape.apis.rate_limiter import RateLimiter
+
+
+class ApiKey:
+    """An API key together with the rate limiter that tracks its own budget."""
+
+    def __init__(self, key: str, rate_limiter: RateLimiter):
+        """
+        :param key: the API key. None stands for anonymous access.
+        :type key: str or None
+        :param rate_limiter: the rate limiter for this key
+        :type rate_limiter: RateLimiter
+        """
+        self.key = key
+        self.rate_limiter = rate_limiter
+
+
+class ApiKeyPool:
+    """
+    Spreads requests across several API keys. Each key has its own rate budget, so the throughput of a wrapper
+    scales with the number of keys it owns.
+    """
+
+    def __init__(self, keys: list, max_calls_per_sec: float, rate_limiter_factory: callable = None):
+        """
+        :param keys: the API keys. Pass `[None]` for anonymous access.
+        :type keys: list
+        :param max_calls_per_sec: the rate budget of every single key
+        :type max_calls_per_sec: float
+        :param rate_limiter_factory: optional function that takes a key and returns its rate limiter. Defaults to a
+        `RateLimiter` that is local to this process.
+        :type rate_limiter_factory: callable
+        """
+        if len(keys) == 0:
+            keys = [None]
+        if rate_limiter_factory is None:
+            def rate_limiter_factory(key):
+                return RateLimiter(max_calls_per_sec)
+        self.api_keys = [ApiKey(key, rate_limiter_factory(key)) for key in keys]
+        self._next_index = 0
+
+    def __len__(self):
+        return len(self.api_keys)
+
+    @property
+    def max_calls_per_sec(self) -> float:
+        """
+        The combined rate budget of all keys.
+        """
+        return sum(api_key.rate_limiter.max_calls_per_sec for api_key in self.api_keys)
+
+    async def acquire(self) -> ApiKey:
+        """
+        Picks the least loaded key, i.e. the one that can hand out a token the soonest, and waits for its token.
+        Ties are broken round-robin so that idle keys are used evenly.
+
+        :return: the key to use for the next request
+        :rtype: ApiKey
+        """
+        count = len(self.api_keys)
+        candidates = [self.api_keys[(self._next_index + i) % count] for i in range(count)]
+        api_key = min(candidates, key=lambda k: k.rate_limiter.time_until_available())
+        self._next_index = (self.api_keys.index(api_key) + 1) % count
+        await api_key.rate_limiter.acquire()
+        return api_key
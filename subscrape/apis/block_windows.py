@@ -0,0 +1,92 @@
+__author__ = 'Tommi Enenkel @alice_und_bob'
+
+import asyncio
+import collections
+import logging
+
+# Moonscan and Blockscout return at most this many transactions per `txlist` response.
+TXLIST_MAX_RESULTS = 10000
+
+logger = logging.getLogger(__name__)
+
+
+def split_block_range(start_block: int, end_block: int, windows: int) -> list:
+    """
+    Splits a block range into windows of equal width.
+
+    :param start_block: first block of the range
+    :type start_block: int
+    :param end_block: last block of the range, inclusive
+    :type end_block: int
+    :param windows: the number of windows
+    :type windows: int
+    :return: list of `(start_block, end_block)` tuples in block order
+    :rtype: list
+    """
+    width = (end_block - start_block) // windows + 1
+    return [(start, min(start + width - 1, end_block)) for start in range(start_block, end_block + 1, width)]
+
+
+async def _fetch_window(fetch_window, start_block: int, end_block: int, max_results: int) -> list:
+    """
+    Fetches all elements of a window. A window that comes back saturated might have been truncated, so it is bisected
+    and both halves are fetched concurrently until every piece fits into a single response.
+    """
+    elements = await fetch_window(start_block, end_block)
+    if len(elements) < max_results:
+        return elements
+    if start_block == end_block:
+        logger.warning(f"Block {start_block} alone has {len(elements)} or more elements. Some might be missing.")
+        return elements
+    middle = (start_block + end_block) // 2
+    logger.debug(f"Window {start_block}-{end_block} is saturated. Bisecting at block {middle}.")
+    lower, upper = await asyncio.gather(
+        _fetch_window(fetch_window, start_block, middle, max_results),
+        _fetch_window(fetch_window, middle + 1, end_block, max_results),
+    )
+    return lower + upper
+
+
+async def process_block_windows(fetch_window, start_block: int, end_block: int, windows: int, element_processor,
+                                tx_filter=None, max_results: int = TXLIST_MAX_RESULTS, lookahead: int = None):
+    """
+    Scans a block range in concurrent windows and hands the elements to the `element_processor` in block order.
+    Windows that finish early are held in a reorder buffer until all windows before them have been processed.
+
+    :param fetch_window: async function that takes the first and last block of a window and returns its elements in
+    block order
+    :type fetch_window: function
+    :param start_block: first block to scan
+    :type start_block: int
+    :param end_block: last block to scan, inclusive
+    :type end_block: int
+    :param windows: the number of windows to split the range into
+    :type windows: int
+    :param element_processor: async method to process each element
+    :type element_processor: function
+    :param tx_filter: method that returns True if certain elements should be filtered out of the results
+    :type tx_filter: function
+    :param max_results: the number of elements at which a response is considered saturated
+    :type max_results: int
+    :param lookahead: how many windows may be in flight or buffered at the same time. Defaults to all of them.
+    :type lookahead: int
+    """
+    ranges = collections.deque(split_block_range(start_block, end_block, windows))
+    if lookahead is None:
+        lookahead = len(ranges)
+    logger.info(f"Scanning blocks {start_block}-{end_block} in {len(ranges)} windows.")
+
+    pending = collections.deque()
+    try:
+        while ranges or pending:
+            while ranges and len(pending) < lookahead:
+                window_start, window_end = ranges.popleft()
+                pending.append(asyncio.create_task(_fetch_window(fetch_window, window_start, window_end, max_results)))
+            elements = await pending.popleft()
+            for element in elements:
+                if tx_filter is not None and tx_filter(element):
+                    continue
+                await element_processor(element)
+    finally:
+        for task in pending:
+            task.cancel()
@@ -1,61 +1,145 @@
 __author__ = 'spazcoin@gmail.com @spazvt'
 __author__ = 'Tommi Enenkel @alice_und_bob'
 
-import asyncio
 from datetime import datetime
 import httpx
-import json
 import logging
+from subscrape.apis.block_windows import process_block_windows, TXLIST_MAX_RESULTS
+from subscrape.apis.http_client import create_async_client
+from subscrape.apis import json_decoder
+from subscrape.apis.prefetch import Prefetcher, DEFAULT_PAGE_LOOKAHEAD
+from subscrape.apis.rate_limiter import RateLimiter
+from subscrape.apis.retry_policy import ExplorerError, RetryPolicy, retry_after
+from subscrape.apis.response_cache import ResponseCache, NEVER_EXPIRES, LIST_PAGE_TTL, UNAVAILABLE_TTL
+from subscrape.apis.shared_rate_limiter import SharedRateLimiter
+
+# No API limit stated on Blockscout website, so choose conservative 5 calls/sec
+BLOCKSCOUT_MAX_CALLS_PER_SEC = 5
+# the answer of `getToken` for an address that is not a token contract. Any other error is not conclusive.
+TOKEN_NOT_FOUND_MESSAGE = "contract address not found"
+# the answer of `getabi` for a contract without verified source code. Any other error is not conclusive.
+ABI_NOT_VERIFIED_MESSAGE = "Contract source code not verified"
+
+
+def _abi_ttl(response_json):
+    """Verified ABIs never change. Contracts without a verified ABI might still get verified later. Other errors are
+    not cached."""
+    if response_json.get('status') == "1":
+        return NEVER_EXPIRES
+    if response_json.get('message') == ABI_NOT_VERIFIED_MESSAGE:
+        return UNAVAILABLE_TTL
+    return None
+
+
+def _token_ttl(response_json):
+    """Token basics never change. Addresses that aren't tokens might change later. Other errors are not cached."""
+    if response_json.get('status') == "1":
+        return NEVER_EXPIRES
+    if response_json.get('message') == TOKEN_NOT_FOUND_MESSAGE:
+        return UNAVAILABLE_TTL
+    return None
+
+
+def _tx_info_ttl(response_json):
+    """Infos of mined transactions never change. A transaction that is not found might still be pending."""
+    return NEVER_EXPIRES if response_json.get('status') == "1" else None
 
 
 class BlockscoutWrapper:
     """Interface for interacting with the API of the Blockscout explorer for the Moonriver and Moonbeam chains."""
-    def __init__(self, chain):
+    def __init__(self, chain, http_limits: httpx.Limits = None, shared_rate_limit_dir=None,
+                 response_cache: ResponseCache = None):
+        """
+        :param chain: name of the specific EVM chain
+        :type chain: str
+        :param http_limits: connection pool limits of the shared http client. Use None for the defaults.
+        :type http_limits: httpx.Limits or None
+        :param shared_rate_limit_dir: if set, the rate budget is coordinated with other processes through a state file
+        in this folder. Use None to keep the budget local to this process.
+        :type shared_rate_limit_dir: Path or None
+        :param response_cache: persistent cache for the responses. Use None to always query the API.
+        :type response_cache: ResponseCache or None
+        """
         self.logger = logging.getLogger(__name__)
         self.endpoint = f"https://blockscout.{chain}.moonbeam.network/api"
-        # No API limit stated on Blockscout website, so choose conservative 5 calls/sec
-        self.semaphore = asyncio.Semaphore(5)
-        self.lock = asyncio.Lock()
+        if shared_rate_limit_dir is None:
+            self.rate_limiter = RateLimiter(BLOCKSCOUT_MAX_CALLS_PER_SEC)
+        else:
+            self.rate_limiter = SharedRateLimiter(BLOCKSCOUT_MAX_CALLS_PER_SEC, shared_rate_limit_dir, self.endpoint)
+        self._http_limits = http_limits
+        self._client = None
+        self.response_cache = response_cache
+        self.txlist_max_results = TXLIST_MAX_RESULTS
+        self.page_lookahead = DEFAULT_PAGE_LOOKAHEAD
+        self.retry_policy = RetryPolicy(self.endpoint)
 
-    async def __query(self, params, client=None):
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """The pooled http client that is shared by all requests of this wrapper. It is created on first use."""
+        if self._client is None or self._client.is_closed:
+            self._client = create_async_client(self._http_limits)
+        return self._client
+
+    async def close(self):
+        """Closes the shared http client and all of its pooled connections."""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def __query(self, params, client=None, cache_ttl=None):
         """Rate limited call to fetch another page of data from the Blockscout block explorer website
 
         :param params: Blockscout API call params that filter which transactions are returned.
         :type params:
-        :param client: client to use for sending http requests for blockchain data. If None, defaults to `httpx`.
+        :param client: client to use for sending http requests for blockchain data. If None, defaults to the shared
+        pooled client of this wrapper.
         :type client: object
+        :param cache_ttl: seconds to keep the response in the response cache, or a function that deduces them from
+        the response. None if the response should not be cached.
+        :type cache_ttl: float or function or None
         :returns: JSON structure of response text
         :rtype: dict
         """
         if client is None:
-            client = httpx.AsyncClient()
+            client = self.client
+
+        cache_key = None
+        if self.response_cache is not None and cache_ttl is not None:
+            cache_key = ResponseCache.make_key(self.endpoint, params.get("action"), params)
+            content = self.response_cache.get(cache_key)
+            if content is not None:
+                return json_decoder.loads(content)
 
-        response = None
-        should_request = True
-        while should_request:  # loop until we get a response
+        async def send_request(timeout):
+            await self.rate_limiter.acquire()
+            generation = self.rate_limiter.generation
             before = datetime.now()
-            async with self.semaphore:
-                response = await client.get(self.endpoint, params=params, timeout=30.0)
+            response = await client.get(self.endpoint, params=params, timeout=timeout)
             after = datetime.now()
             self.logger.debug("request took: " + str(after - before))
 
-            # lock to prevent multiple threads from trying to sleep at the same time
-            await self.lock.acquire()
-            try:
-                if response.status_code == 429:
-                    self.logger.warning("API rate limit exceeded. Waiting 1 second and retrying...")
-                    await asyncio.sleep(1)
-                elif response.status_code != 200:
-                    self.logger.info(f"Status Code: {response.status_code}")
-                    self.logger.info(response)
-                    raise Exception(f"Error: {response.status_code}")
-                else:
-                    should_request = False
-            finally:
-                self.lock.release()
+            if response.status_code == 429:
+                self.rate_limiter.on_rate_limited(pause=retry_after(response), generation=generation)
+            elif response.status_code == 200:
+                self.rate_limiter.on_success()
+            return response
+
+        response = await self.retry_policy.send(send_request)
 
         self.logger.debug(response)
-        response_json = json.loads(response.text)
+        response_json = json_decoder.loads(response.content)
+
+        if cache_key is not None:
+            ttl = cache_ttl(response_json) if callable(cache_ttl) else cache_ttl
+            if ttl is not None:
+                self.response_cache.set(cache_key, response.content, ttl)
+
         return response_json
 
     async def __iterate_pages(self, element_processor, params={}, tx_filter=None):
@@ -68,41 +152,101 @@ class BlockscoutWrapper:
         :param tx_filter: method that returns True if certain transactions should be filtered out of the results
         :type tx_filter: function
         """
-        done = False             # keep crunching until we are done
-        previous_block = 0       # to check if the iterator actually moved forward
-        last_block_received = 0  # to compare most recent block to end block requested
         count = 0                # counter for how many items we queried already
+        params = dict(params)
         if 'startblock' in params:
             start_block = int(params['startblock'])
         else:
             start_block = 0
+        end_block = int(params["endblock"])
+
+        async def pages():
+            # the next page starts at the block of the last element, so pages can be fetched ahead
+            next_block = start_block
+            previous_block = 0   # to check if the iterator actually moved forward
+            while True:
+                params["startblock"] = str(next_block)
+                response_obj = await self.__query(params, cache_ttl=LIST_PAGE_TTL)
+                yield response_obj
+                if response_obj["status"] == "0":
+                    return
+                next_block = int(response_obj["result"][-1]["blockNumber"])
+                if next_block == previous_block or next_block == end_block:
+                    return
+                previous_block = next_block
 
-        while not done:
-            params["startblock"] = str(start_block)
-            response_obj = self.__query(params)
+        async with Prefetcher(pages(), self.page_lookahead) as prefetched:
+            async for response_obj in prefetched:
+                if response_obj["status"] == "0":
+                    self.logger.info("received empty result")
+                    return
 
-            if response_obj["status"] == "0":
-                self.logger.info("received empty result")
-                return
+                elements = response_obj["result"]
 
-            elements = response_obj["result"]
+                # process the elements
+                for element in elements:
+                    if tx_filter is not None and tx_filter(element):
+                        continue
+                    await element_processor(element)
 
-            # process the elements
-            for element in elements:
-                last_block_received = int(element['blockNumber'])
-                if tx_filter is not None and tx_filter(element):
-                    continue
-                await element_processor(element)
+                count += len(elements)
+                self.logger.info(count)
 
-            # update counters and check if we should exit
-            count += len(elements)
-            self.logger.info(count)
+    async def __fetch_window(self, params, start_block, end_block):
+        """Fetches all transactions of a block window in a single response.
 
-            start_block = int(element["blockNumber"])
-            end_block = int(params["endblock"])
-            if start_block == previous_block or last_block_received == end_block:
-                done = True
-            previous_block = start_block
+        :param params: Blockscout API call params that filter which transactions are returned.
+        :type params: dict
+        :param start_block: first block of the window
+        :type start_block: int
+        :param end_block: last block of the window, inclusive
+        :type end_block: int
+        :returns: the transactions in block order. Saturated windows are bisected by the caller.
+        :rtype: list
+        """
+        params = dict(params)
+        params["startblock"] = str(start_block)
+        params["endblock"] = str(end_block)
+        response_obj = await self.__query(params, cache_ttl=LIST_PAGE_TTL)
+        if response_obj["status"] == "0":
+            self.logger.debug(f"received empty result for blocks {start_block}-{end_block}."
+                              f" message='{response_obj['message']}'")
+            return []
+        return response_obj["result"]
+
+    async def __iterate_windows(self, element_processor, windows, params, tx_filter=None):
+        """Fetch transactions from Blockscout in concurrent block windows. Saturated windows are bisected adaptively and
+        the transactions reach the `element_processor` in block order.
+
+        :param element_processor: method to process each transaction as it is received
+        :type element_processor: function
+        :param windows: the number of block windows to fetch concurrently
+        :type windows: int
+        :param params: Blockscout API call params that filter which transactions are returned.
+        :type params: dict
+        :param tx_filter: method that returns True if certain transactions should be filtered out of the results
+        :type tx_filter: function
+        """
+        start_block = int(params["startblock"])
+        end_block = min(int(params["endblock"]), await self.get_latest_block_number())
+        if end_block < start_block:
+            return
+
+        async def fetch_window(window_start, window_end):
+            return await self.__fetch_window(params, window_start, window_end)
+
+        await process_block_windows(fetch_window, start_block, end_block, windows, element_processor,
+                                    tx_filter=tx_filter, max_results=self.txlist_max_results)
+
+    async def get_latest_block_number(self):
+        """Get the number of the latest block of the chain.
+
+        :returns: the block number
+        :rtype: int
+        """
+        params = {"module": "block", "action": "eth_block_number"}
+        response_dict = await self.__query(params)
+        return int(response_dict['result'], 16)
 
     async def fetch_and_process_transactions(self, address, element_processor, config=None):
         """Fetch all transactions for a given address (account/contract) and use the given processor method to filter
@@ -120,7 +264,9 @@ class BlockscoutWrapper:
         """
         params = {"module": "account", "action": "txlist", "address": address, "startblock": "1",
                   "endblock": "99999999", "sort": "asc"}
-        if config and hasattr(config, 'filter'):
+        if config and config.shards > 1:
+            await self.__iterate_windows(element_processor, config.shards, params, tx_filter=config.filter)
+        elif config and hasattr(config, 'filter'):
             await self.__iterate_pages(element_processor, params=params, tx_filter=config.filter)
         else:
             await self.__iterate_pages(element_processor, params=params)
@@ -134,7 +280,7 @@ class BlockscoutWrapper:
         :rtype: str or None
         """
         params = {"module": "contract", "action": "getabi", "address": contract_address}
-        response_dict = await self.__query(params)
+        response_dict = await self.__query(params, cache_ttl=_abi_ttl)
         if response_dict['status'] == "0" or response_dict['message'] == "NOTOK":
             self.logger.info(f'ABI not retrievable for {contract_address} because "{response_dict["result"]}"')
             return None
@@ -153,7 +299,7 @@ class BlockscoutWrapper:
         :rtype: dict or None
         """
         params = {"module": "transaction", "action": "gettxinfo", "txhash": tx_hash}
-        response_dict = await self.__query(params)
+        response_dict = await self.__query(params, cache_ttl=_tx_info_ttl)
         # response_dict['logs'] should contain a long string representation of the tx receipt.
         # return response_dict['logs']
         if response_dict['status'] == "0" or response_dict['message'] == "NOTOK":
@@ -171,12 +317,16 @@ class BlockscoutWrapper:
         :type token_address: str
         :param verbose: should the "not retrievable" message be printed out?
         :type verbose: bool
-        :returns: dictionary of values about the token, or None if not retrievable
+        :returns: dictionary of values about the token, or None if the contract is not a token
         :rtype: dict or None
+        :raises ExplorerError: if Blockscout failed to answer, so it is unknown whether the contract is a token
         """
         params = {"module": "token", "action": "getToken", "contractaddress": token_address}
-        response_dict = await self.__query(params)
+        response_dict = await self.__query(params, cache_ttl=_token_ttl)
         if response_dict['status'] == "0" or response_dict['message'] == "NOTOK":
+            if response_dict['message'] != TOKEN_NOT_FOUND_MESSAGE:
+                raise ExplorerError(f'Token info not retrievable for {token_address} because'
+                                    f' "{response_dict["message"]}: {response_dict["result"]}"')
             if verbose:
                 self.logger.info(f'Token info not retrievable for {token_address} because "{response_dict["result"]}"')
             return None
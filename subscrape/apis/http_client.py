@@ -0,0 +1,78 @@
+__author__ = 'Tommi Enenkel @alice_und_bob'
+
+import httpx
+
+# Defaults for the connection pool that every explorer wrapper keeps open for its whole lifetime.
+DEFAULT_MAX_CONNECTIONS = 20
+DEFAULT_MAX_KEEPALIVE_CONNECTIONS = 10
+DEFAULT_KEEPALIVE_EXPIRY = 30.0     # seconds an idle connection is kept alive
+DEFAULT_TIMEOUT = 30.0              # seconds
+
+# Optional function that takes the limits and the http2 flag and returns the transport for new clients.
+# Used to route all explorer traffic through the record/replay transports.
+_transport_factory = None
+
+
+def set_transport_factory(transport_factory: callable):
+    """
+    Routes every client created by `create_async_client` from now on through a custom transport.
+
+    :param transport_factory: function that takes the `httpx.Limits` and the http2 flag and returns an
+    `httpx.AsyncBaseTransport`. Use None to go back to the default transport.
+    :type transport_factory: callable
+    """
+    global _transport_factory
+    _transport_factory = transport_factory
+
+
+def get_transport_factory() -> callable:
+    """
+    :return: the function that creates the transport for new clients, or None if they use the default transport
+    :rtype: callable
+    """
+    return _transport_factory
+
+
+def create_limits(max_connections: int = DEFAULT_MAX_CONNECTIONS,
+                  max_keepalive_connections: int = DEFAULT_MAX_KEEPALIVE_CONNECTIONS,
+                  keepalive_expiry: float = DEFAULT_KEEPALIVE_EXPIRY) -> httpx.Limits:
+    """
+    Creates the connection pool limits for an explorer client.
+
+    :param max_connections: maximum number of concurrent connections
+    :type max_connections: int
+    :param max_keepalive_connections: maximum number of idle connections kept in the pool
+    :type max_keepalive_connections: int
+    :param keepalive_expiry: seconds after which an idle connection is closed
+    :type keepalive_expiry: float
+    :return: the limits
+    :rtype: httpx.Limits
+    """
+    return httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=max_keepalive_connections,
+        keepalive_expiry=keepalive_expiry,
+    )
+
+
+def create_async_client(limits: httpx.Limits = None, timeout: float = DEFAULT_TIMEOUT,
+                        http2: bool = True) -> httpx.AsyncClient:
+    """
+    Creates a pooled `httpx.AsyncClient` that is meant to be shared by all requests of one explorer wrapper.
+    With HTTP/2 enabled, concurrent requests against the same host are multiplexed over a single connection, so
+    the TCP and TLS handshakes are only paid once.
+
+    :param limits: connection pool limits. If None, the module defaults are used.
+    :type limits: httpx.Limits
+    :param timeout: default timeout in seconds for every request
+    :type timeout: float
+    :param http2: whether to negotiate HTTP/2
+    :type http2: bool
+    :return: the client
+    :rtype: httpx.AsyncClient
+    """
+    if limits is None:
+        limits = create_limits()
+    if _transport_factory is not None:
+        return httpx.AsyncClient(transport=_transport_factory(limits, http2), timeout=timeout)
+    return httpx.AsyncClient(http2=http2, limits=limits, timeout=timeout)
@@ -0,0 +1,32 @@
+__author__ = 'Tommi Enenkel @alice_und_bob'
+
+import json
+
+# orjson parses straight from the raw response bytes and is several times faster than the standard library. It is
+# used if available; platforms without a wheel fall back to `json`.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def is_fast() -> bool:
+    """
+    :return: whether the fast decoder is available
+    :rtype: bool
+    """
+    return orjson is not None
+
+
+def loads(content):
+    """
+    Decodes a JSON document from the raw bytes of a response, without building an intermediate `str`.
+
+    :param content: the raw response body
+    :type content: bytes or str
+    :return: the decoded document
+    :rtype: dict or list
+    """
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
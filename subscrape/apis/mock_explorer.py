@@ -0,0 +1,329 @@
+__author__ = 'Tommi Enenkel @alice_und_bob'
+
+import asyncio
+import collections
+import json
+import logging
+import random
+import time
+import zlib
+import httpx
+from subscrape.apis import http_client
+
+# A minimal ERC-20 ABI, so that synthetic transfers can be decoded like real contract interactions.
+ERC20_ABI = json.dumps([
+    {"type": "function", "name": "transfer", "stateMutability": "nonpayable",
+     "inputs": [{"name": "to", "type": "address"}, {"name": "value", "type": "uint256"}],
+     "outputs": [{"name": "", "type": "bool"}]},
+    {"type": "event", "name": "Transfer", "anonymous": False,
+     "inputs": [{"name": "from", "type": "address", "indexed": True},
+                {"name": "to", "type": "address", "indexed": True},
+                {"name": "value", "type": "uint256", "indexed": False}]},
+])
+TRANSFER_METHOD_ID = "0xa9059cbb"
+TRANSFER_EVENT_TOPIC = "0xddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef"
+BLOCK_TIME = 12                 # seconds between synthetic blocks
+GENESIS_TIMESTAMP = 1600000000  # timestamp of the first synthetic block
+
+
+class MockExplorer:
+    """
+    Local stand-in for Subscan, Moonscan and Blockscout that generates synthetic chain data on the fly. It serves the
+    endpoints used by the API wrappers through an `httpx.MockTransport`, so the whole scraping pipeline can be
+    load-tested at millions of items without touching the real explorers.
+
+    Items are derived arithmetically from their index instead of being stored, so the size of the synthetic chain
+    does not cost memory.
+    """
+
+    def __init__(self, num_items: int = 10000, items_per_block: int = 4, first_block: int = 1,
+                 latency: float = 0.0, max_calls_per_sec: float = None, rate_limit_probability: float = 0.0,
+                 subscan_max_rows: int = 100, txlist_page_size: int = 10000, seed: int = 0):
+        """
+        :param num_items: number of extrinsics, events and account transactions the synthetic chain contains
+        :type num_items: int
+        :param items_per_block: how many items share a block
+        :type items_per_block: int
+        :param first_block: block number of the first item
+        :type first_block: int
+        :param latency: simulated seconds of latency per request
+        :type latency: float
+        :param max_calls_per_sec: if set, requests beyond this rate are answered with status 429
+        :type max_calls_per_sec: float
+        :param rate_limit_probability: probability that any request is answered with status 429
+        :type rate_limit_probability: float
+        :param subscan_max_rows: maximum page size of the Subscan list endpoints
+        :type subscan_max_rows: int
+        :param txlist_page_size: maximum number of results of a Moonscan/Blockscout `txlist` response
+        :type txlist_page_size: int
+        :param seed: seed for the random 429 injection
+        :type seed: int
+        """
+        self.logger = logging.getLogger(__name__)
+        self.num_items = num_items
+        self.items_per_block = items_per_block
+        self.first_block = first_block
+        self.latency = latency
+        self.max_calls_per_sec = max_calls_per_sec
+        self.rate_limit_probability = rate_limit_probability
+        self.subscan_max_rows = subscan_max_rows
+        self.txlist_page_size = txlist_page_size
+        self._random = random.Random(seed)
+        self._recent_calls = collections.deque()
+        self.request_counts = collections.Counter()     # requests served per path or action
+
+    @property
+    def head_block(self) -> int:
+        """The number of the last block of the synthetic chain."""
+        return self._block_of(self.num_items - 1)
+
+    def _block_of(self, index: int) -> int:
+        return self.first_block + index // self.items_per_block
+
+    def _timestamp_of(self, block: int) -> int:
+        return GENESIS_TIMESTAMP + block * BLOCK_TIME
+
+    def _index_range(self, start_block: int, end_block: int) -> range:
+        """
+        :return: the indexes of the items within the given blocks
+        :rtype: range
+        """
+        low = max(0, (start_block - self.first_block) * self.items_per_block)
+        high = min(self.num_items, (end_block - self.first_block + 1) * self.items_per_block)
+        return range(low, max(low, high))
+
+    def transport(self) -> httpx.MockTransport:
+        """
+        :return: a transport that answers all requests of the API wrappers
+        :rtype: httpx.MockTransport
+        """
+        return httpx.MockTransport(self.handle_request)
+
+    def install(self):
+        """
+        Routes all explorer wrappers created from now on to this mock explorer.
+        """
+        http_client.set_transport_factory(lambda limits, http2: self.transport())
+
+    def uninstall(self):
+        """
+        Routes all explorer wrappers created from now on to the network again.
+        """
+        http_client.set_transport_factory(None)
+
+    def _is_rate_limited(self) -> bool:
+        if self.rate_limit_probability > 0 and self._random.random() < self.rate_limit_probability:
+            return True
+        if self.max_calls_per_sec is None:
+            return False
+        now = time.monotonic()
+        while self._recent_calls and self._recent_calls[0] < now - 1:
+            self._recent_calls.popleft()
+        if len(self._recent_calls) >= self.max_calls_per_sec:
+            return True
+        self._recent_calls.append(now)
+        return False
+
+    async def handle_request(self, request: httpx.Request) -> httpx.Response:
+        """
+        Answers a request like the real explorer would.
+
+        :param request: the request sent by an API wrapper
+        :type request: httpx.Request
+        :return: the response
+        :rtype: httpx.Response
+        """
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+        if self._is_rate_limited():
+            return httpx.Response(429, request=request)
+
+        if request.url.host.endswith("subscan.io"):
+            self.request_counts[request.url.path] += 1
+            body = json.loads(request.content) if request.content else {}
+            data = self._handle_subscan(request.url.path, body)
+            if data is None:
+                return httpx.Response(404, json={"code": 404, "message": "Not Found"}, request=request)
+            return httpx.Response(200, json={"code": 0, "message": "Success", "data": data}, request=request)
+        else:
+            params = request.url.params
+            self.request_counts[params.get("action")] += 1
+            return httpx.Response(200, json=self._handle_etherscan(params), request=request)
+
+    # Subscan
+
+    def _handle_subscan(self, path: str, body: dict):
+        if path == "/api/v2/scan/extrinsics":
+            return self._subscan_list(body, "extrinsics", self._subscan_extrinsic_metadata)
+        elif path == "/api/v2/scan/events":
+            return self._subscan_list(body, "events", self._subscan_event_metadata)
+        elif path == "/api/scan/extrinsic":
+            block, idx = [int(part) for part in body["extrinsic_index"].split("-")]
+            return self._subscan_extrinsic(block, idx, body)
+        elif path == "/api/scan/event":
+            block, idx = [int(part) for part in body["event_index"].split("-")]
+            return self._subscan_event(block, idx, body)
+        return None
+
+    def _subscan_list(self, body: dict, list_key: str, element_factory) -> dict:
+        """
+        Pages through the synthetic items newest first, like the Subscan v2 list endpoints do with `after_id`.
+        """
+        rows = min(int(body.get("row", 10)), self.subscan_max_rows)
+        start_block, end_block = self.first_block, self.head_block
+        if "block_range" in body:
+            start_block, end_block = [int(part) for part in body["block_range"].split("-")]
+        indexes = self._index_range(start_block, end_block)
+        count = len(indexes)
+        high = indexes.stop
+        if "after_id" in body:
+            # the id of an item is its index + 1
+            high = min(high, int(body["after_id"]) - 1)
+        low = max(indexes.start, high - rows)
+        elements = [element_factory(index, body) for index in range(high - 1, low - 1, -1)]
+        return {"count": count, list_key: elements}
+
+    def _address_of(self, index: int) -> str:
+        # a fixed, valid Kusama address keeps the synthetic data decodable by `ss58_decode`
+        return "HNZata7iMYWmk5RvZRTiAsSDhV8366zq2YGb3tLH5Upf74F"
+
+    def _idx_of(self, index: int, body: dict) -> int:
+        """
+        The position of an item within its block. Every module/call filter gets its own slots, so that the synthetic
+        items of different filters do not share their indexes, just like on a real chain.
+        """
+        filter_key = f"{body.get('module')}.{body.get('call') or body.get('event_id')}"
+        return (zlib.crc32(filter_key.encode("UTF-8")) % 1000) * self.items_per_block + index % self.items_per_block
+
+    def _subscan_extrinsic_metadata(self, index: int, body: dict) -> dict:
+        block = self._block_of(index)
+        idx = self._idx_of(index, body)
+        return {
+            "id": index + 1,
+            "block_num": block,
+            "block_timestamp": self._timestamp_of(block),
+            "extrinsic_index": f"{block}-{idx}",
+            "call_module_function": body.get("call") or "remark",
+            "call_module": body.get("module") or "system",
+            "nonce": index,
+            "extrinsic_hash": f"0x{index:064x}",
+            "success": True,
+            "fee": "1000",
+            "fee_used": "1000",
+            "finalized": True,
+            "account_display": {"address": self._address_of(index)},
+        }
+
+    def _subscan_event_metadata(self, index: int, body: dict) -> dict:
+        block = self._block_of(index)
+        idx = self._idx_of(index, body)
+        return {
+            "id": index + 1,
+            "block_num": block,
+            "block_timestamp": self._timestamp_of(block),
+            "event_index": f"{block}-{idx}",
+            "extrinsic_index": f"{block}-{idx}",
+            "phase": 0,
+            "module_id": body.get("module") or "system",
+            "event_id": body.get("event_id") or "remarked",
+            "extrinsic_hash": f"0x{index:064x}",
+            "finalized": True,
+        }
+
+    def _subscan_extrinsic(self, block: int, idx: int, body: dict) -> dict:
+        index = (block - self.first_block) * self.items_per_block + idx % self.items_per_block
+        extrinsic = self._subscan_extrinsic_metadata(index, body)
+        extrinsic.update({
+            "extrinsic_index": f"{block}-{idx}",    # the slot of the requested item, whatever its filter
+            "params": [{"name": "remark", "type": "Bytes", "value": f"0x{index:08x}"}],
+            "error": None,
+            "tip": "0",
+        })
+        return extrinsic
+
+    def _subscan_event(self, block: int, idx: int, body: dict) -> dict:
+        return {
+            "block_num": block,
+            "event_idx": idx,
+            "extrinsic_idx": idx,
+            "module_id": "system",
+            "event_id": "remarked",
+            "params": [{"type_name": "Hash", "value": f"0x{block:064x}"}],
+            "finalized": True,
+        }
+
+    # Moonscan and Blockscout
+
+    def _handle_etherscan(self, params) -> dict:
+        action = params.get("action")
+        if action == "txlist":
+            return self._txlist(params)
+        elif action == "getabi":
+            return {"status": "1", "message": "OK", "result": ERC20_ABI}
+        elif action == "eth_getTransactionReceipt":
+            return {"jsonrpc": "2.0", "id": 1, "result": self._receipt(int(params["txhash"], 16))}
+        elif action == "eth_blockNumber" or action == "eth_block_number":
+            return {"jsonrpc": "2.0", "id": 1, "result": hex(self.head_block)}
+        elif action == "getToken":
+            address = params["contractaddress"].lower()
+            return {"status": "1", "message": "OK",
+                    "result": {"contractAddress": address, "name": f"Token {address[-4:]}",
+                               "symbol": f"T{address[-4:].upper()}", "decimals": "18", "type": "ERC-20"}}
+        elif action == "gettxinfo":
+            index = int(params["txhash"], 16)
+            receipt = self._receipt(index)
+            return {"status": "1", "message": "OK",
+                    "result": {"hash": receipt["transactionHash"], "blockNumber": str(self._block_of(index)),
+                               "logs": receipt["logs"], "success": True}}
+        return {"status": "0", "message": "NOTOK", "result": f"Unknown action {action}"}
+
+    def _transaction(self, index: int, address: str) -> dict:
+        block = self._block_of(index)
+        recipient = f"0x{index:040x}"
+        return {
+            "blockNumber": str(block),
+            "timeStamp": str(self._timestamp_of(block)),
+            "hash": f"0x{index:064x}",
+            "nonce": str(index),
+            "from": address,
+            "to": self._token_address(index),
+            "value": "0",
+            "gas": "60000",
+            "gasPrice": "1000000000",
+            "isError": "0",
+            "input": f"{TRANSFER_METHOD_ID}{recipient[2:]:0>64}{index + 1:064x}",
+            "gasUsed": "50000",
+        }
+
+    def _token_address(self, index: int) -> str:
+        # a handful of token contracts, so that ABI and token lookups repeat like on a real chain
+        return f"0x{0xa0 + index % 8:040x}"
+
+    def _txlist(self, params) -> dict:
+        start_block = int(params.get("startblock", 0))
+        end_block = int(params.get("endblock", 99999999))
+        indexes = self._index_range(start_block, end_block)
+        page = indexes[:self.txlist_page_size]
+        if len(page) == 0:
+            return {"status": "0", "message": "No transactions found", "result": []}
+        address = params.get("address", "0x0").lower()
+        return {"status": "1", "message": "OK", "result": [self._transaction(index, address) for index in page]}
+
+    def _receipt(self, index: int) -> dict:
+        if index >= self.num_items:
+            return None
+        block = self._block_of(index)
+        recipient = f"0x{index:040x}"
+        return {
+            "blockNumber": hex(block),
+            "transactionHash": f"0x{index:064x}",
+            "status": "0x1",
+            "logs": [{
+                "address": self._token_address(index),
+                "topics": [TRANSFER_EVENT_TOPIC, f"0x{0:064x}", f"0x{recipient[2:]:0>64}"],
+                "data": f"0x{index + 1:064x}",
+                "blockNumber": hex(block),
+                "transactionHash": f"0x{index:064x}",
+                "logIndex": "0x0",
+            }],
+        }
@@ -1,12 +1,17 @@
 __author__ = 'spazcoin@gmail.com @spazvt'
 __author__ = 'Tommi Enenkel @alice_und_bob'
 
-import asyncio
-import math
 from datetime import datetime
 import httpx
-import json
 import logging
+from subscrape.apis.block_windows import process_block_windows, TXLIST_MAX_RESULTS
+from subscrape.apis.http_client import create_async_client
+from subscrape.apis import json_decoder
+from subscrape.apis.prefetch import Prefetcher, DEFAULT_PAGE_LOOKAHEAD
+from subscrape.apis.api_key_pool import ApiKeyPool
+from subscrape.apis.retry_policy import RetryPolicy, retry_after
+from subscrape.apis.response_cache import ResponseCache, NEVER_EXPIRES, LIST_PAGE_TTL, UNAVAILABLE_TTL
+from subscrape.apis.shared_rate_limiter import SharedRateLimiter
 import time
 
 # "Powered by https://moonbeam.moonscan.io APIs"
@@ -16,89 +21,167 @@ MOONSCAN_MAX_CALLS_PER_SEC_WITHOUT_API_KEY = 0.195  # Empirically determined. Ab
 MOONSCAN_MAX_CALLS_PER_SEC_WITH_AN_API_KEY = 5      # "5 calls per sec/IP"
 
 
+# the answer of `getabi` for a contract without verified source code. Any other error is not conclusive.
+ABI_NOT_VERIFIED_MESSAGE = "Contract source code not verified"
+
+
+def _abi_ttl(response_json):
+    """Verified ABIs never change. Contracts without a verified ABI might still get verified later. Other errors are
+    not cached."""
+    if response_json.get('status') == "1":
+        return NEVER_EXPIRES
+    if response_json.get('result') == ABI_NOT_VERIFIED_MESSAGE:
+        return UNAVAILABLE_TTL
+    return None
+
+
+def _receipt_ttl(response_json):
+    """Receipts of mined transactions are immutable. A receipt without block is still pending."""
+    result = response_json.get('result')
+    if type(result) is dict and result.get('blockNumber') is not None:
+        return NEVER_EXPIRES
+    return None
+
+
+def _is_rate_limited(response):
+    """Moonscan reports exceeded rate limits of anonymous access with status 200 and a message in the result."""
+    # a cheap scan of the raw bytes, so that regular responses are only decoded once
+    if b"Max rate limit reached" not in response.content:
+        return False
+    response_json = json_decoder.loads(response.content)
+    return response_json.get('result') == "Max rate limit reached, please use API Key for higher rate limit"
+
+
 class MoonscanWrapper:
     """Interface for interacting with the API of explorer Moonscan.io for the Moonriver and Moonbeam chains."""
-    def __init__(self, chain, api_key=None):
+    def __init__(self, chain, api_key=None, http_limits: httpx.Limits = None, shared_rate_limit_dir=None,
+                 response_cache: ResponseCache = None):
+        """
+        :param chain: name of the specific EVM chain
+        :type chain: str
+        :param api_key: the API key to use, or a list of API keys to spread the requests across. Every key has its own
+        rate budget. Use None, if no API key is to be used.
+        :type api_key: str or list or None
+        :param http_limits: connection pool limits of the shared http client. Use None for the defaults.
+        :type http_limits: httpx.Limits or None
+        :param shared_rate_limit_dir: if set, the rate budget of each key is coordinated with other processes through
+        state files in this folder. Use None to keep the budget local to this process.
+        :type shared_rate_limit_dir: Path or None
+        :param response_cache: persistent cache for the responses. Use None to always query the API.
+        :type response_cache: ResponseCache or None
+        """
         self.logger = logging.getLogger(__name__)
         self.endpoint = f"https://api-{chain}.moonscan.io/api"
-        self.api_key = api_key
         if api_key is None:
+            keys = []
             self.max_calls_per_sec = MOONSCAN_MAX_CALLS_PER_SEC_WITHOUT_API_KEY
         else:
+            keys = api_key if type(api_key) is list else [api_key]
             self.max_calls_per_sec = MOONSCAN_MAX_CALLS_PER_SEC_WITH_AN_API_KEY
-        self.min_wait_between_queries = 1 / self.max_calls_per_sec
-        self.logger.info(f'Moonscan.io rate limit set to {self.max_calls_per_sec} API calls per second.'
-                         f' Minimum wait time between queries is {self.min_wait_between_queries:.3f} seconds.')
+        if shared_rate_limit_dir is None:
+            rate_limiter_factory = None
+        else:
+            def rate_limiter_factory(key):
+                name = f"moonscan-{key}" if key is not None else self.endpoint
+                return SharedRateLimiter(self.max_calls_per_sec, shared_rate_limit_dir, name)
+        self.api_keys = ApiKeyPool(keys, self.max_calls_per_sec, rate_limiter_factory)
+        self.min_wait_between_queries = 1 / self.api_keys.max_calls_per_sec
+        self.logger.info(f'Moonscan.io rate limit set to {self.max_calls_per_sec} API calls per second for each of'
+                         f' {len(self.api_keys)} key(s). Minimum wait time between queries is'
+                         f' {self.min_wait_between_queries:.3f} seconds.')
         if api_key is None:
             api_key_sec_between_queries = 1 / MOONSCAN_MAX_CALLS_PER_SEC_WITH_AN_API_KEY
             self.logger.info(f'Moonscan.io rate limit could be {MOONSCAN_MAX_CALLS_PER_SEC_WITH_AN_API_KEY} calls/sec'
                              f' ({api_key_sec_between_queries:.3f} sec between queries) if you had an API key.')
         self.time_of_last_request = 0
-        self.semaphore = asyncio.Semaphore(math.ceil(self.max_calls_per_sec))
-        self.lock = asyncio.Lock()
+        self._http_limits = http_limits
+        self._client = None
+        self.response_cache = response_cache
+        self.txlist_max_results = TXLIST_MAX_RESULTS
+        self.page_lookahead = DEFAULT_PAGE_LOOKAHEAD
+        self.retry_policy = RetryPolicy(self.endpoint)
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """The pooled http client that is shared by all requests of this wrapper. It is created on first use."""
+        if self._client is None or self._client.is_closed:
+            self._client = create_async_client(self._http_limits)
+        return self._client
+
+    async def close(self):
+        """Closes the shared http client and all of its pooled connections."""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def __aenter__(self):
+        return self
 
-    async def __query(self, params, client=None):
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def __query(self, params, client=None, cache_ttl=None):
         """Rate limited call to fetch another page of data from the Moonscan.io block explorer website
 
         :param params: Moonscan.io API call params that filter which transactions are returned.
         :type params:
-        :param client: client to use for sending http requests for blockchain data. If None, defaults to `httpx`.
+        :param client: client to use for sending http requests for blockchain data. If None, defaults to the shared
+        pooled client of this wrapper.
         :type client: object
+        :param cache_ttl: seconds to keep the response in the response cache, or a function that deduces them from
+        the response. None if the response should not be cached.
+        :type cache_ttl: float or function or None
         :returns: JSON structure of response text
         :rtype: dict
         """
         if client is None:
-            client = httpx.AsyncClient()
+            client = self.client
 
-        if self.api_key is not None:
-            params["apikey"] = self.api_key
+        params = dict(params)
+        cache_key = None
+        if self.response_cache is not None and cache_ttl is not None:
+            cache_key = ResponseCache.make_key(self.endpoint, params.get("action"), params)
+            content = self.response_cache.get(cache_key)
+            if content is not None:
+                return json_decoder.loads(content)
 
-        response = None
-        should_request = True
         if self.time_of_last_request == 0:
             self.time_of_last_request = time.time()
-        while should_request:  # loop until we get a response
+
+        async def send_request(timeout):
+            api_key = await self.api_keys.acquire()
+            generation = api_key.rate_limiter.generation
+            request_params = dict(params)
+            if api_key.key is not None:
+                request_params["apikey"] = api_key.key
             time_now = time.time()
             time_since_last_request = time_now - self.time_of_last_request
             self.time_of_last_request = time_now
-            async with self.semaphore:
-                self.logger.debug(f"sending httpx request at {datetime.now().strftime('%H:%M:%S.%f')[:-3]} and"
-                                  f" {time_since_last_request:.3f} sec since the last query. {params=}")
-                response = await client.get(self.endpoint, params=params, timeout=30.0)
-            time_since_last_request = time.time() - self.time_of_last_request
-            self.logger.debug(f"request took: {time_since_last_request:.3} seconds. {self.time_of_last_request=:.3f}")
-
-            # lock to prevent multiple threads from trying to sleep at the same time
-            await self.lock.acquire()
-            try:
-                if response.status_code == 429:
-                    self.logger.warning("API rate limit exceeded. Waiting 1 second and retrying...")
-                    await asyncio.sleep(1)
-                elif response.status_code != 200:
-                    self.logger.info(f"Status Code: {response.status_code}")
-                    self.logger.info(response.headers)
-                    raise Exception(f"Error: {response.status_code}")
-                else:
-                    response_json = json.loads(response.text)
-                    if response_json['result'] == "Max rate limit reached, please use API Key for higher rate limit":
-                        self.logger.warning("API rate limit exceeded. Waiting 30 seconds and retrying...")
-                        await asyncio.sleep(30)
-                    else:
-                        should_request = False
-                        if ('status' in response_json and response_json['status'] == "0") \
-                                or ('message' in response_json and response_json['message'] == "NOTOK"):
-                            self.logger.warning(f'Moonscan API query failed with response "{response_json["result"]}"'
-                                                f' at {datetime.now().strftime("%H:%M:%S.%f")[:-3]} with {params=}')
-                        else:
-                            # We received a normal response.
-                            # Check if we should sleep a little to avoid exceeding the rate limit
-                            if time_since_last_request < self.min_wait_between_queries:
-                                await asyncio.sleep(self.min_wait_between_queries - time_since_last_request)
-            finally:
-                self.lock.release()
+            self.logger.debug(f"sending httpx request at {datetime.now().strftime('%H:%M:%S.%f')[:-3]} and"
+                              f" {time_since_last_request:.3f} sec since the last query. {params=}")
+            response = await client.get(self.endpoint, params=request_params, timeout=timeout)
+            self.logger.debug(f"request took: {time.time() - time_now:.3} seconds.")
+
+            if response.status_code == 429 or (response.status_code == 200 and _is_rate_limited(response)):
+                api_key.rate_limiter.on_rate_limited(pause=retry_after(response), generation=generation)
+            elif response.status_code == 200:
+                api_key.rate_limiter.on_success()
+            return response
+
+        response = await self.retry_policy.send(send_request, is_rate_limited=_is_rate_limited)
+        response_json = json_decoder.loads(response.content)
+        if ('status' in response_json and response_json['status'] == "0") \
+                or ('message' in response_json and response_json['message'] == "NOTOK"):
+            self.logger.warning(f'Moonscan API query failed with response "{response_json["result"]}"'
+                                f' at {datetime.now().strftime("%H:%M:%S.%f")[:-3]} with {params=}')
 
         self.logger.debug(response)
-        response_json = json.loads(response.text)
+
+        if cache_key is not None:
+            ttl = cache_ttl(response_json) if callable(cache_ttl) else cache_ttl
+            if ttl is not None:
+                self.response_cache.set(cache_key, response.content, ttl)
+
         return response_json
 
     async def __iterate_pages(self, element_processor, params={}, tx_filter=None):
@@ -111,42 +194,102 @@ class MoonscanWrapper:
         :param tx_filter: method that returns True if certain transactions should be filtered out of the results
         :type tx_filter: function
         """
-        done = False             # keep crunching until we are done
-        previous_block = 0       # to check if the iterator actually moved forward
-        last_block_received = 0  # to compare most recent block to end block requested
         count = 0                # counter for how many items we queried already
+        params = dict(params)
         if 'startblock' in params:
             start_block = int(params['startblock'])
         else:
             start_block = 0
+        end_block = int(params["endblock"])
+
+        async def pages():
+            # the next page starts at the block of the last element, so pages can be fetched ahead
+            next_block = start_block
+            previous_block = 0   # to check if the iterator actually moved forward
+            while True:
+                params["startblock"] = str(next_block)
+                response_obj = await self.__query(params, cache_ttl=LIST_PAGE_TTL)
+                yield response_obj
+                if response_obj["status"] == "0":
+                    return
+                next_block = int(response_obj["result"][-1]["blockNumber"])
+                if next_block == previous_block or next_block == end_block:
+                    return
+                previous_block = next_block
+
+        async with Prefetcher(pages(), self.page_lookahead) as prefetched:
+            async for response_obj in prefetched:
+                if response_obj["status"] == "0":
+                    self.logger.info(f"received empty result. message='{response_obj['message']}' and"
+                                     f" result='{response_obj['result']}' at {datetime.now().strftime('%H:%M:%S.%f')[:-3]}")
+                    return
+
+                elements = response_obj["result"]
+
+                # process the elements
+                for element in elements:
+                    if tx_filter is not None and tx_filter(element):
+                        continue
+                    await element_processor(element)
+
+                count += len(elements)
+                self.logger.debug(count)
+
+    async def __fetch_window(self, params, start_block, end_block):
+        """Fetches all transactions of a block window in a single response.
+
+        :param params: Moonscan.io API call params that filter which transactions are returned.
+        :type params: dict
+        :param start_block: first block of the window
+        :type start_block: int
+        :param end_block: last block of the window, inclusive
+        :type end_block: int
+        :returns: the transactions in block order. Saturated windows are bisected by the caller.
+        :rtype: list
+        """
+        params = dict(params)
+        params["startblock"] = str(start_block)
+        params["endblock"] = str(end_block)
+        response_obj = await self.__query(params, cache_ttl=LIST_PAGE_TTL)
+        if response_obj["status"] == "0":
+            self.logger.debug(f"received empty result for blocks {start_block}-{end_block}."
+                              f" message='{response_obj['message']}'")
+            return []
+        return response_obj["result"]
 
-        while not done:
-            params["startblock"] = str(start_block)
-            response_obj = await self.__query(params)
+    async def __iterate_windows(self, element_processor, windows, params, tx_filter=None):
+        """Fetch transactions from Moonscan.io in concurrent block windows. Saturated windows are bisected adaptively and
+        the transactions reach the `element_processor` in block order.
 
-            if response_obj["status"] == "0":
-                self.logger.info(f"received empty result. message='{response_obj['message']}' and"
-                                 f" result='{response_obj['result']}' at {datetime.now().strftime('%H:%M:%S.%f')[:-3]}")
-                return
+        :param element_processor: method to process each transaction as it is received
+        :type element_processor: function
+        :param windows: the number of block windows to fetch concurrently
+        :type windows: int
+        :param params: Moonscan.io API call params that filter which transactions are returned.
+        :type params: dict
+        :param tx_filter: method that returns True if certain transactions should be filtered out of the results
+        :type tx_filter: function
+        """
+        start_block = int(params["startblock"])
+        end_block = min(int(params["endblock"]), await self.get_latest_block_number())
+        if end_block < start_block:
+            return
 
-            elements = response_obj["result"]
+        async def fetch_window(window_start, window_end):
+            return await self.__fetch_window(params, window_start, window_end)
 
-            # process the elements
-            for element in elements:
-                last_block_received = int(element['blockNumber'])
-                if tx_filter is not None and tx_filter(element):
-                    continue
-                await element_processor(element)
+        await process_block_windows(fetch_window, start_block, end_block, windows, element_processor,
+                                    tx_filter=tx_filter, max_results=self.txlist_max_results)
 
-            # update counters and check if we should exit
-            count += len(elements)
-            self.logger.debug(count)
+    async def get_latest_block_number(self):
+        """Get the number of the latest block of the chain.
 
-            start_block = int(element["blockNumber"])
-            end_block = int(params["endblock"])
-            if start_block == previous_block or last_block_received == end_block:
-                done = True
-            previous_block = start_block
+        :returns: the block number
+        :rtype: int
+        """
+        params = {"module": "proxy", "action": "eth_blockNumber"}
+        response_dict = await self.__query(params)
+        return int(response_dict['result'], 16)
 
     async def fetch_and_process_transactions(self, address, element_processor, config=None):
         """Fetch all transactions for a given address (account/contract) and use the given processor method to filter
@@ -197,7 +340,9 @@ class MoonscanWrapper:
                             start_block = value
         params = {"module": "account", "action": "txlist", "address": address,
                   "startblock": str(start_block), "endblock": str(end_block), "sort": "asc"}
-        if config and config.filter is not None:
+        if config and config.shards > 1:
+            await self.__iterate_windows(element_processor, config.shards, params, tx_filter=config.filter)
+        elif config and config.filter is not None:
             await self.__iterate_pages(element_processor, params=params, tx_filter=config.filter)
         else:
             await self.__iterate_pages(element_processor, params=params)
@@ -211,7 +356,7 @@ class MoonscanWrapper:
         :rtype: str or None
         """
         params = {"module": "contract", "action": "getabi", "address": contract_address}
-        response_dict = await self.__query(params)   # will add on the optional API key
+        response_dict = await self.__query(params, cache_ttl=_abi_ttl)   # will add on the optional API key
         if response_dict['status'] == "0" or response_dict['message'] == "NOTOK":
             self.logger.info(f'ABI not retrievable for {contract_address} because "{response_dict["result"]}"'
                              f' at {datetime.now().strftime("%H:%M:%S.%f")[:-3]}')
@@ -229,6 +374,6 @@ class MoonscanWrapper:
         :rtype: dict or None
         """
         params = {"module": "proxy", "action": "eth_getTransactionReceipt", "txhash": tx_hash}
-        response_dict = await self.__query(params)   # will add on the optional API key
+        response_dict = await self.__query(params, cache_ttl=_receipt_ttl)   # will add on the optional API key
         # response_dict['result'] should contain a long string representation of the tx receipt.
         return response_dict['result']
@@ -0,0 +1,73 @@
+__author__ = 'Tommi Enenkel @alice_und_bob'
+
+import asyncio
+
+# How many pages a pager may fetch ahead of the page that is being processed.
+DEFAULT_PAGE_LOOKAHEAD = 2
+
+_DONE = object()
+
+
+class _Failure:
+    """Carries an exception of the producer over to the consumer."""
+
+    def __init__(self, exception: BaseException):
+        self.exception = exception
+
+
+class Prefetcher:
+    """
+    Runs an async page generator in a background task that fetches up to `lookahead` pages ahead of the consumer,
+    so that waiting for the network overlaps with processing the previous page instead of adding up to it.
+
+    Use it as an async context manager, so that the producer is stopped when the consumer stops early:
+
+    ```
+    async with Prefetcher(pages()) as prefetched:
+        async for page in prefetched:
+            ...
+    ```
+    """
+
+    def __init__(self, pages, lookahead: int = DEFAULT_PAGE_LOOKAHEAD):
+        """
+        :param pages: async generator that fetches the pages one after another
+        :type pages: AsyncGenerator
+        :param lookahead: maximum number of fetched pages waiting to be processed
+        :type lookahead: int
+        """
+        self._pages = pages
+        self._queue = asyncio.Queue(maxsize=max(1, lookahead))
+        self._producer = None
+
+    async def _produce(self):
+        try:
+            async for page in self._pages:
+                await self._queue.put(page)
+        except Exception as e:
+            await self._queue.put(_Failure(e))
+            return
+        await self._queue.put(_DONE)
+
+    async def __aenter__(self):
+        self._producer = asyncio.create_task(self._produce())
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self._producer.cancel()
+        try:
+            await self._producer
+        except asyncio.CancelledError:
+            pass
+        await self._pages.aclose()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        page = await self._queue.get()
+        if page is _DONE:
+            raise StopAsyncIteration
+        if isinstance(page, _Failure):
+            raise page.exception
+        return page
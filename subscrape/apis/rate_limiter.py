@@ -0,0 +1,155 @@
+__author__ = 'Tommi Enenkel @alice_und_bob'
+
+import asyncio
+import logging
+import time
+
+
+class RateLimiter:
+    """
+    Async token bucket that paces the requests of an API wrapper.
+
+    The bucket adapts its rate with AIMD (additive increase, multiplicative decrease): every successful response
+    nudges the rate back up towards `max_calls_per_sec`, while a rate limit response from the API cuts it down and
+    pauses the bucket briefly. That way we converge on the rate the API actually allows instead of a hand-tuned
+    constant.
+
+    Tokens are reserved at the time of the call, so concurrent callers queue up behind each other without a lock.
+    A rate limit response invalidates all outstanding reservations: callers that are still waiting reserve again
+    once they wake up, so a slowdown or pause applies to them as well and not only to callers arriving later. The
+    rate limit responses of requests that were reserved before the last slowdown belong to the same episode and do
+    not slow the bucket down again.
+    """
+
+    def __init__(self, max_calls_per_sec: float, min_calls_per_sec: float = None, increase_step: float = None,
+                 decrease_factor: float = 0.5):
+        """
+        :param max_calls_per_sec: the upper bound for the rate
+        :type max_calls_per_sec: float
+        :param min_calls_per_sec: the lower bound for the rate. Defaults to 1/16th of the upper bound.
+        :type min_calls_per_sec: float
+        :param increase_step: calls/sec added to the rate after each successful call. Defaults to 1% of the upper bound.
+        :type increase_step: float
+        :param decrease_factor: factor the rate is multiplied with when the API tells us to slow down
+        :type decrease_factor: float
+        """
+        self.logger = logging.getLogger(__name__)
+        self.max_calls_per_sec = max_calls_per_sec
+        self.min_calls_per_sec = min_calls_per_sec if min_calls_per_sec is not None else max_calls_per_sec / 16
+        self.increase_step = increase_step if increase_step is not None else max_calls_per_sec / 100
+        self.decrease_factor = decrease_factor
+        self.calls_per_sec = max_calls_per_sec
+        self._tokens = self.capacity
+        self._last_refill = self._now()
+        self._generation = 0    # incremented whenever outstanding reservations become invalid
+
+    def _now(self) -> float:
+        """
+        :return: the current time in seconds of the clock the bucket runs on
+        :rtype: float
+        """
+        return time.monotonic()
+
+    @property
+    def capacity(self) -> float:
+        """
+        The maximum number of tokens that can pile up, i.e. the largest burst we allow.
+        """
+        return max(1.0, self.calls_per_sec)
+
+    def _refill(self, now: float):
+        """
+        Adds the tokens that accrued since the last refill. While the bucket is paused, `_last_refill` lies in the
+        future and nothing accrues.
+        """
+        if now > self._last_refill:
+            self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self.calls_per_sec)
+            self._last_refill = now
+
+    def _reserve(self) -> float:
+        """
+        Reserves one token.
+
+        :return: the number of seconds the caller has to wait before using the token
+        :rtype: float
+        """
+        now = self._now()
+        self._refill(now)
+        self._tokens -= 1
+        wait = max(self._last_refill - now, 0.0)
+        if self._tokens < 0:
+            wait += -self._tokens / self.calls_per_sec
+        return wait
+
+    def _current_generation(self) -> int:
+        """
+        :return: the generation of the bucket. Reservations made in an older generation are no longer valid.
+        :rtype: int
+        """
+        return self._generation
+
+    @property
+    def generation(self) -> int:
+        """
+        The generation of the bucket as of the last reservation. Read it right after `acquire()` and pass it to
+        `on_rate_limited()`, so that one rate limit episode only slows the bucket down once.
+        """
+        return self._generation
+
+    def time_until_available(self) -> float:
+        """
+        :return: the number of seconds a new caller would have to wait for a token
+        :rtype: float
+        """
+        now = self._now()
+        self._refill(now)
+        wait = max(self._last_refill - now, 0.0)
+        if self._tokens < 1:
+            wait += (1 - self._tokens) / self.calls_per_sec
+        return wait
+
+    async def acquire(self):
+        """
+        Waits until the caller is allowed to send the next request.
+        """
+        while True:
+            wait = self._reserve()
+            generation = self._generation
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+            if self._current_generation() == generation:
+                return
+            # the API slowed us down while we were waiting. our reservation was made at the old rate, so reserve again
+
+    def on_success(self):
+        """
+        Additive increase: the API answered normally, so carefully speed up again.
+        """
+        if self.calls_per_sec < self.max_calls_per_sec:
+            self.calls_per_sec = min(self.max_calls_per_sec, self.calls_per_sec + self.increase_step)
+
+    def on_rate_limited(self, pause: float = None, generation: int = None):
+        """
+        Multiplicative decrease: the API told us that we are too fast. Slow down and pause the bucket.
+
+        :param pause: seconds during which no tokens are handed out. Defaults to the interval of the new rate.
+        :type pause: float
+        :param generation: the `generation` of the reservation the rate limited request was sent with. If the bucket
+        has slowed down since, the response belongs to the same episode and is ignored. None always slows down.
+        :type generation: int
+        """
+        if generation is not None and generation != self._generation:
+            # several requests in flight hit the limit at the same time. the first of them already slowed us down
+            return
+        self.calls_per_sec = max(self.min_calls_per_sec, self.calls_per_sec * self.decrease_factor)
+        if pause is None:
+            pause = 1 / self.calls_per_sec
+        now = self._now()
+        self._refill(now)
+        # empty the bucket. the callers that are still waiting reserve again, so their debt is dropped as well
+        self._tokens = 0.0
+        self._last_refill = max(self._last_refill, now + pause)
+        self._generation += 1
+        self.logger.info(f"Rate limited. Slowing down to {self.calls_per_sec:.3f} calls/sec and pausing for"
+                         f" {pause:.3f} seconds.")
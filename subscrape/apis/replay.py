@@ -0,0 +1,279 @@
+__author__ = 'Tommi Enenkel @alice_und_bob'
+
+import asyncio
+import atexit
+import collections
+import gzip
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+import time
+import httpx
+from subscrape.apis import http_client
+
+logger = logging.getLogger(__name__)
+
+# Credentials are stripped from the urls before they are archived, so archives can be shared and replayed with any or
+# no API key. Request headers (like Subscan's `x-api-key`) are not archived at all.
+_CREDENTIAL_PARAMS = ["apikey"]
+# Response headers worth keeping. Everything else is dropped to keep the archive compact.
+_ARCHIVED_HEADERS = ["content-type", "retry-after"]
+# The archive that is currently recorded to or replayed from. None if neither is enabled.
+_active_archive = None
+
+
+def _strip_credentials(url: httpx.URL) -> httpx.URL:
+    for param in _CREDENTIAL_PARAMS:
+        url = url.copy_remove_param(param)
+    return url
+
+
+def request_key(request: httpx.Request) -> str:
+    """
+    Builds the key under which a request is archived. The key ignores credentials.
+
+    :param request: the request
+    :type request: httpx.Request
+    :return: the key
+    :rtype: str
+    """
+    url = _strip_credentials(request.url)
+    payload = f"{request.method} {url}\n".encode("UTF-8") + request.content
+    return hashlib.sha256(payload).hexdigest()
+
+
+class ReplayArchive:
+    """
+    Compact archive of request/response pairs: a gzipped file with one JSON document per exchange.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: path of the archive file
+        :type path: Path or str
+        """
+        self.path = Path(path)
+        self._file = None
+        self._unflushed = 0
+        self.exchanges = collections.defaultdict(list)   # request key -> list of archived responses
+
+    def load(self):
+        """
+        Reads all exchanges of the archive into memory.
+        """
+        with gzip.open(self.path, "rt", encoding="UTF-8") as archive_file:
+            for line in archive_file:
+                exchange = json.loads(line)
+                self.exchanges[exchange["key"]].append(exchange)
+        logger.info(f"Loaded {sum(len(e) for e in self.exchanges.values())} exchanges from {self.path}.")
+
+    def append(self, request: httpx.Request, response: httpx.Response):
+        """
+        Adds an exchange to the archive. The response must have been read already.
+
+        :param request: the request
+        :type request: httpx.Request
+        :param response: the response to the request
+        :type response: httpx.Response
+        """
+        if self._file is None:
+            os.makedirs(self.path.parent, exist_ok=True)
+            self._file = gzip.open(self.path, "at", encoding="UTF-8")
+            atexit.register(self.close)
+        exchange = {
+            "key": request_key(request),
+            "method": request.method,
+            "url": str(_strip_credentials(request.url)),
+            "status": response.status_code,
+            "headers": {name: response.headers[name] for name in _ARCHIVED_HEADERS if name in response.headers},
+            "body": response.content.decode("UTF-8"),
+        }
+        self._file.write(json.dumps(exchange, separators=(",", ":")) + "\n")
+        self._unflushed += 1
+        if self._unflushed >= 50:
+            self._file.flush()
+            self._unflushed = 0
+
+    def close(self):
+        """
+        Flushes and closes the archive file.
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class RecordingTransport(httpx.AsyncBaseTransport):
+    """Transport that forwards every request to the network and archives the exchange."""
+
+    def __init__(self, archive: ReplayArchive, transport: httpx.AsyncBaseTransport):
+        """
+        :param archive: the archive to write to
+        :type archive: ReplayArchive
+        :param transport: the transport that actually sends the requests
+        :type transport: httpx.AsyncBaseTransport
+        """
+        self.archive = archive
+        self.transport = transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        response = await self.transport.handle_async_request(request)
+        await response.aread()
+        self.archive.append(request, response)
+        return response
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+class ReplayTransport(httpx.AsyncBaseTransport):
+    """
+    Transport that serves every request from an archive without touching the network. It can simulate the latency
+    and the rate limit of an explorer to benchmark the scraper under realistic but reproducible conditions.
+    """
+
+    def __init__(self, archive: ReplayArchive, latency: float = 0.0, max_calls_per_sec: float = None):
+        """
+        :param archive: the loaded archive to serve from
+        :type archive: ReplayArchive
+        :param latency: seconds every response is delayed
+        :type latency: float
+        :param max_calls_per_sec: if set, requests beyond this rate are answered with status 429
+        :type max_calls_per_sec: float
+        """
+        self.archive = archive
+        self.latency = latency
+        self.max_calls_per_sec = max_calls_per_sec
+        self._positions = collections.Counter()     # how often each request key has been served
+        self._recent_calls = collections.deque()
+
+    def _is_rate_limited(self) -> bool:
+        """
+        :return: whether the request exceeds the simulated rate limit of the last second
+        :rtype: bool
+        """
+        if self.max_calls_per_sec is None:
+            return False
+        now = time.monotonic()
+        while self._recent_calls and self._recent_calls[0] < now - 1:
+            self._recent_calls.popleft()
+        if len(self._recent_calls) >= self.max_calls_per_sec:
+            return True
+        self._recent_calls.append(now)
+        return False
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+        if self._is_rate_limited():
+            return httpx.Response(429, request=request)
+
+        key = request_key(request)
+        exchanges = self.archive.exchanges.get(key)
+        if not exchanges:
+            logger.warning(f"No archived response for {request.method} {request.url}.")
+            return httpx.Response(404, json={"message": "not archived"}, request=request)
+
+        # responses to repeated requests are served in the order they were recorded, the last one sticks
+        position = min(self._positions[key], len(exchanges) - 1)
+        self._positions[key] += 1
+        exchange = exchanges[position]
+        return httpx.Response(exchange["status"], headers=exchange["headers"],
+                              content=exchange["body"].encode("UTF-8"), request=request)
+
+
+def _install(archive, transport_factory):
+    global _active_archive
+    _active_archive = archive
+    http_client.set_transport_factory(transport_factory)
+
+
+def is_active() -> bool:
+    """
+    :return: whether explorer traffic is currently recorded or replayed. The response cache is bypassed meanwhile, since
+    cache hits would be missing from a recording and would shadow the archive during replay.
+    :rtype: bool
+    """
+    return _active_archive is not None
+
+
+def current_state() -> tuple:
+    """
+    :return: the active archive and transport factory, to be handed to `restore()` once a run is done
+    :rtype: tuple
+    """
+    return _active_archive, http_client.get_transport_factory()
+
+
+def restore(state: tuple):
+    """
+    Goes back to a state returned by `current_state()`. An archive that was recorded to since is closed.
+
+    :param state: the state to go back to
+    :type state: tuple
+    """
+    archive, transport_factory = state
+    if _active_archive is not None and _active_archive is not archive:
+        _active_archive.close()
+    _install(archive, transport_factory)
+
+
+def enable_recording(path):
+    """
+    Records every exchange of the explorer wrappers created from now on into an archive.
+
+    :param path: path of the archive file. New exchanges are appended if the file exists.
+    :type path: Path or str
+    """
+    archive = ReplayArchive(path)
+    logger.info(f"Recording explorer responses to {archive.path}.")
+
+    def transport_factory(limits, http2):
+        return RecordingTransport(archive, httpx.AsyncHTTPTransport(http2=http2, limits=limits))
+
+    _install(archive, transport_factory)
+
+
+def enable_replay(path, latency: float = 0.0, max_calls_per_sec: float = None):
+    """
+    Serves every request of the explorer wrappers created from now on from an archive.
+
+    :param path: path of the archive file
+    :type path: Path or str
+    :param latency: simulated seconds of latency per request
+    :type latency: float
+    :param max_calls_per_sec: simulated rate limit. None for no limit.
+    :type max_calls_per_sec: float
+    """
+    archive = ReplayArchive(path)
+    archive.load()
+    logger.info(f"Replaying explorer responses from {archive.path}.")
+
+    def transport_factory(limits, http2):
+        return ReplayTransport(archive, latency, max_calls_per_sec)
+
+    _install(archive, transport_factory)
+
+
+def configure_from_environment():
+    """
+    Enables recording or replay if the environment asks for it. This allows to run e.g. the test suite offline:
+    `SUBSCRAPE_REPLAY=data/replay/tests.jsonl.gz pytest`.
+
+    - `SUBSCRAPE_RECORD`: path of the archive to record to
+    - `SUBSCRAPE_REPLAY`: path of the archive to replay from
+    - `SUBSCRAPE_REPLAY_LATENCY`: simulated latency in seconds
+    - `SUBSCRAPE_REPLAY_MAX_CALLS_PER_SEC`: simulated rate limit
+    """
+    record_path = os.environ.get("SUBSCRAPE_RECORD")
+    replay_path = os.environ.get("SUBSCRAPE_REPLAY")
+    if record_path:
+        enable_recording(record_path)
+    elif replay_path:
+        latency = float(os.environ.get("SUBSCRAPE_REPLAY_LATENCY", 0.0))
+        max_calls_per_sec = os.environ.get("SUBSCRAPE_REPLAY_MAX_CALLS_PER_SEC")
+        if max_calls_per_sec is not None:
+            max_calls_per_sec = float(max_calls_per_sec)
+        enable_replay(replay_path, latency, max_calls_per_sec)
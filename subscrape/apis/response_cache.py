@@ -0,0 +1,167 @@
+__author__ = 'Tommi Enenkel @alice_und_bob'
+
+import hashlib
+import json
+import logging
+import math
+import os
+from pathlib import Path
+import sqlite3
+import time
+
+DEFAULT_MAX_SIZE_BYTES = 1024 ** 3    # 1 GiB
+NEVER_EXPIRES = math.inf             # finalized chain data never changes
+LIST_PAGE_TTL = 5 * 60               # list pages grow with every block
+MUTABLE_TTL = 60                     # data about blocks that are not finalized yet
+UNAVAILABLE_TTL = 24 * 60 * 60       # negative answers, e.g. an ABI that has not been verified yet
+ACCESS_FLUSH_THRESHOLD = 1000        # access times that are kept in memory before they are written
+
+
+class ResponseCache:
+    """
+    Persistent, content-addressed cache for explorer responses. The key of an entry is the hash of the endpoint,
+    method and body of the request; the value is the raw response body. Every entry has its own expiry time, so
+    immutable data can be kept forever while list pages expire quickly. When the cache grows beyond its maximum size,
+    the least recently used entries are evicted.
+
+    A cache hit only records its access time in memory. The access times are written along with the next `set()`,
+    once `ACCESS_FLUSH_THRESHOLD` of them piled up, or on `close()`, so that hits do not cost a write transaction each.
+    """
+
+    def __init__(self, path, max_size_bytes: int = DEFAULT_MAX_SIZE_BYTES):
+        """
+        :param path: path of the SQLite file backing the cache
+        :type path: Path or str
+        :param max_size_bytes: the cache evicts entries once the stored bodies exceed this size
+        :type max_size_bytes: int
+        """
+        self.logger = logging.getLogger(__name__)
+        self.path = Path(path)
+        self.max_size_bytes = max_size_bytes
+        os.makedirs(self.path.parent, exist_ok=True)
+        self._connection = sqlite3.connect(str(self.path), timeout=30)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY,"
+            " body BLOB NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " expires_at REAL,"         # NULL for entries that never expire
+            " last_access REAL NOT NULL)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+        self._connection.commit()
+        self._size = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+        self._pending_accesses = {}     # key -> last access time that is not written yet
+
+    @staticmethod
+    def make_key(endpoint: str, method: str, body) -> str:
+        """
+        Builds the content address of a request. Credentials must not be part of `body`, so entries can be shared
+        between API keys.
+
+        :param endpoint: the url of the explorer API
+        :type endpoint: str
+        :param method: the API method or action
+        :type method: str
+        :param body: the request body or query params
+        :type body: dict or str
+        :return: the key
+        :rtype: str
+        """
+        payload = json.dumps([endpoint, method, body], sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(payload.encode("UTF-8")).hexdigest()
+
+    def get(self, key: str):
+        """
+        Looks up a response body.
+
+        :param key: the key built by `make_key`
+        :type key: str
+        :return: the response body, or None if the entry does not exist or has expired
+        :rtype: bytes or None
+        """
+        now = time.time()
+        row = self._connection.execute("SELECT body, size, expires_at FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        body, size, expires_at = row
+        if expires_at is not None and expires_at < now:
+            self._pending_accesses.pop(key, None)
+            self._connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._connection.commit()
+            self._size -= size
+            self.misses += 1
+            return None
+        self._pending_accesses[key] = now
+        if len(self._pending_accesses) >= ACCESS_FLUSH_THRESHOLD:
+            self._write_accesses()
+            self._connection.commit()
+        self.hits += 1
+        return body
+
+    def set(self, key: str, body: bytes, ttl: float):
+        """
+        Stores a response body.
+
+        :param key: the key built by `make_key`
+        :type key: str
+        :param body: the raw response body
+        :type body: bytes
+        :param ttl: seconds until the entry expires. Use `NEVER_EXPIRES` for immutable data.
+        :type ttl: float
+        """
+        now = time.time()
+        expires_at = None if ttl == NEVER_EXPIRES else now + ttl
+        self._pending_accesses.pop(key, None)
+        self._write_accesses()
+        row = self._connection.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            self._size -= row[0]
+        self._connection.execute(
+            "INSERT OR REPLACE INTO responses (key, body, size, expires_at, last_access) VALUES (?, ?, ?, ?, ?)",
+            (key, body, len(body), expires_at, now))
+        self._connection.commit()
+        self._size += len(body)
+        if self._size > self.max_size_bytes:
+            self._evict()
+
+    def _write_accesses(self):
+        """
+        Writes the access times recorded in memory. The caller commits them.
+        """
+        if len(self._pending_accesses) > 0:
+            self._connection.executemany("UPDATE responses SET last_access = ? WHERE key = ?",
+                                         [(last_access, key) for key, last_access in self._pending_accesses.items()])
+            self._pending_accesses.clear()
+
+    def _evict(self):
+        """
+        Removes expired entries, then the least recently used ones until the cache is down to 90% of its maximum.
+        """
+        now = time.time()
+        self._write_accesses()
+        self._connection.execute("DELETE FROM responses WHERE expires_at IS NOT NULL AND expires_at < ?", (now,))
+        self._size = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+        target = self.max_size_bytes * 0.9
+        evicted_keys = []
+        for key, size in self._connection.execute("SELECT key, size FROM responses ORDER BY last_access"):
+            if self._size <= target:
+                break
+            evicted_keys.append((key,))
+            self._size -= size
+        self._connection.executemany("DELETE FROM responses WHERE key = ?", evicted_keys)
+        self._connection.commit()
+        self.logger.info(f"Evicted {len(evicted_keys)} responses from the cache at {self.path}.")
+
+    def close(self):
+        """
+        Writes the pending access times and closes the underlying database.
+        """
+        self._write_accesses()
+        self._connection.commit()
+        self._connection.close()
@@ -0,0 +1,268 @@
+__author__ = 'Tommi Enenkel @alice_und_bob'
+
+import asyncio
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import logging
+import random
+import time
+import httpx
+from subscrape.apis.http_client import DEFAULT_TIMEOUT
+
+# Status codes that are worth another try. 429 is handled by the rate limiters, the others are transient server
+# errors, mostly caused by overloaded explorers or their load balancers.
+RATE_LIMITED_STATUS = 429
+TRANSIENT_STATUSES = [500, 502, 503, 504]
+
+
+class ExplorerError(Exception):
+    """Raised when an explorer request fails for good."""
+
+    def __init__(self, message: str, status_code: int = None):
+        """
+        :param message: description of the failure
+        :type message: str
+        :param status_code: the http status of the last response, or None if no response was received
+        :type status_code: int or None
+        """
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def retry_after(response: httpx.Response) -> float:
+    """
+    Reads the `Retry-After` header of a response.
+
+    :param response: the response
+    :type response: httpx.Response
+    :return: seconds to wait, or None if the header is missing or malformed
+    :rtype: float or None
+    """
+    value = response.headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class CircuitBreaker:
+    """
+    Stops sending requests to an endpoint that keeps failing. After `failure_threshold` consecutive failures the
+    circuit opens and every request of the endpoint waits for `reset_timeout` seconds. Then a single trial request is
+    let through: if it succeeds, the circuit closes again, otherwise it stays open for another period. Only the
+    coroutines using the endpoint wait; the rest of the event loop keeps running.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        """
+        :param name: name of the endpoint, for logging
+        :type name: str
+        :param failure_threshold: consecutive failures after which the circuit opens
+        :type failure_threshold: int
+        :param reset_timeout: seconds the circuit stays open before a trial request is let through
+        :type reset_timeout: float
+        """
+        self.logger = logging.getLogger(__name__)
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+
+    @property
+    def is_open(self) -> bool:
+        return self._opened_at is not None
+
+    async def wait(self) -> bool:
+        """
+        Waits until the circuit lets a request through.
+
+        :return: whether the request is the trial request. Its outcome must be recorded on every exit path,
+        otherwise the circuit never lets another request through.
+        :rtype: bool
+        """
+        while self._opened_at is not None:
+            remaining = self._opened_at + self.reset_timeout - time.monotonic()
+            if remaining > 0:
+                await asyncio.sleep(remaining)
+            elif not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            else:
+                # another coroutine is sending the trial request
+                await asyncio.sleep(min(1.0, self.reset_timeout))
+        return False
+
+    def record_success(self):
+        """
+        The endpoint answered. Closes the circuit.
+        """
+        if self._opened_at is not None:
+            self.logger.info(f"{self.name} is responding again. Closing the circuit.")
+        self.failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+
+    def record_failure(self):
+        """
+        The endpoint failed. Opens the circuit if it failed too often in a row or if the trial request failed.
+        """
+        self.failures += 1
+        self._trial_in_flight = False
+        if self.failures >= self.failure_threshold or self._opened_at is not None:
+            self._opened_at = time.monotonic()
+            self.logger.warning(f"{self.name} failed {self.failures} times in a row. Pausing its requests for"
+                                f" {self.reset_timeout} seconds.")
+
+
+class RetryBudget:
+    """
+    Limits retries to a fraction of the requests, so that an outage does not multiply the load on the explorer.
+    Every request deposits `ratio` tokens, every retry withdraws one. The balance starts at and is capped by
+    `min_retries`, which allows a burst of retries after a quiet period.
+    """
+
+    def __init__(self, ratio: float = 0.2, min_retries: int = 10):
+        """
+        :param ratio: retries allowed per request
+        :type ratio: float
+        :param min_retries: retries that are always allowed
+        :type min_retries: int
+        """
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self._balance = float(min_retries)
+
+    def on_request(self):
+        self._balance = min(self.min_retries, self._balance + self.ratio)
+
+    def try_withdraw(self) -> bool:
+        """
+        :return: whether a retry is within the budget. If so, it is withdrawn.
+        :rtype: bool
+        """
+        if self._balance < 1:
+            return False
+        self._balance -= 1
+        return True
+
+
+class RetryPolicy:
+    """
+    Shared retry policy of the explorer wrappers. Transient failures (timeouts, connection errors and 5xx responses)
+    are retried with exponential backoff and full jitter, honoring `Retry-After`, as long as the retry budget allows.
+    Rate limited responses are retried after the rate limiter has slowed down. A circuit breaker pauses the endpoint
+    when it keeps failing. Every wrapper owns one policy, so all state is per endpoint.
+    """
+
+    def __init__(self, name: str, max_attempts: int = 8, max_rate_limited_attempts: int = 50,
+                 base_delay: float = 0.5, max_delay: float = 60.0, timeout: float = DEFAULT_TIMEOUT,
+                 retry_budget: RetryBudget = None, circuit_breaker: CircuitBreaker = None):
+        """
+        :param name: name of the endpoint, for logging
+        :type name: str
+        :param max_attempts: maximum number of attempts per request, including the first one
+        :type max_attempts: int
+        :param max_rate_limited_attempts: maximum number of rate limited attempts per request
+        :type max_rate_limited_attempts: int
+        :param base_delay: backoff in seconds before the first retry. It doubles with every further retry.
+        :type base_delay: float
+        :param max_delay: upper bound of the backoff in seconds
+        :type max_delay: float
+        :param timeout: timeout in seconds of every single attempt
+        :type timeout: float
+        :param retry_budget: the retry budget. Defaults to a new `RetryBudget`.
+        :type retry_budget: RetryBudget
+        :param circuit_breaker: the circuit breaker. Defaults to a new `CircuitBreaker`.
+        :type circuit_breaker: CircuitBreaker
+        """
+        self.logger = logging.getLogger(__name__)
+        self.name = name
+        self.max_attempts = max_attempts
+        self.max_rate_limited_attempts = max_rate_limited_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.retry_budget = retry_budget if retry_budget is not None else RetryBudget()
+        self.circuit_breaker = circuit_breaker if circuit_breaker is not None else CircuitBreaker(name)
+
+    def backoff(self, attempt: int) -> float:
+        """
+        :param attempt: the number of the failed attempt, starting at 0
+        :type attempt: int
+        :return: seconds to wait before the next attempt
+        :rtype: float
+        """
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    async def send(self, send_request, is_rate_limited=None) -> httpx.Response:
+        """
+        Sends a request until it succeeds or fails for good.
+
+        :param send_request: async function that takes the timeout in seconds, sends the request once and returns the
+        response. It is also responsible for feeding the rate limiter of the API key it used.
+        :type send_request: function
+        :param is_rate_limited: optional function that detects rate limited responses that have status 200
+        :type is_rate_limited: function
+        :return: the successful response
+        :rtype: httpx.Response
+        """
+        self.retry_budget.on_request()
+        attempt = 0                 # failed attempts
+        rate_limited_attempts = 0
+        while True:
+            is_trial = await self.circuit_breaker.wait()
+            status_code = None
+            delay = None
+            try:
+                response = await send_request(self.timeout)
+                rate_limited = response.status_code == RATE_LIMITED_STATUS or \
+                    (response.status_code == 200 and is_rate_limited is not None and is_rate_limited(response))
+            except httpx.TransportError as e:
+                reason = f"{type(e).__name__}: {e}"
+            except BaseException:
+                if is_trial:
+                    # the trial request was cancelled or failed unexpectedly. count it as a failure, so the circuit
+                    # lets another trial through after the next period instead of waiting for this one forever
+                    self.circuit_breaker.record_failure()
+                raise
+            else:
+                status_code = response.status_code
+                if rate_limited:
+                    # the rate limiter of the key has already slowed down and paused, no need to back off here
+                    self.circuit_breaker.record_success()
+                    rate_limited_attempts += 1
+                    if rate_limited_attempts >= self.max_rate_limited_attempts:
+                        raise ExplorerError(f"{self.name} kept rate limiting after {rate_limited_attempts} attempts.",
+                                            status_code)
+                    self.logger.warning("API rate limit exceeded. Slowing down and retrying...")
+                    continue
+                if status_code not in TRANSIENT_STATUSES:
+                    self.circuit_breaker.record_success()
+                    if status_code != 200:
+                        self.logger.info(f"Status Code: {status_code}")
+                        self.logger.info(response.headers)
+                        raise ExplorerError(f"Error: {status_code}", status_code)
+                    return response
+                reason = f"status {status_code}"
+                delay = retry_after(response)
+
+            self.circuit_breaker.record_failure()
+            attempt += 1
+            if attempt >= self.max_attempts:
+                raise ExplorerError(f"{self.name} failed after {attempt} attempts. Last error: {reason}", status_code)
+            if not self.retry_budget.try_withdraw():
+                raise ExplorerError(f"{self.name} failed with {reason} and the retry budget is exhausted.",
+                                    status_code)
+            if delay is None:
+                delay = self.backoff(attempt - 1)
+            self.logger.warning(f"{self.name} failed with {reason}. Retrying in {delay:.2f} seconds"
+                                f" (attempt {attempt + 1} of {self.max_attempts}).")
+            await asyncio.sleep(delay)
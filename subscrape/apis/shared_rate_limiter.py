@@ -0,0 +1,101 @@
+__author__ = 'Tommi Enenkel @alice_und_bob'
+
+import contextlib
+import hashlib
+import json
+import os
+from pathlib import Path
+import time
+from subscrape.apis.rate_limiter import RateLimiter
+
+try:
+    import fcntl
+except ImportError:     # not available on Windows
+    fcntl = None
+
+
+def is_supported() -> bool:
+    """
+    :return: whether cross-process rate limiting is supported on this platform
+    :rtype: bool
+    """
+    return fcntl is not None
+
+
+class SharedRateLimiter(RateLimiter):
+    """
+    A `RateLimiter` whose bucket lives in a small state file instead of in memory, so several processes scraping
+    with the same API key draw their tokens from one shared budget. Every operation on the bucket locks the file,
+    loads the state, applies the usual token bucket logic and writes the state back.
+
+    Since the state is shared between processes, the bucket runs on wall clock time.
+    """
+
+    def __init__(self, max_calls_per_sec: float, state_dir: Path, name: str, **kwargs):
+        """
+        :param max_calls_per_sec: the upper bound for the rate
+        :type max_calls_per_sec: float
+        :param state_dir: folder where the state files of the buckets are kept
+        :type state_dir: Path
+        :param name: identifies the budget, e.g. the API key. It is hashed, so no secret ends up in a file name.
+        :type name: str
+        """
+        if fcntl is None:
+            raise RuntimeError("Cross-process rate limiting requires fcntl, which is not available on this platform.")
+        super().__init__(max_calls_per_sec, **kwargs)
+        state_dir = Path(state_dir)
+        state_dir.mkdir(parents=True, exist_ok=True)
+        digest = hashlib.sha256(name.encode("UTF-8")).hexdigest()[:32]
+        self.state_path = state_dir / f"{digest}.json"
+
+    def _now(self) -> float:
+        return time.time()
+
+    @contextlib.contextmanager
+    def _locked_state(self):
+        """
+        Locks the state file, loads the bucket from it and writes the bucket back when the block is done.
+        """
+        fd = os.open(self.state_path, os.O_RDWR | os.O_CREAT)
+        with os.fdopen(fd, "r+", encoding="UTF-8") as state_file:
+            fcntl.flock(state_file, fcntl.LOCK_EX)
+            try:
+                content = state_file.read()
+                if content:
+                    state = json.loads(content)
+                    self._tokens = state["tokens"]
+                    self._last_refill = state["last_refill"]
+                    self.calls_per_sec = min(state["calls_per_sec"], self.max_calls_per_sec)
+                    self._generation = state.get("generation", 0)
+                yield
+                state_file.seek(0)
+                state_file.truncate()
+                state_file.write(json.dumps({
+                    "tokens": self._tokens,
+                    "last_refill": self._last_refill,
+                    "calls_per_sec": self.calls_per_sec,
+                    "generation": self._generation,
+                }))
+                state_file.flush()
+            finally:
+                fcntl.flock(state_file, fcntl.LOCK_UN)
+
+    def _reserve(self) -> float:
+        with self._locked_state():
+            return super()._reserve()
+
+    def _current_generation(self) -> int:
+        with self._locked_state():
+            return super()._current_generation()
+
+    def time_until_available(self) -> float:
+        with self._locked_state():
+            return super().time_until_available()
+
+    def on_success(self):
+        with self._locked_state():
+            super().on_success()
+
+    def on_rate_limited(self, pause: float = None, generation: int = None):
+        with self._locked_state():
+            super().on_rate_limited(pause, generation)
@@ -0,0 +1,36 @@
+__author__ = 'Tommi Enenkel @alice_und_bob'
+
+import asyncio
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls for the same key: while a call is in flight, every further caller for that key awaits
+    the same future instead of sending its own identical request. Once the call has finished, the key is free again,
+    so results are not cached here; that is up to the caller.
+    """
+
+    def __init__(self):
+        self._in_flight = {}    # key -> future of the running call
+
+    def __len__(self):
+        return len(self._in_flight)
+
+    async def do(self, key, call):
+        """
+        Runs `call` unless a call for `key` is already in flight, and returns its result. If the call raises, all
+        callers waiting for it receive the exception.
+
+        :param key: identifies identical calls, e.g. `("abi", contract_address)`
+        :type key: hashable
+        :param call: function without arguments that returns the awaitable to run
+        :type call: function
+        :return: the result of the call
+        """
+        future = self._in_flight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(call())
+            self._in_flight[key] = future
+            future.add_done_callback(lambda f: self._in_flight.pop(key, None))
+        # a cancelled caller must not cancel the call for the others
+        return await asyncio.shield(future)
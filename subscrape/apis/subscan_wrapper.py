@@ -4,10 +4,16 @@ from datetime import datetime
 import httpx
 import json
 import logging
-from ratelimit import limits, sleep_and_retry
 from subscrape.db.subscrape_db import SubscrapeDB, Extrinsic, Event
 from substrateinterface.utils import ss58
 import asyncio
+from subscrape.apis.http_client import create_async_client
+from subscrape.apis import json_decoder
+from subscrape.apis.prefetch import Prefetcher, DEFAULT_PAGE_LOOKAHEAD
+from subscrape.apis.api_key_pool import ApiKeyPool
+from subscrape.apis.retry_policy import RetryPolicy, retry_after
+from subscrape.apis.response_cache import ResponseCache, NEVER_EXPIRES, LIST_PAGE_TTL, MUTABLE_TTL
+from subscrape.apis.shared_rate_limiter import SharedRateLimiter
 from subscrape.scrapers.scrape_config import ScrapeConfig
 
 # import http.client
@@ -17,8 +23,16 @@ from subscrape.scrapers.scrape_config import ScrapeConfig
 # requests_log.propagate = True
 
 SUBSCAN_MAX_CALLS_PER_SEC_WITHOUT_API_KEY = 2
-SUBSCAN_MAX_CALLS_PER_SEC_WITH_AN_API_KEY = 30
-MAX_CALLS_PER_SEC = SUBSCAN_MAX_CALLS_PER_SEC_WITHOUT_API_KEY
+SUBSCAN_MAX_CALLS_PER_SEC_WITH_AN_API_KEY = 5
+
+
+def _finality_aware_ttl(data):
+    """
+    Hydrated extrinsics and events never change once their block is finalized, so they are cached forever.
+    """
+    if data is None:
+        return None
+    return NEVER_EXPIRES if data.get("finalized") else MUTABLE_TTL
 
 
 class SubscanWrapper:
@@ -26,27 +40,56 @@ class SubscanWrapper:
     Interface for interacting with the API of explorer Subscan.io for the Moonriver and Moonbeam chains.
     """
 
-    def __init__(self, chain: str, db: SubscrapeDB, api_key: str = None):
+    def __init__(self, chain: str, db: SubscrapeDB, api_key=None, http_limits: httpx.Limits = None,
+                 shared_rate_limit_dir=None, response_cache: ResponseCache = None, api_key_pool: ApiKeyPool = None):
         """
         Initializes the SubscanBase.
         :param chain: The chain to scrape.
         :type chain: str
         :param db: The database to write to.
         :type db: SubscrapeDB
-        :param api_key: The api key to use. Use None, if no api key is to be used.
-        :type api_key: str or None
+        :param api_key: The api key to use, or a list of api keys to spread the requests across. Every key has its
+        own rate budget. Use None, if no api key is to be used.
+        :type api_key: str or list or None
+        :param http_limits: Connection pool limits of the shared http client. Use None for the defaults.
+        :type http_limits: httpx.Limits or None
+        :param shared_rate_limit_dir: If set, the rate budget of each key is coordinated with other processes through
+        state files in this folder. Use None to keep the budget local to this process.
+        :type shared_rate_limit_dir: Path or None
+        :param response_cache: Persistent cache for the responses. Use None to always query the API.
+        :type response_cache: ResponseCache or None
+        :param api_key_pool: The pool of `api_key`, if it is shared with the wrappers of other chains. Subscan budgets
+        are tied to the key, so all chains scraped with a key have to draw from the same pool. Use None to create one.
+        :type api_key_pool: ApiKeyPool or None
         """
         self.logger = logging.getLogger(__name__)
         self.chain = chain.lower()
         self.endpoint = f"https://{self.chain}.api.subscan.io"
         self.db: SubscrapeDB = db
-        self.api_key = api_key
-        global MAX_CALLS_PER_SEC
-        if api_key is not None:
-            MAX_CALLS_PER_SEC = 5
-        self.logger.info(f'Subscan rate limit set to {MAX_CALLS_PER_SEC} API calls per second.')
-        self.semaphore = asyncio.Semaphore(MAX_CALLS_PER_SEC)
-        self.lock = asyncio.Lock()
+        if api_key is None:
+            keys = []
+            self.max_calls_per_sec = SUBSCAN_MAX_CALLS_PER_SEC_WITHOUT_API_KEY
+        else:
+            keys = api_key if type(api_key) is list else [api_key]
+            self.max_calls_per_sec = SUBSCAN_MAX_CALLS_PER_SEC_WITH_AN_API_KEY
+        if api_key_pool is not None:
+            self.api_keys = api_key_pool
+        else:
+            if shared_rate_limit_dir is None:
+                rate_limiter_factory = None
+            else:
+                # Subscan budgets are tied to the key. Anonymous calls are only limited per endpoint.
+                def rate_limiter_factory(key):
+                    name = f"subscan-{key}" if key is not None else self.endpoint
+                    return SharedRateLimiter(self.max_calls_per_sec, shared_rate_limit_dir, name)
+            self.api_keys = ApiKeyPool(keys, self.max_calls_per_sec, rate_limiter_factory)
+        self.logger.info(f'Subscan rate limit set to {self.max_calls_per_sec} API calls per second'
+                         f' for each of {len(self.api_keys)} key(s).')
+        self._http_limits = http_limits
+        self._client = None
+        self.response_cache = response_cache
+        self.page_lookahead = DEFAULT_PAGE_LOOKAHEAD
+        self.retry_policy = RetryPolicy(self.endpoint)
 
         self._extrinsic_index_deducer = lambda e: e["extrinsic_index"]
         # self._events_index_deducer = lambda e: f"{e['event_index']}"
@@ -59,9 +102,30 @@ class SubscanWrapper:
         self._api_method_event = "/api/scan/event"
         self._api_method_events_call = "event_id"
 
-    @sleep_and_retry  # be patient and sleep this thread to avoid exceeding the rate limit
-    # @limits(calls=MAX_CALLS_PER_SEC, period=1)     # API limits us to 30 calls every second
-    async def _query(self, method, headers={}, body={}, client=None):
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """
+        The pooled http client that is shared by all requests of this wrapper. It is created on first use.
+        """
+        if self._client is None or self._client.is_closed:
+            self._client = create_async_client(self._http_limits)
+        return self._client
+
+    async def close(self):
+        """
+        Closes the shared http client and all of its pooled connections.
+        """
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def _query(self, method, headers={}, body={}, client=None, cache_ttl=None):
         """Rate limited call to fetch another page of data from the Subscan.io block explorer website
 
         :param method: Subscan.io API call method.
@@ -70,45 +134,56 @@ class SubscanWrapper:
         :type headers: list
         :param body: Subscan.io API call body. Typically, used to specify each page being requested.
         :type body: list
-        :param client: client to use for sending http requests for blockchain data. If None, defaults to `httpx`.
+        :param client: client to use for sending http requests for blockchain data. If None, defaults to the shared
+        pooled client of this wrapper.
         :type client: object
+        :param cache_ttl: seconds to keep the response in the response cache, or a function that deduces them from
+        the returned data. None if the response should not be cached.
+        :type cache_ttl: float or function or None
         """
         if client is None:
-            client = httpx.AsyncClient()
+            client = self.client
 
+        headers = dict(headers)
         headers["Content-Type"] = "application/json"
-        if self.api_key is not None:
-            headers["x-api-key"] = self.api_key
         body = json.dumps(body)
         url = self.endpoint + method
 
-        response = None
-        should_request = True
-        while should_request:  # loop until we get a response
+        cache_key = None
+        if self.response_cache is not None and cache_ttl is not None:
+            cache_key = ResponseCache.make_key(self.endpoint, method, body)
+            content = self.response_cache.get(cache_key)
+            if content is not None:
+                return json_decoder.loads(content)["data"]
+
+        async def send_request(timeout):
+            api_key = await self.api_keys.acquire()
+            generation = api_key.rate_limiter.generation
+            request_headers = dict(headers)
+            if api_key.key is not None:
+                request_headers["x-api-key"] = api_key.key
             before = datetime.now()
-            async with self.semaphore:
-                response = await client.post(url, headers=headers, data=body)
+            response = await client.post(url, headers=request_headers, data=body, timeout=timeout)
             after = datetime.now()
             self.logger.debug("request took: " + str(after - before))
 
-            # lock to prevent multiple threads from trying to sleep at the same time
-            await self.lock.acquire()
-            try:
-                if response.status_code == 429:
-                    self.logger.warning("API rate limit exceeded. Waiting 1 second and retrying...")
-                    await asyncio.sleep(1)
-                elif response.status_code != 200:
-                    self.logger.info(f"Status Code: {response.status_code}")
-                    self.logger.info(response.headers)
-                    raise Exception(f"Error: {response.status_code}")
-                else:
-                    should_request = False
-            finally:
-                self.lock.release()
+            if response.status_code == 429:
+                api_key.rate_limiter.on_rate_limited(pause=retry_after(response), generation=generation)
+            elif response.status_code == 200:
+                api_key.rate_limiter.on_success()
+            return response
+
+        response = await self.retry_policy.send(send_request)
 
         # self.logger.debug(response.text)
         # unpack the payload
-        obj = json.loads(response.text)
+        obj = json_decoder.loads(response.content)
+
+        if cache_key is not None and obj.get("code") == 0:
+            ttl = cache_ttl(obj["data"]) if callable(cache_ttl) else cache_ttl
+            if ttl is not None:
+                self.response_cache.set(cache_key, response.content, ttl)
+
         return obj["data"]
 
     # iterates through all pages until it processed all elements
@@ -122,6 +197,7 @@ class SubscanWrapper:
             body={},
             filter=None,
             stop_on_known_data=True,
+            page_processor=None,
     ) -> list:
         """Repeatedly fetch transactions from Subscan.io matching a set of parameters, iterating one html page at a
         time. Perform post-processing of each transaction using the `element_processor` method provided.
@@ -139,64 +215,186 @@ class SubscanWrapper:
         :type filter: function
         :param stop_on_known_data: whether to stop iterating when we encounter a known element
         :type stop_on_known_data: bool
+        :param page_processor: optional async function that is called once the elements of a page have been processed,
+        e.g. to write them to the database in one go
+        :type page_processor: function
         :return: the items processed
         """
 
-        done = False            # keep crunching until we are done
         rows_per_page = 100     # constant for the rows per page to query
         items = []              # the items we will return
         limit = 0               # max amount of items to be queried. to be determined after the first call
 
+        body = dict(body)
         body["row"] = rows_per_page
-        last_id = None
-
-        while not done:
-            if last_id is not None:
-                body["after_id"] = last_id
 
-            data = await self._query(method, body=body)
-            # determine the limit on the first run
-            if limit == 0:
-                limit = data["count"]
-                self.logger.info(f"About to fetch {limit} entries.")
+        async def pages():
+            # the cursor of the next page only depends on the last element, so pages can be fetched ahead
+            fetched = 0
+            while True:
+                data = await self._query(method, body=body, cache_ttl=LIST_PAGE_TTL)
+                yield data
+                elements = data[list_key]
+                fetched += len(elements) if elements else 0
+                if not elements or fetched >= data["count"]:
+                    return
+                body["after_id"] = last_id_deducer(elements[-1])
+                self.logger.debug(f"Last ID: {body['after_id']}")
+
+        async with Prefetcher(pages(), self.page_lookahead) as prefetched:
+            async for data in prefetched:
+                # determine the limit on the first run
                 if limit == 0:
-                    break
-            elements = data[list_key]
-
-            if elements is None:
-                self.logger.info("elements was empty. Stopping.")
-                break
-
-            for element in elements:
-                if filter is not None and filter(element):
-                    continue
-                item = element_processor(element)
-                if item:
-                    items.append(item)
-                elif stop_on_known_data:
-                    done = True
+                    limit = data["count"]
+                    self.logger.info(f"About to fetch {limit} entries.")
+                    if limit == 0:
+                        break
+                elements = data[list_key]
+
+                if not elements:
+                    self.logger.info("elements was empty. Stopping.")
                     break
 
-            num_items = len(items)
-            self.logger.debug(num_items)
-
-            if num_items >= limit:
-                done = True
-
-            last_id = last_id_deducer(elements[-1])
-            self.logger.debug(f"Last ID: {last_id}")
+                done = False
+                for element in elements:
+                    if filter is not None and filter(element):
+                        continue
+                    item = element_processor(element)
+                    if item:
+                        items.append(item)
+                    elif stop_on_known_data:
+                        done = True
+                        break
+                if page_processor is not None:
+                    await page_processor()
+
+                num_items = len(items)
+                self.logger.debug(num_items)
+
+                if done or num_items >= limit:
+                    break
 
         return items
 
-    def _create_extrinsic_metadata_processor(self, already_existing_extrinsic_pks: list):
+    async def _find_newest_block(self, method, list_key, body) -> int:
+        """
+        Finds the block of the newest element matching `body`.
+
+        :param method: Subscan.io API call method.
+        :type method: str
+        :param list_key: what's the subkey in the response that contains the list of elements
+        :type list_key: str
+        :param body: Subscan.io API call body
+        :type body: dict
+        :return: the block number, or None if there are no matching elements
+        :rtype: int
         """
-        Creates a method to process extrinsic metadata and stores it in the database.
+        probe = dict(body)
+        probe["row"] = 1
+        data = await self._query(method, body=probe, cache_ttl=LIST_PAGE_TTL)
+        if data["count"] == 0 or not data[list_key]:
+            return None
+        element = data[list_key][0]
+        if "block_num" in element:
+            return element["block_num"]
+        # events only carry the block number as part of their index
+        index = element.get("event_index") or element["extrinsic_index"]
+        return int(index.split("-")[0])
+
+    async def _iterate_pages_sharded(
+            self,
+            method,
+            element_processor,
+            list_key,
+            last_id_deducer,
+            shards,
+            body={},
+            filter=None,
+            stop_on_known_data=True,
+            page_processor=None,
+    ) -> list:
+        """Splits the block space into `shards` windows of equal size and pages through all of them concurrently
+        using `block_range`. The shared rate limiter keeps the combined request rate within the budget, so a backfill
+        runs at the full rate limit instead of being bound to the round-trip time of a single request.
 
-        :param already_existing_extrinsic_pks: list of primary keys of extrinsics that already exist in the database
-        :type already_existing_extrinsic_pks: list
-        :return: method to process extrinsic metadata and store it in the database
-        :rtype: function
+        :param method: Subscan.io API call method.
+        :type method: str
+        :param element_processor: method to process each transaction as it is received
+        :type element_processor: function
+        :param list_key: what's the subkey in the response that contains the list of elements
+        :type list_key: str
+        :param last_id_deducer: method to deduce the last id from the last element in the list
+        :type last_id_deducer: function
+        :param shards: the number of block windows to page through concurrently
+        :type shards: int
+        :param body: Subscan.io API call body. A `block_range` in the body limits the block space to shard.
+        :type body: dict
+        :param filter: method to determine whether certain extrinsics/events should be filtered out of the results
+        :type filter: function
+        :param stop_on_known_data: whether a shard stops iterating when it encounters a known element
+        :type stop_on_known_data: bool
+        :param page_processor: optional async function that is called once the elements of a page have been processed
+        :type page_processor: function
+        :return: the items processed, newest first like `_iterate_pages`
+        """
+        first_block = 0
+        if "block_range" in body:
+            first_block = int(body["block_range"].split("-")[0])
+
+        last_block = await self._find_newest_block(method, list_key, body)
+        if last_block is None:
+            self.logger.info("About to fetch 0 entries.")
+            return []
+
+        window = (last_block - first_block) // shards + 1
+        ranges = [(start, min(start + window - 1, last_block)) for start in range(first_block, last_block + 1, window)]
+        # newest window first, so that the merged items are in the same order as without sharding
+        ranges.reverse()
+        self.logger.info(f"Fetching blocks {first_block}-{last_block} in {len(ranges)} shards.")
+
+        tasks = []
+        for start, end in ranges:
+            shard_body = dict(body)
+            shard_body["block_range"] = f"{start}-{end}"
+            tasks.append(asyncio.ensure_future(self._iterate_pages(
+                method,
+                element_processor,
+                list_key,
+                last_id_deducer,
+                body=shard_body,
+                filter=filter,
+                stop_on_known_data=stop_on_known_data,
+                page_processor=page_processor,
+            )))
+        try:
+            results = await asyncio.gather(*tasks)
+        finally:
+            # if a shard fails, the others are cancelled and awaited before the error is raised, so that none of them
+            # keeps paging unsupervised
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        return [item for items in results for item in items]
+
+    def _create_extrinsic_metadata_processor(self, known_extrinsic_ids: set):
         """
+        Creates a method to process extrinsic metadata and a method to store the extrinsics of a page in the database.
+        The extrinsics are buffered until the page is complete and then written with a single statement.
+
+        :param known_extrinsic_ids: ids of the extrinsics of the chain that already exist in the database. Ids of new
+        extrinsics are added as they are buffered.
+        :type known_extrinsic_ids: set
+        :return: method to process extrinsic metadata and method to write the buffered extrinsics to the database
+        :rtype: tuple
+        """
+        rows = []
+
+        async def _extrinsic_metadata_page_processor():
+            """
+            Writes the extrinsics buffered from the current page to the database.
+            """
+            await self.db.write_many_async(Extrinsic, list(rows))
+            rows.clear()
 
         def _extrinsic_metadata_processor(raw_extrinsic_metadata: dict) -> Extrinsic:
             """
@@ -215,10 +413,11 @@ class SubscanWrapper:
 
             extrinsic_id = raw_extrinsic_metadata["extrinsic_index"]
 
-            if (self.chain, extrinsic_id) in already_existing_extrinsic_pks:
+            if extrinsic_id in known_extrinsic_ids:
                 return None
+            known_extrinsic_ids.add(extrinsic_id)
 
-            extrinsic = Extrinsic(
+            row = dict(
                 chain=self.chain,
                 id=extrinsic_id,
                 block_number=raw_extrinsic_metadata["block_num"],
@@ -235,21 +434,32 @@ class SubscanWrapper:
                 finalized=raw_extrinsic_metadata["finalized"],
             )
 
-            self.db.write_item(extrinsic)
-            return extrinsic
+            rows.append(row)
+            return Extrinsic(**row)
 
-        return _extrinsic_metadata_processor
+        return _extrinsic_metadata_processor, _extrinsic_metadata_page_processor
 
-    def _create_event_metadata_processor(self, already_existing_event_pks: list):
+    def _create_event_metadata_processor(self, known_event_ids: set):
         """
-        Creates a function that processes event metadata and stores it in the database.
-        `already_existing_event_pks` is used to prevent duplicate events from being written to the database.
-
-        :param already_existing_event_pks: a list of event primary keys that already exist in the database
-        :type already_existing_event_pks: list
-        :return: The function that can be used to process an element in the list
-        :rtype: function
+        Creates a function that processes event metadata and a function that stores the events of a page in the
+        database with a single statement.
+        `known_event_ids` is used to prevent duplicate events from being written to the database.
+
+        :param known_event_ids: ids of the events of the chain that already exist in the database. Ids of new events
+        are added as they are buffered.
+        :type known_event_ids: set
+        :return: The function that can be used to process an element in the list and the function that writes the
+        buffered events to the database
+        :rtype: tuple
         """
+        rows = []
+
+        async def _event_metadata_page_processor():
+            """
+            Writes the events buffered from the current page to the database.
+            """
+            await self.db.write_many_async(Event, list(rows))
+            rows.clear()
 
         def _event_metadata_processor(raw_event_metadata: dict) -> Event:
             """
@@ -262,13 +472,14 @@ class SubscanWrapper:
             """
             event_id = raw_event_metadata["event_index"]
 
-            if (self.chain, event_id) in already_existing_event_pks:
+            if event_id in known_event_ids:
                 return None
+            known_event_ids.add(event_id)
 
             # block_number is the string until the hyphen
             block_number = int(raw_event_metadata["event_index"].split("-")[0])
 
-            event = Event(
+            row = dict(
                 chain=self.chain,
                 id=event_id,
                 block_number=block_number,
@@ -279,10 +490,64 @@ class SubscanWrapper:
                 finalized=raw_event_metadata["finalized"],
             )
 
-            self.db.write_item(event)
-            return event
+            rows.append(row)
+            return Event(**row)
+
+        return _event_metadata_processor, _event_metadata_page_processor
+
+    def _extrinsic_row_from_raw_extrinsic(self, raw_extrinsic: dict) -> dict:
+        """
+        Builds the column values of an extrinsic from the raw extrinsic.
+
+        :param raw_extrinsic: The raw extrinsic
+        :type raw_extrinsic: dict
+        :return: The column values. The origin is missing if the extrinsic has no sender.
+        :rtype: dict
+        """
+        row = dict(
+            chain=self.chain,
+            id=raw_extrinsic["extrinsic_index"],
+            block_number=raw_extrinsic["block_num"],
+            block_timestamp=datetime.fromtimestamp(raw_extrinsic["block_timestamp"]),
+            module=raw_extrinsic["call_module"].lower(),
+            call=raw_extrinsic["call_module_function"].lower(),
+            nonce=raw_extrinsic["nonce"],
+            extrinsic_hash=raw_extrinsic["extrinsic_hash"],
+            success=raw_extrinsic["success"],
+            params=raw_extrinsic["params"],
+            fee=raw_extrinsic["fee"],
+            fee_used=raw_extrinsic["fee_used"],
+            error=raw_extrinsic["error"],
+            finalized=raw_extrinsic["finalized"],
+            tip=raw_extrinsic["tip"],
+        )
+        if raw_extrinsic["account_display"] is not None:
+            address = raw_extrinsic["account_display"]["address"]
+            row["origin_address"] = address
+            row["origin_public_key"] = ss58.ss58_decode(address)
+        return row
 
-        return _event_metadata_processor
+    def _event_row_from_raw_event(self, raw_event: dict) -> dict:
+        """
+        Builds the column values of an event from the raw event.
+
+        :param raw_event: The raw event
+        :type raw_event: dict
+        :return: The column values
+        :rtype: dict
+        """
+        return dict(
+            # Subscan API is delivering the extrinsic id instead of the event id
+            # in the event_index field. So let's work around that.
+            id=f'{raw_event["block_num"]}-{raw_event["event_idx"]}',
+            chain=self.chain,
+            block_number=raw_event["block_num"],
+            extrinsic_id=f'{raw_event["block_num"]}-{raw_event["extrinsic_idx"]}',
+            module=raw_event["module_id"].lower(),
+            event=raw_event["event_id"].lower(),
+            params=raw_event["params"],
+            finalized=raw_event["finalized"],
+        )
 
     def update_extrinsic_from_raw_extrinsic(self, extrinsic: Extrinsic, raw_extrinsic: dict):
         """
@@ -293,26 +558,8 @@ class SubscanWrapper:
         :param raw_extrinsic: The raw extrinsic
         :type raw_extrinsic: dict
         """
-
-        extrinsic.id = raw_extrinsic["extrinsic_index"]
-        extrinsic.chain = self.chain
-        extrinsic.block_number = raw_extrinsic["block_num"]
-        extrinsic.block_timestamp = datetime.fromtimestamp(raw_extrinsic["block_timestamp"])
-        extrinsic.module = raw_extrinsic["call_module"].lower()
-        extrinsic.call = raw_extrinsic["call_module_function"].lower()
-        if raw_extrinsic["account_display"] is not None:
-            address = raw_extrinsic["account_display"]["address"]
-            extrinsic.origin_address = address
-            extrinsic.origin_public_key = ss58.ss58_decode(address)
-        extrinsic.nonce = raw_extrinsic["nonce"]
-        extrinsic.extrinsic_hash = raw_extrinsic["extrinsic_hash"]
-        extrinsic.success = raw_extrinsic["success"]
-        extrinsic.params = raw_extrinsic["params"]
-        extrinsic.fee = raw_extrinsic["fee"]
-        extrinsic.fee_used = raw_extrinsic["fee_used"]
-        extrinsic.error = raw_extrinsic["error"]
-        extrinsic.finalized = raw_extrinsic["finalized"]
-        extrinsic.tip = raw_extrinsic["tip"]
+        for column, value in self._extrinsic_row_from_raw_extrinsic(raw_extrinsic).items():
+            setattr(extrinsic, column, value)
 
     def update_event_from_raw_event(self, event: Event, raw_event: dict):
         """
@@ -323,17 +570,8 @@ class SubscanWrapper:
         :param raw_event: The raw event
         :type raw_event: dict
         """
-
-        # Subscan API is delivering the extrinsic id instead of the event id
-        # in the event_index field. So let's work around that.
-        event.id = f'{raw_event["block_num"]}-{raw_event["event_idx"]}'
-        event.chain = self.chain
-        event.block_number = raw_event["block_num"]
-        event.extrinsic_id = f'{raw_event["block_num"]}-{raw_event["extrinsic_idx"]}'
-        event.module = raw_event["module_id"].lower()
-        event.event = raw_event["event_id"].lower()
-        event.params = raw_event["params"]
-        event.finalized = raw_event["finalized"]
+        for column, value in self._event_row_from_raw_event(raw_event).items():
+            setattr(event, column, value)
 
     async def fetch_extrinsic_metadata(self, module, call, config: ScrapeConfig) -> list:
         """
@@ -350,25 +588,39 @@ class SubscanWrapper:
         """
         self.logger.info(f"Fetching extrinsic {module}.{call} from {self.endpoint}")
 
-        # create a list of already fetched extrinsics
-        already_fetched_extrinsics = self.db.query_extrinsics(chain=self.chain, module=module, call=call).all()
-        already_fetched_extrinsic_pks = [(e.chain, e.id) for e in already_fetched_extrinsics]
+        # the ids of the already fetched extrinsics
+        known_extrinsic_ids = self.db.query_extrinsic_ids(chain=self.chain, module=module, call=call)
 
         body = {"module": module, "call": call}
         if config.params is not None:
             body.update(config.params)
 
-        items = await self._iterate_pages(
-            self._api_method_extrinsics,
-            self._create_extrinsic_metadata_processor(already_fetched_extrinsic_pks),
-            last_id_deducer=self._last_id_deducer,
-            list_key="extrinsics",
-            body=body,
-            filter=config.filter,
-            stop_on_known_data=config.stop_on_known_data,
-        )
+        element_processor, page_processor = self._create_extrinsic_metadata_processor(known_extrinsic_ids)
+        if config.shards > 1:
+            items = await self._iterate_pages_sharded(
+                self._api_method_extrinsics,
+                element_processor,
+                last_id_deducer=self._last_id_deducer,
+                list_key="extrinsics",
+                shards=config.shards,
+                body=body,
+                filter=config.filter,
+                stop_on_known_data=config.stop_on_known_data,
+                page_processor=page_processor,
+            )
+        else:
+            items = await self._iterate_pages(
+                self._api_method_extrinsics,
+                element_processor,
+                last_id_deducer=self._last_id_deducer,
+                list_key="extrinsics",
+                body=body,
+                filter=config.filter,
+                stop_on_known_data=config.stop_on_known_data,
+                page_processor=page_processor,
+            )
 
-        self.db.flush()
+        await self.db.flush_async()
 
         if config.auto_hydrate is True:
             self.logger.info(f"Hydrating extrinsics {module}.{call} from {self.endpoint}")
@@ -389,60 +641,50 @@ class SubscanWrapper:
         :rtype: list
         """
 
-        items = []
+        written_ids = []
 
         self.logger.info("Building list of extrinsics to fetch...")
 
-        already_fetched_extrinsics = self.db.query_extrinsics(chain=self.chain, extrinsic_ids=extrinsic_indexes).all()
-        already_fetched_extrinsic_ids = [e.id for e in already_fetched_extrinsics]
-
         # if we do not update existing items, we only need to fetch the ones that are not in the db
         if update_existing is False:
-            extrinsic_indexes = already_fetched_extrinsic_ids
+            extrinsic_indexes = list(self.db.query_extrinsic_ids(chain=self.chain, extrinsic_ids=extrinsic_indexes))
 
         self.logger.info(f"Fetching {len(extrinsic_indexes)} extrinsics from {self.endpoint}")
 
         method = self._api_method_extrinsic
 
-        async with httpx.AsyncClient() as client:
-            while len(extrinsic_indexes) > 0:
-                # take up to 1000 extrinsics at a time
-                batch = extrinsic_indexes[:1000]
-                if len(batch) == 0:
-                    break
-
-                futures = []
-                for extrinsic_index in batch:
-                    body = {"extrinsic_index": extrinsic_index}
-                    task = self._query(method, body=body, client=client)
-
-                    self.logger.debug(f"Spawning task for {extrinsic_index}")
-                    future = asyncio.ensure_future(task)
-                    await asyncio.sleep(1 / MAX_CALLS_PER_SEC)
-                    futures.append(future)
+        for batch_start in range(0, len(extrinsic_indexes), 1000):
+            # take up to 1000 extrinsics at a time
+            batch = extrinsic_indexes[batch_start:batch_start + 1000]
 
-                raw_extrinsics = await asyncio.gather(*futures)
+            futures = []
+            for extrinsic_index in batch:
+                body = {"extrinsic_index": extrinsic_index}
+                task = self._query(method, body=body, cache_ttl=_finality_aware_ttl)
 
-                for raw_extrinsic in raw_extrinsics:
-                    extrinsic_id = self._extrinsic_index_deducer(raw_extrinsic)
+                self.logger.debug(f"Spawning task for {extrinsic_index}")
+                future = asyncio.ensure_future(task)
+                futures.append(future)
 
-                    if extrinsic_id in already_fetched_extrinsic_ids:
-                        extrinsic = self.db.query_extrinsic(self.chain, extrinsic_id)
-                    else:
-                        extrinsic = Extrinsic()
-                    self.update_extrinsic_from_raw_extrinsic(extrinsic, raw_extrinsic)
+            raw_extrinsics = await asyncio.gather(*futures)
 
-                    self.db.write_item(extrinsic)
-                    items.append(extrinsic)
+            # new and already stored extrinsics are written with the same upsert, without loading them first
+            rows = [self._extrinsic_row_from_raw_extrinsic(raw_extrinsic) for raw_extrinsic in raw_extrinsics]
+            await self.db.write_many_async(Extrinsic, rows, upsert=True)
+            written_ids.extend(row["id"] for row in rows)
 
-                self.db.flush()
+            remaining = len(extrinsic_indexes) - batch_start - len(batch)
+            self.logger.info(f"Done fetching {len(written_ids)} extrinsics. {remaining} remaining.")
 
-                for index in batch:
-                    extrinsic_indexes.remove(index)
+        await self.db.flush_async()
 
-                self.logger.info(f"Done fetching {len(items)} extrinsics. {len(extrinsic_indexes)} remaining.")
-
-        return items
+        # return the stored extrinsics, which also carry the columns that only the list endpoint provides
+        stored_extrinsics = {}
+        for batch_start in range(0, len(written_ids), 1000):
+            batch_ids = written_ids[batch_start:batch_start + 1000]
+            query = self.db.query_extrinsics(chain=self.chain, extrinsic_ids=batch_ids)
+            stored_extrinsics.update((extrinsic.id, extrinsic) for extrinsic in query.populate_existing())
+        return [stored_extrinsics[extrinsic_id] for extrinsic_id in written_ids if extrinsic_id in stored_extrinsics]
 
     async def fetch_event_metadata(self, module, call, config) -> list:
         """
@@ -461,25 +703,39 @@ class SubscanWrapper:
 
         self.logger.info(f"Fetching events {module}.{call} from {self.endpoint}")
 
-        # create a list of already fetched event ids
-        already_fetched_events = self.db.query_events(chain=self.chain, module=module, event=call).all()
-        already_fetched_event_pks = [(e.chain, e.id) for e in already_fetched_events]
+        # the ids of the already fetched events
+        known_event_ids = self.db.query_event_ids(chain=self.chain, module=module, event=call)
 
         body = {"module": module, self._api_method_events_call: call}
         if config.params is not None:
             body.update(config.params)
 
-        items = await self._iterate_pages(
-            self._api_method_events,
-            self._create_event_metadata_processor(already_fetched_event_pks),
-            last_id_deducer=self._last_id_deducer,
-            list_key="events",
-            body=body,
-            filter=config.filter,
-            stop_on_known_data=config.stop_on_known_data,
-        )
+        element_processor, page_processor = self._create_event_metadata_processor(known_event_ids)
+        if config.shards > 1:
+            items = await self._iterate_pages_sharded(
+                self._api_method_events,
+                element_processor,
+                last_id_deducer=self._last_id_deducer,
+                list_key="events",
+                shards=config.shards,
+                body=body,
+                filter=config.filter,
+                stop_on_known_data=config.stop_on_known_data,
+                page_processor=page_processor,
+            )
+        else:
+            items = await self._iterate_pages(
+                self._api_method_events,
+                element_processor,
+                last_id_deducer=self._last_id_deducer,
+                list_key="events",
+                body=body,
+                filter=config.filter,
+                stop_on_known_data=config.stop_on_known_data,
+                page_processor=page_processor,
+            )
 
-        self.db.flush()
+        await self.db.flush_async()
 
         if config.auto_hydrate is True:
             self.logger.info(f"Hydrating events from {module}.{call} from {self.endpoint}")
@@ -500,53 +756,43 @@ class SubscanWrapper:
         :rtype: list
         """
 
-        items = []
-
-        already_fetched_events = self.db.query_events(chain=self.chain, event_ids=event_indexes).all()
-        already_fetched_event_ids = [e.id for e in already_fetched_events]
+        written_ids = []
 
         # if we do not update existing items, we only need to fetch the ones that are not in the db
         if update_existing is False:
-            event_indexes = already_fetched_event_ids
+            event_indexes = list(self.db.query_event_ids(chain=self.chain, event_ids=event_indexes))
 
         self.logger.info(f"Fetching {len(event_indexes)} events from {self.endpoint}")
 
         method = self._api_method_event
 
-        async with httpx.AsyncClient() as client:
-            while len(event_indexes) > 0:
-                # take up to 1000 extrinsics at a time
-                batch = event_indexes[:1000]
-                if len(batch) == 0:
-                    break
-
-                futures = []
-                for event_index in batch:
-                    body = {"event_index": event_index}
-                    task = self._query(method, body=body)
+        for batch_start in range(0, len(event_indexes), 1000):
+            # take up to 1000 events at a time
+            batch = event_indexes[batch_start:batch_start + 1000]
 
-                    self.logger.debug(f"Spawning task for {event_index}")
-                    future = asyncio.ensure_future(task)
-                    await asyncio.sleep(1 / MAX_CALLS_PER_SEC)
-                    futures.append(future)
+            futures = []
+            for event_index in batch:
+                body = {"event_index": event_index}
+                task = self._query(method, body=body, cache_ttl=_finality_aware_ttl)
 
-                raw_events = await asyncio.gather(*futures)
+                self.logger.debug(f"Spawning task for {event_index}")
+                future = asyncio.ensure_future(task)
+                futures.append(future)
 
-                for raw_event in raw_events:
-                    event_id = self._event_index_deducer(raw_event)
+            raw_events = await asyncio.gather(*futures)
 
-                    if event_id in already_fetched_event_ids:
-                        event = self.db.query_event(self.chain, event_id)
-                    else:
-                        event = Event()
-                    self.update_event_from_raw_event(event, raw_event)
+            # new and already stored events are written with the same upsert, without loading them first
+            rows = [self._event_row_from_raw_event(raw_event) for raw_event in raw_events]
+            await self.db.write_many_async(Event, rows, upsert=True)
+            written_ids.extend(row["id"] for row in rows)
 
-                    self.db.write_item(event)
-                    items.append(event)
+        await self.db.flush_async()
 
-                self.db.flush()
-
-                for id in batch:
-                    event_indexes.remove(id)
-
-        return items
+        # return the stored events, which also carry the columns that only the list endpoint provides, like the
+        # block timestamp
+        stored_events = {}
+        for batch_start in range(0, len(written_ids), 1000):
+            batch_ids = written_ids[batch_start:batch_start + 1000]
+            query = self.db.query_events(chain=self.chain, event_ids=batch_ids)
+            stored_events.update((event.id, event) for event in query.populate_existing())
+        return [stored_events[event_id] for event_id in written_ids if event_id in stored_events]
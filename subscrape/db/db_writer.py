@@ -0,0 +1,180 @@
+__author__ = 'Tommi Enenkel @alice_und_bob'
+
+import asyncio
+import concurrent.futures
+import logging
+import queue
+import threading
+import time
+from sqlalchemy.orm import Session
+
+# How many batches may wait for the writer before the producers are paused.
+DEFAULT_MAX_PENDING_BATCHES = 20
+# The writer commits once this many rows are uncommitted...
+DEFAULT_COMMIT_ROWS = 5000
+# ...or once the oldest uncommitted row is this many seconds old.
+DEFAULT_COMMIT_INTERVAL = 1.0
+
+_STOP = object()
+
+
+class DBWriter:
+    """
+    Write-behind queue of a `SubscrapeDB`. A dedicated thread with its own session executes the bulk writes and
+    commits them in batches, so a slow commit never blocks the event loop and the requests in flight. If the writer
+    falls behind by more than `max_pending_batches` batches, `write_many()` waits until it catches up, which slows
+    the pagers down instead of piling up rows in memory.
+
+    The writer is the only one writing to the database, so it never waits for a lock held by another session. If a
+    write fails, the rows of the failed transaction are lost, but the writer keeps writing the rows queued after them.
+    The error is raised by the next call of `write_many()`, `submit()`, `flush()` or `close()`.
+    """
+
+    def __init__(self, db, max_pending_batches: int = DEFAULT_MAX_PENDING_BATCHES,
+                 commit_rows: int = DEFAULT_COMMIT_ROWS, commit_interval: float = DEFAULT_COMMIT_INTERVAL):
+        """
+        :param db: the database to write to
+        :type db: SubscrapeDB
+        :param max_pending_batches: maximum number of batches waiting to be written
+        :type max_pending_batches: int
+        :param commit_rows: number of uncommitted rows that triggers a commit
+        :type commit_rows: int
+        :param commit_interval: seconds after which uncommitted rows are committed
+        :type commit_interval: float
+        """
+        self.logger = logging.getLogger(__name__)
+        self._db = db
+        self._session = Session(bind=db._engine)
+        self.max_pending_batches = max_pending_batches
+        self.commit_rows = commit_rows
+        self.commit_interval = commit_interval
+        self._queue = queue.Queue()
+        self._slots = None      # created on first use, so that it belongs to the running event loop
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name="subscrape-db-writer", daemon=True)
+        self._thread.start()
+
+    async def write_many(self, model, rows: list, upsert: bool = False):
+        """
+        Queues rows to be written like `SubscrapeDB.write_many()`. Waits while the writer is behind.
+
+        :param model: The ORM class of the table, e.g. `Extrinsic`
+        :type model: type
+        :param rows: dicts of column values, including the primary key. The list must not be changed afterwards.
+        :type rows: list
+        :param upsert: Whether to update the given columns of rows that already exist
+        :type upsert: bool
+        """
+        self._raise_error()
+        if len(rows) == 0:
+            return
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_pending_batches)
+        await self._slots.acquire()
+        loop = asyncio.get_running_loop()
+        self._queue.put((model, rows, upsert, lambda: loop.call_soon_threadsafe(self._slots.release)))
+        self._raise_error()
+
+    def submit(self, model, rows: list, upsert: bool = False):
+        """
+        Queues rows to be written like `write_many()`, but without waiting. Meant for the occasional single row, e.g.
+        an ABI or a receipt, that is written outside of the pagers.
+
+        :param model: The ORM class of the table, e.g. `Extrinsic`
+        :type model: type
+        :param rows: dicts of column values, including the primary key. The list must not be changed afterwards.
+        :type rows: list
+        :param upsert: Whether to update the given columns of rows that already exist
+        :type upsert: bool
+        """
+        self._raise_error()
+        if len(rows) > 0:
+            self._queue.put((model, rows, upsert, lambda: None))
+
+    async def flush(self):
+        """
+        Waits until everything queued so far has been committed.
+        """
+        await asyncio.wrap_future(self._queue_flush())
+
+    def flush_blocking(self):
+        """
+        Like `flush()`, but blocks the calling thread.
+        """
+        self._queue_flush().result()
+
+    def close(self):
+        """
+        Commits everything queued so far and stops the writer thread. Raises the error if a write failed.
+        """
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
+        self._session.close()
+        self._raise_error()
+
+    def _queue_flush(self) -> concurrent.futures.Future:
+        self._raise_error()
+        committed = concurrent.futures.Future()
+        self._queue.put(committed)
+        return committed
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def _run(self):
+        uncommitted_rows = 0
+        last_commit = time.monotonic()
+
+        def commit():
+            nonlocal uncommitted_rows, last_commit
+            if uncommitted_rows > 0:
+                self._session.commit()
+            uncommitted_rows = 0
+            last_commit = time.monotonic()
+
+        while True:
+            timeout = None
+            if uncommitted_rows > 0:
+                timeout = max(0.0, last_commit + self.commit_interval - time.monotonic())
+            try:
+                job = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                job = None
+
+            try:
+                if job is _STOP:
+                    commit()
+                    return
+                elif isinstance(job, concurrent.futures.Future):
+                    commit()
+                    if self._error is not None:
+                        job.set_exception(self._error)
+                    else:
+                        job.set_result(None)
+                elif job is not None:
+                    model, rows, upsert, release = job
+                    try:
+                        if uncommitted_rows == 0:
+                            last_commit = time.monotonic()  # the commit interval starts with the oldest row
+                        # counted before the write, so that a failure reports the rows of the whole transaction
+                        uncommitted_rows += len(rows)
+                        self._db._write_rows(self._session, model, rows, upsert)
+                    finally:
+                        release()
+                if uncommitted_rows >= self.commit_rows or \
+                        (uncommitted_rows > 0 and time.monotonic() - last_commit >= self.commit_interval):
+                    commit()
+            except Exception as e:
+                # the rows of the failed transaction are lost. report it to the producers, but keep writing the rows
+                # that are queued after them
+                self.logger.error(f"Writing to the database failed, {uncommitted_rows} rows are lost: {e}")
+                self._session.rollback()
+                uncommitted_rows = 0
+                if self._error is None:
+                    self._error = e
+                if isinstance(job, concurrent.futures.Future) and not job.done():
+                    job.set_exception(e)
+                elif job is _STOP:
+                    return
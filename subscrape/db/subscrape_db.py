@@ -1,11 +1,19 @@
 __author__ = 'Tommi Enenkel @alice_und_bob'
 
+import datetime
+import json
 import os
 import logging
-from sqlalchemy import create_engine, Column, Integer, String, Boolean, JSON, DateTime, ForeignKey, ForeignKeyConstraint
+import zlib
+from sqlalchemy import create_engine, Column, Integer, String, Boolean, JSON, DateTime, ForeignKey, ForeignKeyConstraint, \
+    Index, LargeBinary, Text, insert, inspect, text
 from sqlalchemy.orm import Session, Query, relationship
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.event import listen
 from sqlalchemy_utils import database_exists, create_database
+from subscrape.apis import json_decoder
+from subscrape.db.db_writer import DBWriter
 
 Base = declarative_base()
 
@@ -37,6 +45,13 @@ class Extrinsic(Base):
     finalized = Column(Boolean)
     tip = Column(Integer)
 
+    __table_args__ = (
+        # the access paths of the scrapers and of the analytics
+        Index("ix_extrinsics_chain_module_call", chain, module, call),
+        Index("ix_extrinsics_chain_block_number", chain, block_number),
+        Index("ix_extrinsics_chain_block_timestamp", chain, block_timestamp),
+    )
+
     events = relationship("Event", back_populates="extrinsic")
 
 
@@ -55,11 +70,49 @@ class Event(Base):
     __table_args__ = (
         ForeignKeyConstraint([extrinsic_id, chain],
                              [Extrinsic.id, Extrinsic.chain]),
+        Index("ix_events_chain_module_event", chain, module, event),
+        Index("ix_events_chain_block_number", chain, block_number),
+        Index("ix_events_chain_block_timestamp", chain, block_timestamp),
+        Index("ix_events_chain_extrinsic_id", chain, extrinsic_id),
     )
 
     extrinsic = relationship("Extrinsic", back_populates="events")
 
 
+class ContractAbi(Base):
+    __tablename__ = 'contract_abis'
+    chain = Column(String(50), primary_key=True)
+    address = Column(String(42), primary_key=True)     # lower case
+    abi = Column(Text)                                  # None if the explorer has no ABI for the contract
+    retry_after = Column(DateTime)                      # when to ask again for an ABI that was not available
+
+
+class TransactionReceipt(Base):
+    __tablename__ = 'transaction_receipts'
+    chain = Column(String(50), primary_key=True)
+    tx_hash = Column(String(66), primary_key=True)
+    block_number = Column(Integer)
+    receipt = Column(LargeBinary)   # zlib compressed JSON of the whole receipt, including the logs
+
+
+class TokenInfo(Base):
+    __tablename__ = 'token_infos'
+    chain = Column(String(50), primary_key=True)
+    address = Column(String(42), primary_key=True)     # lower case
+    is_token = Column(Boolean)                          # False if the contract is known not to be a token
+    name = Column(String(100))
+    symbol = Column(String(50))
+    decimals = Column(String(10))
+    retry_after = Column(DateTime)                      # when to check again whether a contract that isn't one is a token
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")     # in WAL mode, this only risks the last commits on a power loss
+    cursor.close()
+
+
 class SubscrapeDB:
     """
     This class is used to support online scraping of various types of data.
@@ -69,35 +122,112 @@ class SubscrapeDB:
     At the end of the process, flush_<type>() is called to make sure the state is properly saved.
     """
 
-    def __init__(self, connection_string="sqlite:///data/cache/default.db"):
+    def __init__(self, connection_string="sqlite:///data/cache/default.db", background_writer: bool = False):
+        """
+        :param connection_string: The SQLAlchemy connection string
+        :type connection_string: str
+        :param background_writer: Whether `write_many_async()` hands the rows to a `DBWriter` thread
+        :type background_writer: bool
+        """
         self.logger = logging.getLogger(__name__)
         self._engine = create_engine(connection_string)
+        if self._engine.dialect.name == "sqlite":
+            # readers and the writer thread do not block each other in WAL mode
+            listen(self._engine, "connect", _set_sqlite_pragmas)
 
         if not database_exists(self._engine.url):
             # ensure that the folder exists
             os.makedirs(os.path.dirname(connection_string.replace("sqlite:///", "")), exist_ok=True)
             create_database(self._engine.url)
-            self._setup_db()
+        # also adds tables that were introduced after the database was created
+        self._setup_db()
 
-        self._session = Session(bind=self._engine)
+        # the scraped items are handed to the caller, so they have to stay readable after later commits and closing
+        self._session = Session(bind=self._engine, expire_on_commit=False)
+        self._writer = DBWriter(self) if background_writer else None
+        self._checked_query_plans = set()
 
     def _setup_db(self):
         """
-        Creates the database tables if they do not exist.
+        Creates the database tables if they do not exist. Indexes that were introduced after a table was created are
+        added to it.
         """
         Base.metadata.create_all(self._engine)
 
+        inspector = inspect(self._engine)
+        for table in Base.metadata.sorted_tables:
+            existing_indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing_indexes:
+                    self.logger.info(f"Creating index {index.name}. This can take a while on a large database.")
+                    index.create(self._engine)
+
+    def explain(self, query: Query) -> list:
+        """
+        Returns the query plan of a query. Only supported on SQLite and PostgreSQL.
+
+        :param query: The query to explain
+        :type query: Query
+        :return: The lines of the query plan, or an empty list on other databases
+        :rtype: list
+        """
+        dialect = self._engine.dialect.name
+        if dialect == "sqlite":
+            explain = "EXPLAIN QUERY PLAN"
+            detail_column = -1  # the rows are (id, parent, notused, detail)
+        elif dialect == "postgresql":
+            explain = "EXPLAIN"
+            detail_column = 0
+        else:
+            return []
+        sql = query.statement.compile(self._engine, compile_kwargs={"literal_binds": True})
+        return [row[detail_column] for row in self._session.execute(text(f"{explain} {sql}"))]
+
+    def _check_query_plan(self, query: Query, shape: tuple):
+        """
+        Warns if a filtered query has to read a whole table, which hints at a missing index. Every shape of query, i.e.
+        table and set of filters, is only checked once.
+
+        :param query: The query to check
+        :type query: Query
+        :param shape: The table and the names of the filters of the query
+        :type shape: tuple
+        """
+        if shape in self._checked_query_plans:
+            return
+        self._checked_query_plans.add(shape)
+        for line in self.explain(query):
+            # SQLite: "SCAN extrinsics" or "SCAN TABLE extrinsics", PostgreSQL: "Seq Scan on extrinsics"
+            if line.startswith("SCAN") or "Seq Scan" in line:
+                self.logger.warning(f"Querying {shape[0]} by {', '.join(shape[1:])} reads the whole table: {line}")
+
     def flush(self):
         """
-        Flush the extrinsics to the database.
+        Flush the extrinsics to the database. With a background writer, blocks until it has committed everything
+        queued so far.
         """
+        if self._writer is not None:
+            self._writer.flush_blocking()
+        self._session.commit()
+
+    async def flush_async(self):
+        """
+        Flush the extrinsics to the database. With a background writer, waits until it has committed everything queued
+        so far, without blocking the event loop.
+        """
+        if self._writer is not None:
+            await self._writer.flush()
         self._session.commit()
 
     def close(self):
         """
         Close the database connection.
         """
-        self._session.close()
+        try:
+            if self._writer is not None:
+                self._writer.close()
+        finally:
+            self._session.close()
 
     def write_item(self, item: Base):
         """
@@ -106,8 +236,87 @@ class SubscrapeDB:
         :param item: The item to write
         :type item: Base
         """
-        self._session.add(item)
-        self._extrinsics_storage_managers = {}
+        if self._writer is not None:
+            row = {column.key: getattr(item, column.key) for column in inspect(type(item)).column_attrs}
+            self._writer.submit(type(item), [row])
+        else:
+            self._session.add(item)
+
+    def write_many(self, model, rows: list, upsert: bool = False):
+        """
+        Write many rows of a table in one statement, without building ORM objects. On SQLite and PostgreSQL, rows
+        whose primary key already exists are skipped, or updated if `upsert` is set. With a background writer, the
+        rows are handed to its thread without waiting. Call `flush()` to persist them.
+
+        :param model: The ORM class of the table, e.g. `Extrinsic`
+        :type model: type
+        :param rows: dicts of column values, including the primary key. Rows with different keys are written with one
+        statement per set of keys.
+        :type rows: list
+        :param upsert: Whether to update the given columns of rows that already exist
+        :type upsert: bool
+        """
+        if self._writer is not None:
+            # the writer is the only session writing to the database, so that the sessions do not lock each other out
+            self._writer.submit(model, rows, upsert)
+        else:
+            self._write_rows(self._session, model, rows, upsert)
+
+    async def write_many_async(self, model, rows: list, upsert: bool = False):
+        """
+        Like `write_many()`, but with a background writer the rows are written and committed by its thread. Waits while
+        the writer is behind. Call `flush_async()` to wait until they are committed.
+
+        :param model: The ORM class of the table, e.g. `Extrinsic`
+        :type model: type
+        :param rows: dicts of column values, including the primary key. The list must not be changed afterwards.
+        :type rows: list
+        :param upsert: Whether to update the given columns of rows that already exist
+        :type upsert: bool
+        """
+        if self._writer is not None:
+            await self._writer.write_many(model, rows, upsert)
+        else:
+            self.write_many(model, rows, upsert)
+
+    def _write_rows(self, session: Session, model, rows: list, upsert: bool):
+        """
+        Writes rows with the given session. See `write_many()`.
+        """
+        rows_by_columns = {}
+        for row in rows:
+            rows_by_columns.setdefault(tuple(row), []).append(row)
+        for same_column_rows in rows_by_columns.values():
+            self._write_same_columns(session, model, same_column_rows, upsert)
+
+    def _write_same_columns(self, session: Session, model, rows: list, upsert: bool):
+        """
+        Writes rows that all have the same keys. See `write_many()`.
+        """
+        table = model.__table__
+        dialect = self._engine.dialect.name
+        if dialect == "sqlite":
+            statement = sqlite.insert(table)
+        elif dialect == "postgresql":
+            statement = postgresql.insert(table)
+        else:
+            # no portable `on conflict`. fall back to the ORM for upserts
+            if upsert:
+                for row in rows:
+                    session.merge(model(**row))
+            else:
+                session.execute(insert(table), rows)
+            return
+
+        primary_key = [column.name for column in table.primary_key.columns]
+        updated_columns = [column for column in rows[0] if column not in primary_key]
+        if upsert and len(updated_columns) > 0:
+            statement = statement.on_conflict_do_update(
+                index_elements=primary_key,
+                set_={column: statement.excluded[column] for column in updated_columns})
+        else:
+            statement = statement.on_conflict_do_nothing(index_elements=primary_key)
+        session.execute(statement, rows)
 
     """ # Extrinsics """
 
@@ -134,8 +343,31 @@ class SubscrapeDB:
         if extrinsic_ids is not None:
             query = query.filter(Extrinsic.id.in_(extrinsic_ids))
 
+        filters = tuple(name for name, value in [("chain", chain), ("module", module), ("call", call),
+                                                 ("extrinsic_ids", extrinsic_ids)] if value is not None)
+        if len(filters) > 0:
+            self._check_query_plan(query, ("extrinsics",) + filters)
         return query
 
+    def query_extrinsic_ids(self, chain: str, module: str = None, call: str = None, extrinsic_ids: list = None) -> set:
+        """
+        Returns the ids of the stored extrinsics of a chain. Only the primary key column is read, so this is cheap
+        even for millions of extrinsics.
+
+        :param chain: The chain to filter for
+        :type chain: str
+        :param module: The module to filter for
+        :type module: str
+        :param call: The call to filter for
+        :type call: str
+        :param extrinsic_ids: The ids of the extrinsics to filter for
+        :type extrinsic_ids: list
+        :return: The ids, like "123456-2"
+        :rtype: set
+        """
+        query = self.query_extrinsics(chain, module, call, extrinsic_ids).with_entities(Extrinsic.id)
+        return {extrinsic_id for (extrinsic_id,) in query}
+
     def query_extrinsic(self, chain: str, extrinsic_id: str) -> Extrinsic:
         """
         Returns the extrinsic with the given id.
@@ -175,8 +407,32 @@ class SubscrapeDB:
             query = query.filter(Event.event == event)
         if event_ids is not None:
             query = query.filter(Event.id.in_(event_ids))
+
+        filters = tuple(name for name, value in [("chain", chain), ("module", module), ("event", event),
+                                                 ("event_ids", event_ids)] if value is not None)
+        if len(filters) > 0:
+            self._check_query_plan(query, ("events",) + filters)
         return query
 
+    def query_event_ids(self, chain: str, module: str = None, event: str = None, event_ids: list = None) -> set:
+        """
+        Returns the ids of the stored events of a chain. Only the primary key column is read, so this is cheap even
+        for millions of events.
+
+        :param chain: The chain to filter for
+        :type chain: str
+        :param module: The module to filter for
+        :type module: str
+        :param event: The event to filter for
+        :type event: str
+        :param event_ids: The ids of the events to filter for
+        :type event_ids: list
+        :return: The ids, like "123456-12"
+        :rtype: set
+        """
+        query = self.query_events(chain, module, event, event_ids).with_entities(Event.id)
+        return {event_id for (event_id,) in query}
+
     def query_event(self, chain: str, event_id: str) -> Event:
         """
         Reads an event with a given id from the database.
@@ -191,3 +447,105 @@ class SubscrapeDB:
         result = self._session.query(Event).get((chain, event_id))
         return result
 
+    """ # Contract ABIs """
+
+    def query_contract_abi(self, chain: str, address: str) -> ContractAbi:
+        """
+        Reads the stored ABI of a contract.
+
+        :param chain: The chain of the contract
+        :type chain: str
+        :param address: The lower case address of the contract
+        :type address: str
+        :return: The stored ABI, or None if the contract has never been looked up
+        :rtype: ContractAbi
+        """
+        # rows are written by row and not through the session, so the session could hold an outdated object
+        return self._session.get(ContractAbi, (chain, address), populate_existing=True)
+
+    def write_contract_abi(self, chain: str, address: str, abi: str, retry_after: datetime.datetime = None):
+        """
+        Stores the ABI of a contract, or the fact that it is not available. Call `flush()` to persist it.
+
+        :param chain: The chain of the contract
+        :type chain: str
+        :param address: The lower case address of the contract
+        :type address: str
+        :param abi: The ABI, or None if the explorer has no ABI for the contract
+        :type abi: str
+        :param retry_after: For a missing ABI, when to ask the explorer again
+        :type retry_after: datetime.datetime
+        """
+        self.write_many(ContractAbi, [dict(chain=chain, address=address, abi=abi, retry_after=retry_after)],
+                        upsert=True)
+
+    """ # Transaction receipts """
+
+    def query_transaction_receipt(self, chain: str, tx_hash: str) -> dict:
+        """
+        Reads the stored receipt of an EVM transaction.
+
+        :param chain: The chain of the transaction
+        :type chain: str
+        :param tx_hash: The hash of the transaction
+        :type tx_hash: str
+        :return: The receipt as returned by `eth_getTransactionReceipt`, or None if it is not stored
+        :rtype: dict
+        """
+        stored_receipt = self._session.query(TransactionReceipt).get((chain, tx_hash))
+        if stored_receipt is None:
+            return None
+        return json_decoder.loads(zlib.decompress(stored_receipt.receipt))
+
+    def write_transaction_receipt(self, chain: str, tx_hash: str, receipt: dict):
+        """
+        Stores the receipt of a mined EVM transaction. Receipts are immutable, so they are never updated. Call
+        `flush()` to persist it.
+
+        :param chain: The chain of the transaction
+        :type chain: str
+        :param tx_hash: The hash of the transaction
+        :type tx_hash: str
+        :param receipt: The receipt as returned by `eth_getTransactionReceipt`
+        :type receipt: dict
+        """
+        compressed_receipt = zlib.compress(json.dumps(receipt, separators=(",", ":")).encode("UTF-8"))
+        block_number = int(receipt['blockNumber'], 16)
+        self.write_many(TransactionReceipt, [dict(chain=chain, tx_hash=tx_hash, block_number=block_number,
+                                                  receipt=compressed_receipt)])
+
+    """ # Token infos """
+
+    def query_token_infos(self, chain: str) -> Query:
+        """
+        Returns a query object for the stored token infos of a chain, including the contracts that are known not to be
+        tokens.
+
+        :param chain: The chain to filter for
+        :type chain: str
+        :return: The query object
+        :rtype: Query
+        """
+        return self._session.query(TokenInfo).filter(TokenInfo.chain == chain).populate_existing()
+
+    def write_token_info(self, chain: str, address: str, token_info: dict, retry_after: datetime.datetime = None):
+        """
+        Stores the basic info of a token contract, or the fact that the contract is not a token. Call `flush()` to
+        persist it.
+
+        :param chain: The chain of the contract
+        :type chain: str
+        :param address: The lower case address of the contract
+        :type address: str
+        :param token_info: dict with the `name`, `symbol` and `decimals` of the token, or None if it is not a token
+        :type token_info: dict
+        :param retry_after: For a contract that is not a token, when to ask the explorer again
+        :type retry_after: datetime.datetime
+        """
+        if token_info is None:
+            row = dict(chain=chain, address=address, is_token=False, name=None, symbol=None, decimals=None,
+                       retry_after=retry_after)
+        else:
+            row = dict(chain=chain, address=address, is_token=True, name=token_info['name'],
+                       symbol=token_info['symbol'], decimals=token_info['decimals'], retry_after=None)
+        self.write_many(TokenInfo, [row], upsert=True)
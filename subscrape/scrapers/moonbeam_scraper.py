@@ -1,6 +1,8 @@
 __author__ = 'spazcoin@gmail.com @spazvt, Tommi Enenkel @alice_und_bob'
 
-from datetime import datetime
+import asyncio
+import collections
+from datetime import datetime, timedelta
 import eth_utils
 import logging
 from numpy.core.defchararray import lower
@@ -8,6 +10,10 @@ import pandas
 from pathlib import Path
 import simplejson as json
 
+from subscrape.apis.response_cache import UNAVAILABLE_TTL
+from subscrape.apis.retry_policy import ExplorerError
+from subscrape.apis.single_flight import SingleFlight
+from subscrape.db.subscrape_db import SubscrapeDB
 from subscrape.decode.decode_evm_transaction import decode_tx
 from subscrape.decode.decode_evm_log import decode_log
 
@@ -15,19 +21,65 @@ from subscrape.decode.decode_evm_log import decode_log
 class MoonbeamScraper:
     """Scrape the Moonbeam or Moonriver chains for transactions/accounts of interest."""
 
-    def __init__(self, db_path, moonscan_api, blockscout_api, chain_name):
+    # contract methods whose transactions are analyzed further with their logs and token infos
+    SWAP_METHODS = {'swapExactTokensForTokens', 'swapTokensForExactTokens',
+                    'swapExactTokensForETH', 'swapTokensForExactETH',
+                    'swapExactTokensForTokensSupportingFeeOnTransferTokens',
+                    'swapExactTokensForETHSupportingFeeOnTransferTokens',
+                    'swapExactETHForTokens', 'swapETHForExactTokens',
+                    'swapExactNativeCurrencyForTokens', 'swapExactTokensForNativeCurrency',
+                    'swapNativeCurrencyForExactTokens', 'swapTokensForExactNativeCurrency'}
+    ADD_LIQUIDITY_METHODS = {'addLiquidity', 'addLiquidityETH', 'addLiquidityNativeCurrency',
+                             'addLiquiditySingleToken',
+                             'addLiquiditySingleNativeCurrency'}
+    REMOVE_LIQUIDITY_METHODS = {'removeLiquidity', 'removeLiquidityWithPermit',
+                                'removeLiquidityETH', 'removeLiquidityETHWithPermit',
+                                'removeLiquidityETHSupportingFeeOnTransferTokens',
+                                'removeLiquidityETHWithPermitSupportingFeeOnTransferTokens',
+                                'removeLiquidityNativeCurrency'}
+    DEPOSIT_METHODS = {'deposit', 'depositWithPermit', 'depositEth', 'depositETH'}
+    WITHDRAW_METHODS = {'withdraw', 'leave'}
+    REDEEM_METHODS = {'redeem'}
+    ENRICHED_METHODS = SWAP_METHODS | ADD_LIQUIDITY_METHODS | REMOVE_LIQUIDITY_METHODS | DEPOSIT_METHODS | \
+        WITHDRAW_METHODS | REDEEM_METHODS
+
+    # basic info of tokens that can't be looked up from a contract address
+    CUSTOM_TOKEN_INFOS = {
+        'moonriver': {'name': 'MOVR?', 'symbol': 'MOVR?', 'decimals': '18'},
+        'moonbeam': {'name': 'GLMR?', 'symbol': 'GLMR?', 'decimals': '18'},
+        'MOVR': {'name': 'MOVR', 'symbol': 'MOVR', 'decimals': '18'},
+        'WMOVR': {'name': 'Wrapped MOVR', 'symbol': 'WMOVR', 'decimals': '18',
+                  'address': '0x98878B06940aE243284CA214f92Bb71a2b032B8A'},
+        'ROME': {'name': 'ROME', 'symbol': 'ROME', 'decimals': '9',
+                 'address': '0x4a436073552044D5f2f49B176853ad3Ad473d9d6'},
+        'sROME': {'name': 'Staked ROME', 'symbol': 'sROME', 'decimals': '9',
+                  'address': '0x89F52002E544585b42F8c7Cf557609CA4c8ce12A'},
+        'ZLK': {'name': 'Zenlink Network Token', 'symbol': 'ZLK', 'decimals': '18',
+                'address': '0x0f47ba9d9Bde3442b42175e51d6A367928A1173B'},
+        'SOLAR': {'name': 'SolarBeam Token', 'symbol': 'SOLAR', 'decimals': '18',
+                  'address': '0x6bD193Ee6D2104F14F94E2cA6efefae561A4334B'},
+        'SLP': {'name': 'SolarBeam LP Token', 'symbol': 'SLP', 'decimals': '18',
+                'address': '0x7eDA899b3522683636746a2f3a7814e6fFca75e1'},
+        '??': {'name': '??', 'symbol': '??', 'decimals': '0'},
+    }
+
+    def __init__(self, db_path, moonscan_api, blockscout_api, chain_name, db: SubscrapeDB = None):
         self.logger = logging.getLogger(__name__)
         self.db_path = db_path
+        self.db = db    # optional persistent store of ABIs, shared across runs
         self.chain_name = chain_name
         self.moonscan_api = moonscan_api
         self.blockscout_api = blockscout_api
         self.transactions = {}
         self.abis = {}  # cache of contract ABI interface definitions
-        self.contracts_with_known_decode_errors = []
+        self.contracts_with_known_decode_errors = set()
         self.tokens = {}  # cache of token contract basic info
-        self.contracts_that_arent_tokens = []  # cache of addresses not recognized as tokens
+        self.contracts_that_arent_tokens = set()  # cache of addresses not recognized as tokens
+        self.single_flight = SingleFlight()  # coalesces concurrent ABI, receipt and token lookups
+        self.prefetched_logs = {}  # tx hash -> future of the decoded logs, filled by the enrichment window
         if type(self.db_path) is not Path:
             self.db_path = Path(self.db_path)
+        self.__load_token_infos()
 
     async def scrape(self, operations, chain_config) -> list:
         """According to the operations specified, parse the blockchain specified to extract useful info/transactions.
@@ -108,15 +160,10 @@ class MoonbeamScraper:
                 for option in account_transactions_payload:
                     if option == "accounts":
                         accounts = account_transactions_payload['accounts']
-                        for account in accounts:
-                            account = account.lower()   # standardize capitalization
-                            self.transactions[account] = {}
-                            processor = self.__process_transactions_on_account_factory(account)
-                            self.logger.info(f"Fetching transactions for {account} from {self.moonscan_api.endpoint}")
-                            await self.moonscan_api.fetch_and_process_transactions(account, processor,
-                                                                                   config=account_transactions_config)
-                            self.__export_transactions(account)
-                            items_scraped.extend(self.transactions[account])
+                        # standardize capitalization and drop duplicates, keeping the order of the config
+                        accounts = list(dict.fromkeys(account.lower() for account in accounts))
+                        new_items = await self.__scrape_accounts(accounts, account_transactions_config)
+                        items_scraped.extend(new_items)
 
                     elif option.startswith("_"):
                         continue
@@ -127,6 +174,129 @@ class MoonbeamScraper:
                 exit
         return items_scraped
 
+    async def __scrape_accounts(self, accounts, config):
+        """Fetch, process and export the transactions of several accounts. Up to `_max_concurrent_accounts` accounts
+        are processed at the same time. They share the rate limiters of the API wrappers as well as the ABI and token
+        caches, so a router or token used by many accounts is only looked up once. If one account fails, the others
+        are cancelled and the error is raised.
+
+        :param accounts: the accounts, in lower case
+        :type accounts: list
+        :param config: the `ScrapeConfig` of the `account_transactions` operation
+        :type config: ScrapeConfig
+        :return: the timestamps of the scraped transactions of all accounts, in the order of the accounts
+        :rtype: list
+        """
+        semaphore = asyncio.Semaphore(max(1, config.max_concurrent_accounts))
+
+        async def scrape_account(account):
+            async with semaphore:
+                self.transactions[account] = {}
+                processor = self.__process_transactions_on_account_factory(account)
+                flush = cancel = None
+                if config.enrichment_window > 1:
+                    processor, flush, cancel = self.__enrichment_window_factory(processor, config.enrichment_window)
+                self.logger.info(f"Fetching transactions for {account} from {self.moonscan_api.endpoint}")
+                try:
+                    await self.moonscan_api.fetch_and_process_transactions(account, processor, config=config)
+                    if flush is not None:
+                        await flush()
+                finally:
+                    # if fetching fails, the prefetches of the transactions still in the window must not outlive it
+                    if cancel is not None:
+                        await cancel()
+                if self.db is not None:
+                    await self.db.flush_async()     # commit the receipts and ABIs of the account
+                self.__export_transactions(account)
+                return list(self.transactions[account])
+
+        tasks = [asyncio.ensure_future(scrape_account(account)) for account in accounts]
+        try:
+            results = await asyncio.gather(*tasks)
+        finally:
+            # if an account fails, the others are cancelled and awaited before the error is raised, so that none of
+            # them keeps running unsupervised
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        return [item for items in results for item in items]
+
+    async def __prefetch_transaction(self, transaction):
+        """Warm the caches for the analysis of a transaction: the ABI of the contract and, for the contract methods
+        that are analyzed further, the decoded logs and the infos of the tokens that emitted them.
+
+        :param transaction: all details for a specific transaction
+        :type transaction: dict
+        """
+        if 'input' not in transaction or len(transaction['input']) < 8:
+            return
+        contract_address = transaction['to'].lower()
+        contract_abi = await self.retrieve_and_cache_contract_abi(contract_address)
+        if contract_abi is None:
+            return
+        contract_method_name = decode_tx(contract_address, transaction['input'], contract_abi)[0]
+        if contract_method_name not in self.ENRICHED_METHODS:
+            return
+        tx_hash = transaction['hash']
+        if tx_hash not in self.prefetched_logs:
+            self.prefetched_logs[tx_hash] = asyncio.ensure_future(self.__fetch_and_decode_logs(transaction))
+        decoded_logs = await self.prefetched_logs[tx_hash]
+        token_addresses = {token_address for (_, _, _, token_address) in decoded_logs}
+        await asyncio.gather(*[self.__retrieve_and_cache_token_info_from_contract(token_address)
+                               for token_address in token_addresses])
+
+    def __enrichment_window_factory(self, processor, window_size):
+        """Wrap a transaction processor in a sliding window. The lookups of up to `window_size` transactions run
+        concurrently, while the processor itself still sees the transactions one after the other in block order, so
+        that e.g. the handling of timestamp collisions stays deterministic.
+
+        :param processor: the transaction processor
+        :type processor: function
+        :param window_size: the number of transactions to enrich concurrently
+        :type window_size: int
+        :returns: the windowed processor, a function to process the transactions still in the window and a function
+        to cancel their prefetches instead
+        :rtype: tuple
+        """
+        window = collections.deque()    # (transaction, prefetch task) in block order
+
+        async def cancel():
+            transactions = [transaction for transaction, _ in window]
+            prefetches = [prefetch for _, prefetch in window]
+            window.clear()
+            for prefetch in prefetches:
+                prefetch.cancel()
+            await asyncio.gather(*prefetches, return_exceptions=True)
+            for transaction in transactions:
+                self.prefetched_logs.pop(transaction['hash'], None)
+
+        async def process_oldest():
+            transaction, prefetch = window.popleft()
+            try:
+                await prefetch
+                await processor(transaction)
+            except BaseException:
+                await cancel()
+                raise
+            finally:
+                self.prefetched_logs.pop(transaction['hash'], None)
+
+        async def windowed_processor(transaction):
+            window.append((transaction, asyncio.ensure_future(self.__prefetch_transaction(transaction))))
+            if len(window) >= window_size:
+                await process_oldest()
+
+        async def flush():
+            while window:
+                await process_oldest()
+
+        return windowed_processor, flush, cancel
+
+    async def close(self):
+        """Releases the http connections held by the underlying API wrappers."""
+        await self.moonscan_api.close()
+        await self.blockscout_api.close()
+
     def __export_transactions(self, address, reference=None):
         """Fetch all transactions for a given address (account/contract) and use the given processor method to filter
         or post-process each transaction as we work through them. Optionally, use 'reference' to uniquely identify this
@@ -278,7 +448,7 @@ class MoonbeamScraper:
 
             if decoded_transaction[0] == 'decode error':
                 if contract_address not in self.contracts_with_known_decode_errors:
-                    self.contracts_with_known_decode_errors.append(contract_address)
+                    self.contracts_with_known_decode_errors.add(contract_address)
                     decode_traceback = decoded_transaction[1]
                     self.logger.warning(f'Unable to decode contract interaction with contract '
                                         f'{contract_address} in transaction:\r\n'
@@ -291,31 +461,19 @@ class MoonbeamScraper:
                 self.transactions[account][timestamp]['contract_method_name'] = contract_method_name
                 decoded_func_params = json.loads(decoded_transaction[1])
 
-                if contract_method_name in {'swapExactTokensForTokens', 'swapTokensForExactTokens',
-                                            'swapExactTokensForETH', 'swapTokensForExactETH',
-                                            'swapExactTokensForTokensSupportingFeeOnTransferTokens',
-                                            'swapExactTokensForETHSupportingFeeOnTransferTokens',
-                                            'swapExactETHForTokens', 'swapETHForExactTokens',
-                                            'swapExactNativeCurrencyForTokens', 'swapExactTokensForNativeCurrency',
-                                            'swapNativeCurrencyForExactTokens', 'swapTokensForExactNativeCurrency'}:
+                if contract_method_name in self.SWAP_METHODS:
                     await self.__decode_token_swap_tx(account, transaction, contract_method_name, decoded_func_params)
-                elif contract_method_name in {'addLiquidity', 'addLiquidityETH', 'addLiquidityNativeCurrency',
-                                              'addLiquiditySingleToken',
-                                              'addLiquiditySingleNativeCurrency'}:
+                elif contract_method_name in self.ADD_LIQUIDITY_METHODS:
                     await self.__decode_add_liquidity_tx(account, transaction, contract_method_name,
                                                          decoded_func_params)
-                elif contract_method_name in {'removeLiquidity', 'removeLiquidityWithPermit',
-                                              'removeLiquidityETH', 'removeLiquidityETHWithPermit',
-                                              'removeLiquidityETHSupportingFeeOnTransferTokens',
-                                              'removeLiquidityETHWithPermitSupportingFeeOnTransferTokens',
-                                              'removeLiquidityNativeCurrency'}:
+                elif contract_method_name in self.REMOVE_LIQUIDITY_METHODS:
                     await self.__decode_remove_liquidity_tx(account, transaction, contract_method_name,
                                                             decoded_func_params)
-                elif contract_method_name in {'deposit', 'depositWithPermit', 'depositEth', 'depositETH'}:
+                elif contract_method_name in self.DEPOSIT_METHODS:
                     await self.__decode_deposit_tx(account, transaction, contract_method_name, decoded_func_params)
-                elif contract_method_name in {'withdraw', 'leave'}:
+                elif contract_method_name in self.WITHDRAW_METHODS:
                     await self.__decode_withdraw_tx(account, transaction, contract_method_name, decoded_func_params)
-                elif contract_method_name in {'redeem'}:
+                elif contract_method_name in self.REDEEM_METHODS:
                     await self.__decode_redeem_tx(account, transaction, contract_method_name, decoded_func_params)
                 else:
                     # todo: handle (and don't ignore) 'stake' contract methods
@@ -351,25 +509,72 @@ class MoonbeamScraper:
         return __process_transaction_on_account
 
     async def retrieve_and_cache_contract_abi(self, contract_address):
-        """Retrieve and cache the abi for a contract
+        """Retrieve and cache the abi for a contract. If the scraper has a database, ABIs are read from it first and
+        every answer of the explorer is stored in it, including that a contract has no ABI. Such negative answers are
+        trusted until their `retry_after` time, since contracts can still get verified later.
 
         :param contract_address: contract address
         :type contract_address: str
         """
+        async def fetch_abi():
+            abi = await self.moonscan_api.get_contract_abi(contract_address)
+            # record the abi before the lookup leaves flight, so that no later caller sends it again
+            self.abis[contract_address] = abi
+            if self.db is not None:
+                retry_after = None if abi is not None else datetime.now() + timedelta(seconds=UNAVAILABLE_TTL)
+                # queued to the background writer, if any, and committed together with the receipts of the account
+                self.db.write_contract_abi(self.chain_name, contract_address, abi, retry_after)
+            return abi
+
+        if contract_address not in self.abis and self.db is not None:
+            stored_abi = self.db.query_contract_abi(self.chain_name, contract_address)
+            if stored_abi is not None and (stored_abi.abi is not None or stored_abi.retry_after > datetime.now()):
+                self.abis[contract_address] = stored_abi.abi
         if contract_address not in self.abis:
-            self.abis[contract_address] = await self.moonscan_api.get_contract_abi(contract_address)
+            await self.single_flight.do(("abi", contract_address), fetch_abi)
         return self.abis[contract_address]
 
+    async def __retrieve_and_cache_transaction_receipt(self, tx_hash):
+        """Retrieve the receipt of a transaction. If the scraper has a database, receipts are read from it first and
+        the receipts of mined transactions are stored in it, since they never change.
+
+        :param tx_hash: transaction hash
+        :type tx_hash: str
+        :returns: dictionary representing the transaction receipt, or None if not retrievable
+        """
+        if self.db is not None:
+            receipt = self.db.query_transaction_receipt(self.chain_name, tx_hash)
+            if receipt is not None:
+                return receipt
+        receipt = await self.moonscan_api.get_transaction_receipt(tx_hash)
+        if self.db is not None and type(receipt) is dict and receipt.get('blockNumber') is not None:
+            # committed together with the other receipts of the account
+            self.db.write_transaction_receipt(self.chain_name, tx_hash, receipt)
+        return receipt
+
     async def decode_logs(self, transaction):
         """Decode transaction receipts/logs from a contract interaction
 
+        :param transaction: dict containing details of the blockchain transaction
+        :type transaction: dict
+        :returns: list of tuples containing decoded transaction receipts/logs
+        """
+        tx_hash = transaction['hash']
+        if tx_hash in self.prefetched_logs:
+            return await self.prefetched_logs[tx_hash]
+        return await self.__fetch_and_decode_logs(transaction)
+
+    async def __fetch_and_decode_logs(self, transaction):
+        """Fetch the receipt of a transaction and decode its logs. See `decode_logs`.
+
         :param transaction: dict containing details of the blockchain transaction
         :type transaction: dict
         :returns: list of tuples containing decoded transaction receipts/logs
         """
         tx_hash = transaction['hash']
         contract_address = transaction['to'].lower()
-        receipt = await self.moonscan_api.get_transaction_receipt(tx_hash)
+        receipt = await self.single_flight.do(("receipt", tx_hash),
+                                              lambda: self.__retrieve_and_cache_transaction_receipt(tx_hash))
         # receipt = await self.blockscout_api.get_transaction_receipt(tx_hash)    # todo: test blockscout receipts
         if type(receipt) is not dict or 'logs' not in receipt or len(receipt['logs']) == 0:
             self.logger.warning(f"For transaction {tx_hash} with contract {contract_address}, no"
@@ -386,7 +591,7 @@ class MoonbeamScraper:
 
                 if evt_name == 'decode error':
                     if token_address not in self.contracts_with_known_decode_errors:
-                        self.contracts_with_known_decode_errors.append(token_address)
+                        self.contracts_with_known_decode_errors.add(token_address)
                         self.logger.warning(f'Unable to decode event log with contract '
                                             f'{contract_address} (token_addr {token_address}) in transaction:\r\n'
                                             f'{transaction}\r\n\r\n'
@@ -1379,24 +1584,39 @@ class MoonbeamScraper:
         :type contract_address: str
         :returns: dict of token info
         """
-        token_info = None
-        contract_address = contract_address.lower()     # standardize capitalization
-        if contract_address in self.contracts_that_arent_tokens:
-            token_info = None
-        elif contract_address in self.tokens:
-            token_info = self.tokens[contract_address]
-        else:
-            possible_token_info = await self.blockscout_api.get_token_info(contract_address)
+        async def fetch_token_info():
+            # record the result before the lookup leaves flight, so that no later caller sends it again
+            try:
+                possible_token_info = await self.blockscout_api.get_token_info(contract_address)
+            except ExplorerError as e:
+                # inconclusive. skip the contract for this run, but don't store anything, so it is looked up again
+                self.logger.warning(f"Could not look up token info for contract {contract_address}: {e}")
+                self.contracts_that_arent_tokens.add(contract_address)
+                return None
             if possible_token_info is None:
-                self.contracts_that_arent_tokens.append(contract_address)
+                self.contracts_that_arent_tokens.add(contract_address)
             elif possible_token_info['decimals'] == '':
                 self.logger.info(f"Received malformed/empty token info from Blockscout for contract"
                                  f" {contract_address}.")
-                self.contracts_that_arent_tokens.append(contract_address)
+                self.contracts_that_arent_tokens.add(contract_address)
                 possible_token_info = None
             else:
                 self.tokens[contract_address] = possible_token_info
-            token_info = possible_token_info
+            if self.db is not None:
+                # like missing ABIs, contracts that aren't tokens are checked again after a while
+                retry_after = None if possible_token_info is not None \
+                    else datetime.now() + timedelta(seconds=UNAVAILABLE_TTL)
+                self.db.write_token_info(self.chain_name, contract_address, possible_token_info, retry_after)
+            return possible_token_info
+
+        token_info = None
+        contract_address = contract_address.lower()     # standardize capitalization
+        if contract_address in self.contracts_that_arent_tokens:
+            token_info = None
+        elif contract_address in self.tokens:
+            token_info = self.tokens[contract_address]
+        else:
+            token_info = await self.single_flight.do(("token", contract_address), fetch_token_info)
         return token_info
 
     def __add_another_entry_for_transaction(self, account, transaction):
@@ -1437,42 +1657,34 @@ class MoonbeamScraper:
         return new_timestamp
 
     def __get_custom_token_info(self, token_name):
-        """Get token info (from block explorer and contract interface) from a contract address. Cache the token info
-        for future use and build up a list of contract addresses that are not tokens.
+        """Get the hard-coded token info of a token that can't be looked up from a contract address.
 
         :param token_name: general name for the token we'll provide basic info for
         :type token_name: str
-        :returns: dict of token info
+        :returns: dict of token info, or None for an unknown name
         """
-        if token_name == 'moonriver':
-            return {'name': 'MOVR?', 'symbol': 'MOVR?', 'decimals': '18'}
-        elif token_name == 'moonbeam':
-            return {'name': 'GLMR?', 'symbol': 'GLMR?', 'decimals': '18'}
-        elif token_name == 'MOVR':
-            return {'name': 'MOVR', 'symbol': 'MOVR', 'decimals': '18'}
-        elif token_name == 'WMOVR':
-            return {'name': 'Wrapped MOVR', 'symbol': 'WMOVR', 'decimals': '18',
-                    'address': '0x98878B06940aE243284CA214f92Bb71a2b032B8A'}
-        elif token_name == 'ROME':
-            return {'name': 'ROME', 'symbol': 'ROME', 'decimals': '9',
-                    'address': '0x4a436073552044D5f2f49B176853ad3Ad473d9d6'}
-        elif token_name == 'sROME':
-            return {'name': 'Staked ROME', 'symbol': 'sROME', 'decimals': '9',
-                    'address': '0x89F52002E544585b42F8c7Cf557609CA4c8ce12A'}
-        elif token_name == 'ZLK':
-            return {'name': 'Zenlink Network Token', 'symbol': 'ZLK', 'decimals': '18',
-                    'address': '0x0f47ba9d9Bde3442b42175e51d6A367928A1173B'}
-        elif token_name == 'SOLAR':
-            return {'name': 'SolarBeam Token', 'symbol': 'SOLAR', 'decimals': '18',
-                    'address': '0x6bD193Ee6D2104F14F94E2cA6efefae561A4334B'}
-        elif token_name == 'SLP':
-            return {'name': 'SolarBeam LP Token', 'symbol': 'SLP', 'decimals': '18',
-                    'address': '0x7eDA899b3522683636746a2f3a7814e6fFca75e1'}
-        # elif token_name == '':
-        #     return {'name': '', 'symbol': '', 'decimals': '', 'address': ''}
-        # elif token_name == '':
-        #     return {'name': '', 'symbol': '', 'decimals': '', 'address': ''}
-        elif token_name == '??':
-            return {'name': '??', 'symbol': '??', 'decimals': '0'}
-        else:
-            return None
+        token_info = self.CUSTOM_TOKEN_INFOS.get(token_name)
+        return None if token_info is None else dict(token_info)
+
+    def __load_token_infos(self):
+        """Fill the token caches with the hard-coded tokens of the chain and with the token infos stored in the
+        database by earlier runs.
+        """
+        if self.chain_name == 'moonriver':
+            # the hard-coded contract addresses are those of Moonriver
+            for token_info in self.CUSTOM_TOKEN_INFOS.values():
+                if 'address' in token_info:
+                    self.tokens[token_info['address'].lower()] = dict(token_info)
+        if self.db is None:
+            return
+        now = datetime.now()
+        for stored_token_info in self.db.query_token_infos(self.chain_name):
+            if stored_token_info.address in self.tokens:
+                continue    # the hard-coded info wins
+            if not stored_token_info.is_token:
+                if stored_token_info.retry_after > now:
+                    self.contracts_that_arent_tokens.add(stored_token_info.address)
+            else:
+                self.tokens[stored_token_info.address] = {'name': stored_token_info.name,
+                                                          'symbol': stored_token_info.symbol,
+                                                          'decimals': stored_token_info.decimals}
@@ -1,5 +1,6 @@
 __author__ = 'Tommi Enenkel @alice_und_bob'
 
+import asyncio
 from email.policy import strict
 import logging
 import string
@@ -50,9 +51,15 @@ class ParachainScraper:
 
         return items
 
+    async def close(self):
+        """Releases the http connections held by the underlying API wrapper."""
+        await self.api.close()
+
     async def scrape_module_calls(self, modules, chain_config, fetch_function) -> list:
         """
-        Scrapes all module calls that belong to the list of accounts.
+        Scrapes all module calls that belong to the list of accounts. Up to `_max_concurrent_calls` module/call pairs
+        are scraped at the same time; they share the rate limiter of the API wrapper. The items are returned in the
+        order of the config, no matter which pair finishes first.
 
         :param modules: dict of extrinsic modules to look for, like `system`, `utility`, etc
         :type modules: dict
@@ -63,7 +70,7 @@ class ParachainScraper:
         :return: the scraped items
         :rtype: list
         """
-        items = []
+        fetches = []
         extrinsic_config = chain_config.create_inner_config(modules)
 
         # if we want to scrape all extrinsics, modules is None. In that case, we just set it to a list containing None
@@ -103,7 +110,22 @@ class ParachainScraper:
                     self.logger.info(f"Config asks to skip {module} {call}")
                     continue
 
-                # go
-                new_items = await fetch_function(module, call, call_config)
-                items.extend(new_items)
-        return items
+                fetches.append((module, call, call_config))
+
+        # go
+        semaphore = asyncio.Semaphore(max(1, extrinsic_config.max_concurrent_calls))
+
+        async def fetch(module, call, call_config):
+            async with semaphore:
+                return await fetch_function(module, call, call_config)
+
+        tasks = [asyncio.ensure_future(fetch(*f)) for f in fetches]
+        try:
+            results = await asyncio.gather(*tasks)
+        finally:
+            # if a call fails, the others are cancelled and awaited before the error is raised, so that none of them
+            # keeps running unsupervised
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        return [item for new_items in results for item in new_items]
@@ -13,6 +13,13 @@ class ScrapeConfig:
         self.db_connection_string = None
         self.auto_hydrate = True
         self.stop_on_known_data = True
+        self.shards = 1
+        self.max_concurrent_calls = 1
+        self.max_concurrent_accounts = 1
+        self.enrichment_window = 1
+        self.background_writer = True
+        self.shared_rate_limit = False
+        self.response_cache = True
         self._set_config(config)
 
     def _set_config(self, config):
@@ -59,6 +66,36 @@ class ScrapeConfig:
         if stop_on_known_data is not None:
             self.stop_on_known_data = stop_on_known_data
 
+        shards = config.get("_shards", None)
+        if shards is not None:
+            self.shards = shards
+
+        max_concurrent_calls = config.get("_max_concurrent_calls", None)
+        if max_concurrent_calls is not None:
+            self.max_concurrent_calls = max_concurrent_calls
+
+        max_concurrent_accounts = config.get("_max_concurrent_accounts", None)
+        if max_concurrent_accounts is not None:
+            self.max_concurrent_accounts = max_concurrent_accounts
+
+        enrichment_window = config.get("_enrichment_window", None)
+        if enrichment_window is not None:
+            self.enrichment_window = enrichment_window
+
+        background_writer = config.get("_background_writer", None)
+        if background_writer is not None:
+            self.background_writer = background_writer
+
+        # _shared_rate_limit is only relevant on the chain level
+        shared_rate_limit = config.get("_shared_rate_limit", None)
+        if shared_rate_limit is not None:
+            self.shared_rate_limit = shared_rate_limit
+
+        # _response_cache is only relevant on the chain level
+        response_cache = config.get("_response_cache", None)
+        if response_cache is not None:
+            self.response_cache = response_cache
+
     def create_inner_config(self, config):
         """
         creates a config that can be nested to lower layers
@@ -1,3 +1,4 @@
+from . import test_apis
 from . import test_db
 from . import test_events
 from . import test_extrinsics
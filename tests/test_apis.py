@@ -0,0 +1,786 @@
+import asyncio
+import datetime
+import subscrape
+import httpx
+import pytest
+import threading
+import time
+from subscrape.apis import subscan_wrapper
+from subscrape.apis.subscan_wrapper import SubscanWrapper
+from subscrape.apis.moonscan_wrapper import MoonscanWrapper
+from subscrape.apis.blockscout_wrapper import BlockscoutWrapper
+from subscrape.apis.api_key_pool import ApiKeyPool
+from subscrape.apis.rate_limiter import RateLimiter
+from subscrape.apis import http_client, json_decoder, replay, shared_rate_limiter
+from subscrape.apis.response_cache import ResponseCache, NEVER_EXPIRES
+from subscrape.apis.mock_explorer import MockExplorer
+from subscrape.apis.prefetch import Prefetcher
+from subscrape.apis.retry_policy import CircuitBreaker, ExplorerError, RetryPolicy
+from subscrape.apis.single_flight import SingleFlight
+from subscrape.db.subscrape_db import SubscrapeDB
+from subscrape.scrapers.moonbeam_scraper import MoonbeamScraper
+from subscrape.scrapers.parachain_scraper import ParachainScraper
+from subscrape.scrapers.scrape_config import ScrapeConfig
+
+
+@pytest.mark.asyncio
+async def test_wrappers_share_one_client():
+    wrappers = [SubscanWrapper("kusama", None), MoonscanWrapper("moonriver"), BlockscoutWrapper("moonriver")]
+    for wrapper in wrappers:
+        async with wrapper:
+            client = wrapper.client
+            assert client is wrapper.client, "The wrapper should reuse its pooled client"
+        assert client.is_closed, "Leaving the context should close the pooled client"
+
+
+@pytest.mark.asyncio
+async def test_rate_limiter_paces_calls():
+    limiter = RateLimiter(20)
+    start = time.monotonic()
+    for _ in range(30):
+        await limiter.acquire()
+    elapsed = time.monotonic() - start
+    # the first 20 calls are a burst, the remaining 10 are paced at 20 calls/sec
+    assert elapsed >= 0.45, "The limiter should not hand out more tokens than its rate allows"
+
+
+def test_rate_limiter_aimd():
+    limiter = RateLimiter(10)
+    limiter.on_rate_limited(pause=0)
+    assert limiter.calls_per_sec == 5, "A rate limit response should halve the rate"
+    limiter.on_success()
+    assert limiter.calls_per_sec == pytest.approx(5.1), "A successful call should increase the rate additively"
+    for _ in range(100):
+        limiter.on_success()
+    assert limiter.calls_per_sec == 10, "The rate should never exceed its upper bound"
+    for _ in range(10):
+        limiter.on_rate_limited(pause=0)
+    assert limiter.calls_per_sec == limiter.min_calls_per_sec, "The rate should never drop below its lower bound"
+
+
+def test_rate_limiter_slows_down_once_per_episode():
+    limiter = RateLimiter(10)
+    generation = limiter.generation
+    for _ in range(5):
+        # five requests that were in flight at the same time are all rate limited
+        limiter.on_rate_limited(pause=0, generation=generation)
+    assert limiter.calls_per_sec == 5, "One rate limit episode should only halve the rate once"
+    limiter.on_rate_limited(pause=0, generation=limiter.generation)
+    assert limiter.calls_per_sec == 2.5, "A request reserved after the slowdown should slow down again"
+
+
+@pytest.mark.asyncio
+async def test_rate_limiter_pause_applies_to_waiting_callers():
+    limiter = RateLimiter(10)
+    for _ in range(10):
+        await limiter.acquire()     # use up the burst, so the next callers have to queue
+    start = time.monotonic()
+    finish_times = []
+
+    async def call():
+        await limiter.acquire()
+        finish_times.append(time.monotonic() - start)
+
+    tasks = [asyncio.create_task(call()) for _ in range(5)]
+    await asyncio.sleep(0.05)
+    limiter.on_rate_limited(pause=0.5)
+    await asyncio.gather(*tasks)
+    assert min(finish_times) >= 0.5, "Callers that were already waiting should respect the pause"
+
+
+@pytest.mark.asyncio
+async def test_api_key_pool_spreads_requests():
+    pool = ApiKeyPool(["key_a", "key_b", "key_c"], 10)
+    assert pool.max_calls_per_sec == 30, "The budget of the pool should be the sum of its keys"
+    used_keys = []
+    for _ in range(30):
+        api_key = await pool.acquire()
+        used_keys.append(api_key.key)
+    for key in ["key_a", "key_b", "key_c"]:
+        assert used_keys.count(key) == 10, "Every key should serve the same share of requests"
+
+
+@pytest.mark.skipif(not shared_rate_limiter.is_supported(), reason="requires fcntl")
+def test_shared_rate_limiter_shares_budget(tmp_path):
+    # two limiters with the same name stand in for two processes using the same API key
+    limiter_a = shared_rate_limiter.SharedRateLimiter(5, tmp_path, "key")
+    limiter_b = shared_rate_limiter.SharedRateLimiter(5, tmp_path, "key")
+    for _ in range(5):
+        assert limiter_a._reserve() == 0, "The burst should be served immediately"
+    assert limiter_b.time_until_available() > 0, "The second limiter should see the tokens the first one used"
+    limiter_b.on_rate_limited(pause=0)
+    limiter_a.time_until_available()
+    assert limiter_a.calls_per_sec == 2.5, "A slowdown should apply to all limiters sharing the budget"
+
+
+def test_response_cache_ttl_and_eviction(tmp_path):
+    cache = ResponseCache(tmp_path / "responses.db", max_size_bytes=100)
+    cache.set("immutable", b"x" * 40, NEVER_EXPIRES)
+    cache.set("expired", b"y" * 10, -1)
+    assert cache.get("immutable") == b"x" * 40
+    assert cache.get("expired") is None, "Expired entries should not be served"
+
+    cache.set("second", b"z" * 40, NEVER_EXPIRES)
+    cache.get("immutable")  # the least recently used entry is now "second"
+    cache.set("third", b"w" * 40, NEVER_EXPIRES)
+    assert cache.get("second") is None, "The least recently used entry should be evicted"
+    assert cache.get("immutable") is not None
+    assert cache.get("third") is not None
+    cache.close()
+
+
+def test_response_cache_defers_access_times(tmp_path):
+    cache = ResponseCache(tmp_path / "responses.db")
+    cache.set("key", b"body", NEVER_EXPIRES)
+    time.sleep(0.01)
+    accessed_at = time.time()
+    changes = cache._connection.total_changes
+    for _ in range(10):
+        assert cache.get("key") == b"body"
+    assert cache._connection.total_changes == changes, "Cache hits should not write to the database"
+    cache.close()
+
+    cache = ResponseCache(tmp_path / "responses.db")
+    last_access = cache._connection.execute("SELECT last_access FROM responses").fetchone()[0]
+    assert last_access >= accessed_at, "The access times should be written when the cache is closed"
+    cache.close()
+
+
+@pytest.mark.asyncio
+async def test_subscan_serves_finalized_hydration_from_cache(tmp_path):
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        return httpx.Response(200, json={"code": 0, "data": {"extrinsic_index": "1-1", "finalized": True}})
+
+    cache = ResponseCache(tmp_path / "responses.db")
+    api = SubscanWrapper("kusama", None, response_cache=cache)
+    api._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    async with api:
+        for _ in range(2):
+            data = await api._query("/api/scan/extrinsic", body={"extrinsic_index": "1-1"},
+                                    cache_ttl=subscan_wrapper._finality_aware_ttl)
+            assert data["extrinsic_index"] == "1-1"
+    assert len(requests) == 1, "The second query should have been served from the cache"
+    cache.close()
+
+
+@pytest.mark.asyncio
+async def test_record_and_replay(tmp_path):
+    def handler(request):
+        return httpx.Response(200, json={"status": "1", "result": request.url.params["address"]})
+
+    archive_path = tmp_path / "archive.jsonl.gz"
+    archive = replay.ReplayArchive(archive_path)
+    async with httpx.AsyncClient(transport=replay.RecordingTransport(archive, httpx.MockTransport(handler))) as client:
+        await client.get("https://example.com/api", params={"address": "0x1", "apikey": "secret"})
+    archive.close()
+
+    state = replay.current_state()
+    try:
+        replay.enable_replay(archive_path)
+        api = MoonscanWrapper("moonriver", api_key="another_key")
+        async with api:
+            response = await api.client.get("https://example.com/api", params={"address": "0x1"})
+            assert response.json()["result"] == "0x1", "Replay should ignore the API key of the request"
+            response = await api.client.get("https://example.com/api", params={"address": "0x2"})
+            assert response.status_code == 404, "Requests that were not recorded should not be served"
+    finally:
+        replay.restore(state)
+
+
+@pytest.mark.asyncio
+async def test_scrape_restores_replay_state(tmp_path):
+    archive_path = tmp_path / "archive.jsonl.gz"
+    archive = replay.ReplayArchive(archive_path)
+    archive.append(httpx.Request("GET", "https://example.com/api"), httpx.Response(200, content=b"{}"))
+    archive.close()
+    state = replay.current_state()
+    try:
+        replay.enable_replay(archive_path)
+        assert subscrape.response_cache_factory() is None, "Replayed requests should bypass the response cache"
+    finally:
+        replay.restore(state)
+
+    await subscrape.scrape({"_replay": str(archive_path)})
+    assert not replay.is_active(), "Replay should end with the run that enabled it"
+    assert http_client.get_transport_factory() is None, "The default transport should be restored"
+
+
+@pytest.mark.asyncio
+async def test_mock_explorer(tmp_path):
+    explorer = MockExplorer(num_items=250, subscan_max_rows=100, txlist_page_size=100)
+    explorer.install()
+    try:
+        db = SubscrapeDB(f"sqlite:///{tmp_path}/mock.db")
+        api = SubscanWrapper("kusama", db)
+        async with api:
+            items = await api.fetch_extrinsic_metadata("system", "remark", ScrapeConfig({"_auto_hydrate": False}))
+        assert len(items) == 250, "All synthetic extrinsics should have been paged through"
+        assert explorer.request_counts["/api/v2/scan/extrinsics"] == 3
+        db.close()
+
+        api = MoonscanWrapper("moonriver")
+        async with api:
+            response = await api.client.get(api.endpoint, params={
+                "module": "account", "action": "txlist", "address": "0x1", "startblock": 0, "endblock": 99999999})
+            assert len(response.json()["result"]) == 100, "txlist should be capped at the configured page size"
+    finally:
+        explorer.uninstall()
+
+
+@pytest.mark.asyncio
+async def test_subscan_sharded_pagination(tmp_path):
+    explorer = MockExplorer(num_items=1000, items_per_block=3, first_block=5)
+    explorer.install()
+    try:
+        db = SubscrapeDB(f"sqlite:///{tmp_path}/sharded.db")
+        api = SubscanWrapper("kusama", db)
+        async with api:
+            config = ScrapeConfig({"_auto_hydrate": False, "_shards": 4})
+            items = await api.fetch_event_metadata("system", "remarked", config)
+        ids = [int(item.id.split("-")[0]) * 3 + int(item.id.split("-")[1]) for item in items]
+        assert len(set(ids)) == 1000, "Every synthetic event should have been fetched exactly once"
+        assert ids == sorted(ids, reverse=True), "Shards should be merged newest first"
+        db.close()
+    finally:
+        explorer.uninstall()
+
+
+@pytest.mark.asyncio
+async def test_moonscan_block_windows():
+    explorer = MockExplorer(num_items=1000, items_per_block=2, txlist_page_size=100)
+    explorer.install()
+    try:
+        processed = []
+
+        async def processor(transaction):
+            processed.append(int(transaction["nonce"]))
+
+        api = MoonscanWrapper("moonriver", api_key=["key1", "key2", "key3", "key4"])
+        api.txlist_max_results = 100
+        async with api:
+            await api.fetch_and_process_transactions("0x1", processor, ScrapeConfig({"_shards": 3}))
+        assert processed == list(range(1000)), "Saturated windows should be bisected and processed in block order"
+    finally:
+        explorer.uninstall()
+
+
+@pytest.mark.asyncio
+async def test_prefetcher_overlaps_fetching_and_processing():
+    fetched = []
+
+    async def pages():
+        for page in range(10):
+            await asyncio.sleep(0.05)
+            fetched.append(page)
+            yield page
+
+    start = time.monotonic()
+    processed = []
+    async with Prefetcher(pages(), lookahead=2) as prefetched:
+        async for page in prefetched:
+            await asyncio.sleep(0.05)
+            processed.append(page)
+            if page == 5:
+                break
+    elapsed = time.monotonic() - start
+    assert processed == list(range(6))
+    # serially, 6 pages would take 0.6 seconds
+    assert elapsed < 0.5, "Fetching the next page should overlap with processing the current one"
+    assert len(fetched) <= 6 + 3, "The producer should not fetch further ahead than the lookahead allows"
+
+
+@pytest.mark.asyncio
+async def test_retry_policy_recovers_from_transient_errors():
+    statuses = [502, 503, 200, 404]
+
+    def handler(request):
+        return httpx.Response(statuses.pop(0), headers={"retry-after": "0"}, json={"code": 0, "data": {"ok": True}})
+
+    api = SubscanWrapper("kusama", None)
+    api._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    async with api:
+        data = await api._query("/api/scan/extrinsic", body={"extrinsic_index": "1-1"})
+        assert data == {"ok": True}, "Transient server errors should be retried"
+        with pytest.raises(ExplorerError) as error:
+            await api._query("/api/scan/extrinsic", body={"extrinsic_index": "1-2"})
+        assert error.value.status_code == 404, "Other errors should fail right away"
+
+
+@pytest.mark.asyncio
+async def test_circuit_breaker_pauses_failing_endpoint():
+    breaker = CircuitBreaker("test", failure_threshold=2, reset_timeout=0.2)
+    breaker.record_failure()
+    assert not breaker.is_open
+    breaker.record_failure()
+    assert breaker.is_open, "The circuit should open after consecutive failures"
+    start = time.monotonic()
+    await breaker.wait()
+    assert time.monotonic() - start >= 0.15, "Requests should wait while the circuit is open"
+    breaker.record_success()
+    assert not breaker.is_open, "A successful trial request should close the circuit"
+
+
+@pytest.mark.asyncio
+async def test_circuit_breaker_recovers_from_cancelled_trial():
+    policy = RetryPolicy("test", circuit_breaker=CircuitBreaker("test", failure_threshold=1, reset_timeout=0.1))
+    policy.circuit_breaker.record_failure()
+
+    async def hang(timeout):
+        await asyncio.sleep(10)
+
+    trial = asyncio.create_task(policy.send(hang))
+    await asyncio.sleep(0.15)
+    trial.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await trial
+
+    async def respond(timeout):
+        return httpx.Response(200)
+
+    response = await asyncio.wait_for(policy.send(respond), timeout=1)
+    assert response.status_code == 200, "A cancelled trial request should not block the endpoint forever"
+    assert not policy.circuit_breaker.is_open
+
+
+def test_json_decoder_reads_raw_bytes():
+    content = '{"code": 0, "data": {"params": [{"value": "\u00e4"}]}}'.encode("UTF-8")
+    assert json_decoder.loads(content) == {"code": 0, "data": {"params": [{"value": "\u00e4"}]}}
+
+
+@pytest.mark.asyncio
+async def test_single_flight_coalesces_concurrent_calls():
+    calls = []
+
+    async def get_contract_abi(address):
+        calls.append(address)
+        await asyncio.sleep(0.05)
+        return f"abi of {address}"
+
+    single_flight = SingleFlight()
+    results = await asyncio.gather(*[single_flight.do(("abi", "0x1"), lambda: get_contract_abi("0x1"))
+                                     for _ in range(10)])
+    assert results == ["abi of 0x1"] * 10
+    assert calls == ["0x1"], "Concurrent callers should share one in-flight request"
+    assert len(single_flight) == 0, "Finished calls should not stay in flight"
+
+
+def _count_db_writer_threads():
+    return len([thread for thread in threading.enumerate() if thread.name == "subscrape-db-writer"])
+
+
+def test_subscan_chains_share_key_pool(monkeypatch):
+    monkeypatch.setattr(subscrape, "read_api_keys", lambda key_path: ["key_a", "key_b"])
+    monkeypatch.setattr(subscrape, "_subscan_key_pools", {})
+    config = ScrapeConfig({})
+    kusama = subscrape.subscan_factory("kusama", None, config)
+    polkadot = subscrape.subscan_factory("polkadot", None, config)
+    assert kusama.api_keys is polkadot.api_keys, "Chains scraped with the same keys should share their budget"
+    monkeypatch.setattr(subscrape, "read_api_keys", lambda key_path: [])
+    kusama = subscrape.subscan_factory("kusama", None, config)
+    polkadot = subscrape.subscan_factory("polkadot", None, config)
+    assert kusama.api_keys is not polkadot.api_keys, "Anonymous calls are limited per endpoint"
+
+
+@pytest.mark.asyncio
+async def test_scrape_chains_concurrently(tmp_path):
+    explorer = MockExplorer(num_items=300, latency=0.01)
+    explorer.install()
+    try:
+        db_connection_string = f"sqlite:///{tmp_path}/chains.db"
+        config = {
+            "_response_cache": False,
+            "kusama": {"_db_connection_string": db_connection_string, "_auto_hydrate": False,
+                       "extrinsics": {"system": ["remark"]}},
+            "polkadot": {"_db_connection_string": db_connection_string, "_auto_hydrate": False,
+                         "extrinsics": {"system": ["remark"]}},
+        }
+        writers_before = _count_db_writer_threads()
+        start = time.monotonic()
+        items = await subscrape.scrape(config)
+        elapsed = time.monotonic() - start
+        assert len(items) == 600, "The results of all chains should be aggregated"
+        # each chain needs 3 pages at 2 calls/sec; scraped one after the other this takes over 2 seconds
+        assert elapsed < 2, "Chains should be scraped concurrently"
+        assert _count_db_writer_threads() == writers_before, "The run should close the databases it opened"
+        assert items[0].chain == "kusama", "The items should stay readable after the database is closed"
+    finally:
+        explorer.uninstall()
+
+
+@pytest.mark.asyncio
+async def test_scrape_module_calls_concurrently(tmp_path):
+    explorer = MockExplorer(num_items=50, latency=0.6)
+    explorer.install()
+    try:
+        config = {
+            "_response_cache": False,
+            "kusama": {"_db_connection_string": f"sqlite:///{tmp_path}/calls.db", "_auto_hydrate": False,
+                       "events": {"_max_concurrent_calls": 4, "system": ["remarked", "extrinsicsuccess"],
+                                  "balances": ["transfer", "deposit"]}},
+        }
+        dbs = {}
+        db_factory = subscrape.shared_db_factory(dbs)
+        start = time.monotonic()
+        items = await subscrape.scrape(config, db_factory)
+        for db in dbs.values():
+            db.close()
+        elapsed = time.monotonic() - start
+        assert [item.event for item in items[::50]] == ["remarked", "extrinsicsuccess", "transfer", "deposit"], \
+            "Items should be returned in the order of the config"
+        # one pair after the other, the latency alone adds up to 2.4 seconds
+        assert elapsed < 2.2, "Module/call pairs should be scraped concurrently"
+    finally:
+        explorer.uninstall()
+
+
+@pytest.mark.asyncio
+async def test_moonbeam_scraper_accounts_concurrently(tmp_path, monkeypatch):
+    # the spreadsheet export is not under test here
+    monkeypatch.setattr(MoonbeamScraper, "_MoonbeamScraper__export_transactions", lambda self, *args: None)
+    explorer = MockExplorer(num_items=40, latency=0.05, txlist_page_size=100)
+    explorer.install()
+    try:
+        moonscan_api = MoonscanWrapper("moonriver", api_key=["key1", "key2", "key3", "key4"])
+        scraper = MoonbeamScraper(tmp_path / "moonriver_", moonscan_api, BlockscoutWrapper("moonriver"), "moonriver")
+        accounts = ["0xA1", "0xa2", "0xa3", "0xa1"]
+        operations = {"account_transactions": {"accounts": accounts}}
+        try:
+            items = await scraper.scrape(operations, ScrapeConfig({"_max_concurrent_accounts": 3}))
+        finally:
+            await scraper.close()
+        assert sorted(scraper.transactions) == ["0xa1", "0xa2", "0xa3"], "Every distinct account should be scraped"
+        assert len(items) >= 3 * 40
+        assert explorer.request_counts["getabi"] == 8, "The ABI cache should be shared by all accounts"
+    finally:
+        explorer.uninstall()
+
+
+@pytest.mark.asyncio
+async def test_moonbeam_scraper_failing_account_cancels_the_others(tmp_path, monkeypatch):
+    monkeypatch.setattr(MoonbeamScraper, "_MoonbeamScraper__export_transactions", lambda self, *args: None)
+    cancelled = []
+
+    async def fetch_and_process_transactions(account, processor, config=None):
+        if account == "0xbad":
+            await asyncio.sleep(0.05)
+            raise ExplorerError("Error: 500", 500)
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(account)
+            raise
+
+    moonscan_api = MoonscanWrapper("moonriver")
+    monkeypatch.setattr(moonscan_api, "fetch_and_process_transactions", fetch_and_process_transactions)
+    scraper = MoonbeamScraper(tmp_path / "moonriver_", moonscan_api, BlockscoutWrapper("moonriver"), "moonriver")
+    operations = {"account_transactions": {"accounts": ["0xa1", "0xbad", "0xa2"]}}
+    try:
+        with pytest.raises(ExplorerError):
+            await scraper.scrape(operations, ScrapeConfig({"_max_concurrent_accounts": 3}))
+    finally:
+        await scraper.close()
+    assert sorted(cancelled) == ["0xa1", "0xa2"], "The other accounts should be cancelled before the error is raised"
+
+
+@pytest.mark.asyncio
+async def test_parachain_scraper_failing_call_cancels_the_others():
+    cancelled = []
+
+    async def fetch_function(module, call, config):
+        if call == "bad":
+            await asyncio.sleep(0.05)
+            raise ExplorerError("Error: 500", 500)
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(call)
+            raise
+
+    scraper = ParachainScraper(None)
+    modules = {"_max_concurrent_calls": 3, "system": ["remark", "bad", "remark_with_event"]}
+    with pytest.raises(ExplorerError):
+        await scraper.scrape_module_calls(modules, ScrapeConfig({}), fetch_function)
+    assert sorted(cancelled) == ["remark", "remark_with_event"], \
+        "The other calls should be cancelled before the error is raised"
+
+
+@pytest.mark.asyncio
+async def test_moonbeam_scraper_enrichment_window(tmp_path, monkeypatch):
+    monkeypatch.setattr(MoonbeamScraper, "_MoonbeamScraper__export_transactions", lambda self, *args: None)
+
+    async def scrape_account(enrichment_window):
+        explorer = MockExplorer(num_items=30, latency=0.05, txlist_page_size=100)
+        explorer.install()
+        try:
+            moonscan_api = MoonscanWrapper("moonriver", api_key=["key1", "key2", "key3", "key4"])
+            scraper = MoonbeamScraper(tmp_path / f"window{enrichment_window}_", moonscan_api,
+                                      BlockscoutWrapper("moonriver"), "moonriver")
+            operations = {"account_transactions": {"accounts": ["0xa1"]}}
+            try:
+                await scraper.scrape(operations, ScrapeConfig({"_enrichment_window": enrichment_window}))
+            finally:
+                await scraper.close()
+            return scraper.transactions, explorer.request_counts
+        finally:
+            explorer.uninstall()
+
+    serial_transactions, serial_counts = await scrape_account(1)
+    windowed_transactions, windowed_counts = await scrape_account(10)
+    assert windowed_transactions == serial_transactions, "The window must not change the results"
+    assert list(windowed_transactions["0xa1"]) == list(serial_transactions["0xa1"]), "...nor their order"
+    assert windowed_counts == serial_counts, "Prefetched lookups should be reused, not repeated"
+
+
+@pytest.mark.asyncio
+async def test_moonbeam_scraper_failing_fetch_cancels_the_window(tmp_path, monkeypatch):
+    monkeypatch.setattr(MoonbeamScraper, "_MoonbeamScraper__export_transactions", lambda self, *args: None)
+    cancelled = []
+
+    async def prefetch_transaction(self, transaction):
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(transaction["hash"])
+            raise
+
+    async def fetch_and_process_transactions(account, processor, config=None):
+        for i in range(3):
+            await processor({"hash": f"0x{i}"})
+        await asyncio.sleep(0.05)   # let the prefetches start
+        raise ExplorerError("Error: 500", 500)
+
+    monkeypatch.setattr(MoonbeamScraper, "_MoonbeamScraper__prefetch_transaction", prefetch_transaction)
+    moonscan_api = MoonscanWrapper("moonriver")
+    monkeypatch.setattr(moonscan_api, "fetch_and_process_transactions", fetch_and_process_transactions)
+    scraper = MoonbeamScraper(tmp_path / "moonriver_", moonscan_api, BlockscoutWrapper("moonriver"), "moonriver")
+    try:
+        with pytest.raises(ExplorerError):
+            await scraper.scrape({"account_transactions": {"accounts": ["0xa1"]}},
+                                 ScrapeConfig({"_enrichment_window": 10}))
+    finally:
+        await scraper.close()
+    assert sorted(cancelled) == ["0x0", "0x1", "0x2"], "The prefetches in the window should be cancelled"
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("background_writer", [False, True])
+async def test_moonbeam_scraper_persists_abis(tmp_path, monkeypatch, background_writer):
+    monkeypatch.setattr(MoonbeamScraper, "_MoonbeamScraper__export_transactions", lambda self, *args: None)
+    db = SubscrapeDB(f"sqlite:///{tmp_path}/abis.db", background_writer=background_writer)
+
+    async def scrape_account():
+        explorer = MockExplorer(num_items=20, txlist_page_size=100)
+        explorer.install()
+        try:
+            scraper = MoonbeamScraper(tmp_path / "moonriver_", MoonscanWrapper("moonriver", api_key=["key1"]),
+                                      BlockscoutWrapper("moonriver"), "moonriver", db=db)
+            try:
+                await scraper.scrape({"account_transactions": {"accounts": ["0xa1"]}}, ScrapeConfig({}))
+            finally:
+                await scraper.close()
+            return explorer.request_counts
+        finally:
+            explorer.uninstall()
+
+    assert (await scrape_account())["getabi"] == 8
+    assert (await scrape_account())["getabi"] == 0, "A warm run should read all ABIs from the database"
+    assert db.query_contract_abi("moonriver", "0x00000000000000000000000000000000000000a0").abi is not None
+    db.close()
+
+
+@pytest.mark.asyncio
+async def test_moonbeam_scraper_persists_receipts(tmp_path):
+    db = SubscrapeDB(f"sqlite:///{tmp_path}/receipts.db")
+    transactions = [{"hash": f"0x{index:064x}", "to": f"0x{0xa0 + index % 8:040x}"} for index in range(5)]
+
+    async def decode_all_logs():
+        explorer = MockExplorer(num_items=5)
+        explorer.install()
+        try:
+            scraper = MoonbeamScraper(tmp_path / "moonriver_", MoonscanWrapper("moonriver", api_key=["key1"]),
+                                      BlockscoutWrapper("moonriver"), "moonriver", db=db)
+            try:
+                for transaction in transactions:
+                    await scraper.decode_logs(transaction)
+                db.flush()
+            finally:
+                await scraper.close()
+            return explorer.request_counts
+        finally:
+            explorer.uninstall()
+
+    assert (await decode_all_logs())["eth_getTransactionReceipt"] == 5
+    assert (await decode_all_logs())["eth_getTransactionReceipt"] == 0, "Receipts should be read from the database"
+    db.close()
+
+
+@pytest.mark.asyncio
+async def test_moonbeam_scraper_persists_token_infos(tmp_path):
+    db = SubscrapeDB(f"sqlite:///{tmp_path}/tokens.db")
+    token_addresses = [f"0x{0xa0 + index:040x}" for index in range(8)]
+    wmovr = MoonbeamScraper.CUSTOM_TOKEN_INFOS["WMOVR"]["address"].lower()
+
+    async def retrieve_token_infos():
+        explorer = MockExplorer()
+        explorer.install()
+        try:
+            scraper = MoonbeamScraper(tmp_path / "moonriver_", MoonscanWrapper("moonriver"),
+                                      BlockscoutWrapper("moonriver"), "moonriver", db=db)
+            try:
+                for token_address in token_addresses + [wmovr]:
+                    token_info = await scraper._MoonbeamScraper__retrieve_and_cache_token_info_from_contract(
+                        token_address)
+                    assert token_info is not None
+            finally:
+                await scraper.close()
+            return explorer.request_counts
+        finally:
+            explorer.uninstall()
+
+    assert (await retrieve_token_infos())["getToken"] == 8, "Hard-coded tokens should not be looked up"
+    assert (await retrieve_token_infos())["getToken"] == 0, "Token infos should be read from the database"
+    db.close()
+
+
+@pytest.mark.asyncio
+async def test_blockscout_token_info_tells_non_tokens_from_failures():
+    answers = [{"status": "0", "message": "contract address not found", "result": None},
+               {"status": "0", "message": "Internal server error", "result": None}]
+
+    def handler(request):
+        return httpx.Response(200, json=answers.pop(0))
+
+    api = BlockscoutWrapper("moonriver")
+    api._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    async with api:
+        assert await api.get_token_info("0xa1") is None, "An address that is not a token should return None"
+        with pytest.raises(ExplorerError):
+            await api.get_token_info("0xa2")
+
+
+@pytest.mark.asyncio
+async def test_response_cache_keeps_only_conclusive_negative_answers(tmp_path):
+    answers = {"0xa1": {"status": "0", "message": "NOTOK", "result": "Contract source code not verified"},
+               "0xa2": {"status": "0", "message": "NOTOK", "result": "Query Timeout occured. Please select a smaller"
+                                                                    " result dataset"},
+               "0xb1": {"status": "0", "message": "contract address not found", "result": None},
+               "0xb2": {"status": "0", "message": "Internal server error", "result": None}}
+    requests = []
+
+    def handler(request):
+        address = request.url.params.get("address") or request.url.params.get("contractaddress")
+        requests.append(address)
+        return httpx.Response(200, json=answers[address])
+
+    cache = ResponseCache(tmp_path / "responses.db")
+    moonscan_api = MoonscanWrapper("moonriver", api_key="key1", response_cache=cache)
+    moonscan_api._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    blockscout_api = BlockscoutWrapper("moonriver", response_cache=cache)
+    blockscout_api._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    async with moonscan_api, blockscout_api:
+        for _ in range(2):
+            assert await moonscan_api.get_contract_abi("0xa1") is None
+            assert await moonscan_api.get_contract_abi("0xa2") is None
+            assert await blockscout_api.get_token_info("0xb1") is None
+            with pytest.raises(ExplorerError):
+                await blockscout_api.get_token_info("0xb2")
+    cache.close()
+    assert sorted(requests) == ["0xa1", "0xa2", "0xa2", "0xb1", "0xb2", "0xb2"], \
+        "Only unverified contracts and addresses that aren't tokens should be served from the cache"
+
+
+@pytest.mark.asyncio
+async def test_moonbeam_scraper_rechecks_non_tokens(tmp_path):
+    db = SubscrapeDB(f"sqlite:///{tmp_path}/non_tokens.db")
+    failing, not_a_token, malformed = "0xa1", "0xa2", "0xa3"
+    lookups = []
+
+    async def get_token_info(contract_address):
+        lookups.append(contract_address)
+        if contract_address == failing:
+            raise ExplorerError("Token info not retrievable")
+        if contract_address == malformed:
+            return {"name": "", "symbol": "", "decimals": ""}
+        return None
+
+    def create_scraper():
+        blockscout_api = BlockscoutWrapper("moonriver")
+        blockscout_api.get_token_info = get_token_info
+        return MoonbeamScraper(tmp_path / "moonriver_", MoonscanWrapper("moonriver"), blockscout_api, "moonriver",
+                               db=db)
+
+    scraper = create_scraper()
+    for contract_address in [failing, not_a_token, malformed]:
+        assert await scraper._MoonbeamScraper__retrieve_and_cache_token_info_from_contract(contract_address) is None
+    db.flush()
+    stored_token_infos = {token_info.address: token_info for token_info in db.query_token_infos("moonriver")}
+    assert failing not in stored_token_infos, "A failed lookup should not be stored"
+    assert stored_token_infos[not_a_token].retry_after > datetime.datetime.now()
+    assert stored_token_infos[malformed].retry_after > datetime.datetime.now()
+
+    lookups.clear()
+    scraper = create_scraper()
+    for contract_address in [failing, not_a_token, malformed]:
+        await scraper._MoonbeamScraper__retrieve_and_cache_token_info_from_contract(contract_address)
+    assert lookups == [failing], "Only the failed lookup should be repeated"
+
+    db.write_token_info("moonriver", not_a_token, None, datetime.datetime.now() - datetime.timedelta(seconds=1))
+    db.flush()
+    lookups.clear()
+    scraper = create_scraper()
+    await scraper._MoonbeamScraper__retrieve_and_cache_token_info_from_contract(not_a_token)
+    assert lookups == [not_a_token], "A contract should be checked again once its retry time has passed"
+    db.close()
+
+
+@pytest.mark.asyncio
+async def test_subscan_hydration_upserts_batches(tmp_path, monkeypatch):
+    explorer = MockExplorer(num_items=20)
+    explorer.install()
+    try:
+        db = SubscrapeDB(f"sqlite:///{tmp_path}/hydration.db")
+        api = SubscanWrapper("kusama", db, ["key1", "key2", "key3", "key4"])
+        async with api:
+            items = await api.fetch_extrinsic_metadata("system", "remark", ScrapeConfig({"_auto_hydrate": False}))
+            extrinsic_ids = [item.id for item in items]
+
+            def query_extrinsic(*args):
+                raise AssertionError("Hydration should not load the stored extrinsics one by one")
+            monkeypatch.setattr(db, "query_extrinsic", query_extrinsic)
+            items = await api.fetch_extrinsics(extrinsic_ids)
+            monkeypatch.undo()
+        assert len(items) == 20
+        assert len(extrinsic_ids) == 20, "The caller's list of ids should be left alone"
+        hydrated = db.query_extrinsics(chain="kusama", module="system", call="remark").all()
+        assert len(hydrated) == 20
+        assert all(extrinsic.params is not None for extrinsic in hydrated), "Every extrinsic should be hydrated"
+        assert all(extrinsic.block_timestamp is not None for extrinsic in hydrated)
+        db.close()
+    finally:
+        explorer.uninstall()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("background_writer", [False, True])
+async def test_subscan_hydration_returns_stored_events(tmp_path, background_writer):
+    explorer = MockExplorer(num_items=20)
+    explorer.install()
+    try:
+        db = SubscrapeDB(f"sqlite:///{tmp_path}/hydrated_events.db", background_writer=background_writer)
+        api = SubscanWrapper("kusama", db, ["key1", "key2", "key3", "key4"])
+        async with api:
+            items = await api.fetch_event_metadata("system", "remarked", ScrapeConfig({"_auto_hydrate": False}))
+            event_ids = [item.id for item in items]
+            items = await api.fetch_events(event_ids)
+        assert [item.id for item in items] == event_ids, "The events should be returned in the order of the ids"
+        for item in items:
+            assert item.params is not None, "The returned events should be hydrated"
+            # the block timestamp is only part of the list endpoint, not of the hydration payload
+            assert item.block_timestamp is not None
+            assert item.block_timestamp == db.query_event("kusama", item.id).block_timestamp
+        db.close()
+    finally:
+        explorer.uninstall()
@@ -1,7 +1,11 @@
+import asyncio
 import subscrape
 from subscrape.db.subscrape_db import SubscrapeDB, Extrinsic, Event
 import pytest
 import datetime
+import sqlalchemy
+import threading
+import time
 import substrateinterface.utils.ss58 as ss58
 
 
@@ -55,3 +59,194 @@ async def test_db():
     assert extrinsic.events[0].extrinsic.extrinsic_hash == "0x123"
 
     db.close()
+
+
+def test_contract_abis(tmp_path):
+    db = SubscrapeDB(f"sqlite:///{tmp_path}/test_abis.db")
+    retry_after = datetime.datetime.now() + datetime.timedelta(days=1)
+    db.write_contract_abi("moonriver", "0xabc", "[]")
+    db.write_contract_abi("moonriver", "0xdef", None, retry_after)
+    db.flush()
+
+    assert db.query_contract_abi("moonriver", "0xabc").abi == "[]"
+    unavailable = db.query_contract_abi("moonriver", "0xdef")
+    assert unavailable.abi is None
+    assert unavailable.retry_after == retry_after
+    assert db.query_contract_abi("moonbeam", "0xabc") is None, "ABIs are stored per chain"
+    db.close()
+
+
+def test_transaction_receipts(tmp_path):
+    db = SubscrapeDB(f"sqlite:///{tmp_path}/test_receipts.db")
+    receipt = {"blockNumber": "0x7b", "transactionHash": "0x123", "status": "0x1",
+               "logs": [{"address": "0xabc", "topics": ["0x01", "0x02"], "data": "0x" + "00" * 64}]}
+    db.write_transaction_receipt("moonriver", "0x123", receipt)
+    db.flush()
+
+    assert db.query_transaction_receipt("moonriver", "0x123") == receipt
+    assert db.query_transaction_receipt("moonriver", "0x456") is None
+    db.close()
+
+
+def test_token_infos(tmp_path):
+    db = SubscrapeDB(f"sqlite:///{tmp_path}/test_tokens.db")
+    db.write_token_info("moonriver", "0xabc", {"name": "Token", "symbol": "TKN", "decimals": "18", "type": "ERC-20"})
+    db.write_token_info("moonriver", "0xdef", None)
+    db.write_token_info("moonbeam", "0xabc", None)
+    db.flush()
+
+    token_infos = {token_info.address: token_info for token_info in db.query_token_infos("moonriver")}
+    assert len(token_infos) == 2
+    assert token_infos["0xabc"].is_token and token_infos["0xabc"].symbol == "TKN"
+    assert not token_infos["0xdef"].is_token, "Contracts that aren't tokens should be remembered as well"
+    db.close()
+
+
+def test_write_many(tmp_path):
+    db = SubscrapeDB(f"sqlite:///{tmp_path}/test_write_many.db")
+    rows = [dict(chain="chain", id=f"123-{index}", block_number=123, extrinsic_id="123-1", module="module",
+                 event="event", finalized=False) for index in range(3)]
+    db.write_many(Event, rows)
+    db.flush()
+    assert db.query_events(chain="chain").count() == 3
+
+    # existing rows are skipped by a plain insert...
+    db.write_many(Event, [dict(rows[0], module="other")])
+    db.flush()
+    assert db.query_event("chain", "123-0").module == "module"
+
+    # ...and updated by an upsert
+    db.write_many(Event, [dict(chain="chain", id="123-0", params={"param1": "value1"}, finalized=True)], upsert=True)
+    db.flush()
+    db.close()
+
+    db = SubscrapeDB(f"sqlite:///{tmp_path}/test_write_many.db")
+    event = db.query_event("chain", "123-0")
+    assert event.params == {"param1": "value1"} and event.finalized
+    assert event.module == "module", "Columns missing from an upsert should be kept"
+    db.close()
+
+
+def test_query_ids(tmp_path):
+    db = SubscrapeDB(f"sqlite:///{tmp_path}/test_ids.db")
+    db.write_many(Extrinsic, [dict(chain="chain", id=f"123-{index}", module="module",
+                                   call="call" if index % 2 else "other") for index in range(4)])
+    db.write_many(Event, [dict(chain="chain", id=f"123-{index}", module="module", event="event") for index in range(3)])
+    db.flush()
+
+    assert db.query_extrinsic_ids("chain", module="module", call="call") == {"123-1", "123-3"}
+    assert db.query_extrinsic_ids("chain", extrinsic_ids=["123-0", "123-9"]) == {"123-0"}
+    assert db.query_event_ids("chain", module="module", event="event") == {"123-0", "123-1", "123-2"}
+    assert db.query_event_ids("other chain") == set()
+    db.close()
+
+
+@pytest.mark.asyncio
+async def test_background_writer(tmp_path):
+    db = SubscrapeDB(f"sqlite:///{tmp_path}/test_writer.db", background_writer=True)
+    assert db._session.execute(sqlalchemy.text("PRAGMA journal_mode")).scalar() == "wal"
+
+    for page in range(5):
+        await db.write_many_async(Event, [dict(chain="chain", id=f"{page}-{index}", module="module", event="event")
+                                          for index in range(100)])
+    await db.flush_async()
+    assert len(db.query_event_ids("chain")) == 500, "Flushing should wait until the writer has committed"
+    db.close()
+
+
+@pytest.mark.asyncio
+async def test_background_writer_applies_backpressure(tmp_path, monkeypatch):
+    db = SubscrapeDB(f"sqlite:///{tmp_path}/test_backpressure.db", background_writer=True)
+    db._writer.max_pending_batches = 2
+    write_rows = db._write_rows
+
+    def slow_write_rows(*args):
+        time.sleep(0.1)
+        write_rows(*args)
+    monkeypatch.setattr(db, "_write_rows", slow_write_rows)
+
+    ticks = 0
+
+    async def ticker():
+        nonlocal ticks
+        while True:
+            await asyncio.sleep(0.01)
+            ticks += 1
+
+    ticker_task = asyncio.create_task(ticker())
+    start = time.monotonic()
+    for page in range(6):
+        await db.write_many_async(Event, [dict(chain="chain", id=f"{page}-0", module="module", event="event")])
+    elapsed = time.monotonic() - start
+    await db.flush_async()
+    ticker_task.cancel()
+
+    assert elapsed >= 0.3, "Producers should wait once the writer is behind"
+    assert ticks >= 20, "The event loop should keep running while the writer works"
+    assert len(db.query_event_ids("chain")) == 6
+    db.close()
+
+
+@pytest.mark.asyncio
+async def test_background_writer_is_the_only_writer(tmp_path):
+    db = SubscrapeDB(f"sqlite:///{tmp_path}/test_single_writer.db", background_writer=True)
+    db._writer.commit_interval = 60     # keep the rows of the writer uncommitted while the main session is used
+    db.write_transaction_receipt("moonriver", "0x123", {"blockNumber": "0x10", "logs": []})
+    db.write_contract_abi("moonriver", "0xabc", "[]")
+    db.query_contract_abi("moonriver", "0xabc")
+    await db.write_many_async(Event, [dict(chain="chain", id="1-0", module="module", event="event")])
+    await asyncio.wait_for(db.flush_async(), timeout=2)
+    assert db.query_transaction_receipt("moonriver", "0x123") == {"blockNumber": "0x10", "logs": []}
+    assert db.query_contract_abi("moonriver", "0xabc").abi == "[]"
+    assert db.query_event_ids("chain") == {"1-0"}
+    db.close()
+
+
+@pytest.mark.asyncio
+async def test_background_writer_failure_surfaces_and_keeps_queued_rows(tmp_path, monkeypatch):
+    db = SubscrapeDB(f"sqlite:///{tmp_path}/test_writer_failure.db", background_writer=True)
+    gate = threading.Event()
+    write_rows = db._write_rows
+
+    def gated_write_rows(*args):
+        gate.wait()     # lets both batches be queued before the first one fails
+        write_rows(*args)
+    monkeypatch.setattr(db, "_write_rows", gated_write_rows)
+
+    await db.write_many_async(Event, [dict(chain="chain", id="1-0", module=object(), event="event")])
+    await db.write_many_async(Event, [dict(chain="chain", id="1-1", module="module", event="event")])
+    gate.set()
+    with pytest.raises(sqlalchemy.exc.DBAPIError):
+        await db.flush_async()
+    with pytest.raises(sqlalchemy.exc.DBAPIError):
+        await db.write_many_async(Event, [dict(chain="chain", id="1-2", module="module", event="event")])
+    with pytest.raises(sqlalchemy.exc.DBAPIError):
+        db.close()
+    db = SubscrapeDB(f"sqlite:///{tmp_path}/test_writer_failure.db")
+    assert db.query_event_ids("chain") == {"1-1"}, "The rows queued after the failure should still be written"
+    db.close()
+
+
+def test_indexes_are_migrated_and_used(tmp_path, caplog):
+    db_connection_string = f"sqlite:///{tmp_path}/test_indexes.db"
+    db = SubscrapeDB(db_connection_string)
+    # simulate a database file that was created before the indexes were introduced
+    with db._engine.begin() as connection:
+        connection.execute(sqlalchemy.text("DROP INDEX ix_extrinsics_chain_module_call"))
+        connection.execute(sqlalchemy.text("DROP INDEX ix_events_chain_extrinsic_id"))
+    db.close()
+
+    db = SubscrapeDB(db_connection_string)
+    index_names = {index["name"] for table in ["extrinsics", "events"]
+                   for index in sqlalchemy.inspect(db._engine).get_indexes(table)}
+    assert {"ix_extrinsics_chain_module_call", "ix_events_chain_extrinsic_id"} <= index_names
+
+    plan = db.explain(db.query_extrinsics(chain="chain", module="module", call="call"))
+    assert "ix_extrinsics_chain_module_call" in plan[0]
+
+    with caplog.at_level("WARNING"):
+        db.query_extrinsics(chain="chain", module="module", call="call")
+        assert "reads the whole table" not in caplog.text
+        db.query_events(event="event")
+        assert "Querying events by event reads the whole table" in caplog.text
+    db.close()